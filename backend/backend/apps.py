@@ -1,6 +1,36 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+# Settings naming caches whose contents every worker process must see
+SHARED_CACHE_SETTINGS = ["TRANSCRIPTION_JOB_CACHE_ALIAS", "NOTEBOOK_CACHE_ALIAS"]
+
+
+def check_shared_caches() -> None:
+    """Refuse to serve from several worker processes with a process-local cache
+    they must share
+
+    Raises:
+        ImproperlyConfigured: If settings.WEB_CONCURRENCY is above 1 and a cache
+            named by SHARED_CACHE_SETTINGS keeps its contents in process memory
+    """
+    if settings.WEB_CONCURRENCY <= 1:
+        return
+    for name in SHARED_CACHE_SETTINGS:
+        alias = getattr(settings, name)
+        if isinstance(caches[alias], LocMemCache):
+            raise ImproperlyConfigured(
+                f"{name} names the cache {alias!r}, which is local to each process, "
+                f"but WEB_CONCURRENCY runs {settings.WEB_CONCURRENCY} worker "
+                "processes that must share it"
+            )
 
 
 class BackendConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'backend'
+
+    def ready(self) -> None:
+        check_shared_caches()
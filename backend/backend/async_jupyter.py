@@ -0,0 +1,625 @@
+from typing import Any, AsyncIterator, Hashable
+
+import asyncio
+import json
+import weakref
+
+import httpx
+from django.conf import settings
+from websockets.asyncio.client import ClientConnection, connect
+from websockets.exceptions import InvalidStatus, WebSocketException
+
+from backend import jupyter
+from backend.jupyter import (
+    CachedExecution,
+    ExecutionTimeout,
+    JupyterError,
+    KernelCache,
+    KernelNotFound,
+    KernelReaper,
+    ResultCache,
+    OutputReader,
+    StandbyPool,
+    batch_waves,
+    forget_kernel,
+    jupyter_error_output,
+    message_waiters,
+    session_kernel,
+    session_model,
+)
+from backend.utils import send_execute_request
+
+
+class AsyncJupyterClient:
+    """Asynchronous counterpart of jupyter.JupyterClient for use in async views
+
+    REST calls use a pooled httpx.AsyncClient and kernel channels use asyncio
+    websockets, so waiting on the Jupyter server never pins a thread. Kernel
+    lookups, standby kernels, the reaper and cached results are shared with the
+    synchronous client.
+
+    Attributes:
+        ws_url (str): Websocket URL of the Jupyter server
+        headers (dict[str, str]): Authentication headers for the Jupyter server
+        http (httpx.AsyncClient): Keep-alive client shared by all requests
+        kernels (KernelCache): Cache of kernel IDs per user and language
+        standby (StandbyPool): Pre-started kernels waiting for new sessions
+        reaper (KernelReaper): Shuts down idle kernels
+        results (ResultCache): Outputs of deterministic executions
+        channels (AsyncChannelManager): Long-lived websockets to each kernel
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: str,
+        token: str,
+        kernels: KernelCache,
+        standby: StandbyPool,
+        reaper: KernelReaper,
+        results: ResultCache,
+        timeout: tuple[float, float] = (3.05, 30),
+        pool_size: int = 10,
+    ) -> None:
+        self.ws_url = f"ws://{host}:{port}"
+        self.headers = {"Authorization": f"Token {token}"}
+        self.http = httpx.AsyncClient(
+            base_url=f"http://{host}:{port}",
+            headers=self.headers,
+            timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+            limits=httpx.Limits(max_keepalive_connections=pool_size),
+        )
+        self.kernels = kernels
+        self.standby = standby
+        self.reaper = reaper
+        self.results = results
+        self.channels = AsyncChannelManager(self)
+
+    async def _request(self, method: str, path: str, **kwargs: Any) -> httpx.Response:
+        """Send a request to the Jupyter server using the pooled client
+
+        Args:
+            method (str): HTTP method
+            path (str): Path on the Jupyter server, e.g. "/api/kernels"
+
+        Raises:
+            KernelNotFound: If the server responds with 404
+            JupyterError: If the server cannot be reached or responds with an error
+
+        Returns:
+            httpx.Response: The server's response
+        """
+        try:
+            response = await self.http.request(method, path, **kwargs)
+        except httpx.HTTPError as e:
+            raise JupyterError("Could not connect to Jupyter Server") from e
+
+        if response.status_code == 404:
+            raise KernelNotFound(path)
+        if not response.is_success:
+            raise JupyterError(f"Jupyter Server responded with {response.status_code}")
+        return response
+
+    async def list_kernels(self) -> list[dict[str, Any]]:
+        """Get the list of running kernels"""
+        return (await self._request("GET", "/api/kernels")).json()
+
+    async def start_kernel(self, language: str) -> dict[str, Any]:
+        """Start a new kernel
+
+        Args:
+            language (str): The kernel name to start
+        """
+        response = await self._request("POST", "/api/kernels", json={"name": language})
+        return response.json()
+
+    async def list_sessions(self) -> list[dict[str, Any]]:
+        """Get the list of sessions binding a path to a kernel"""
+        return (await self._request("GET", "/api/sessions")).json()
+
+    async def create_session(
+        self, user: Hashable, language: str, kernel_id: str | None = None
+    ) -> str:
+        """Bind the user's session in a language to a kernel
+
+        Args:
+            user (Hashable): Key identifying the user
+            language (str): Kernel name
+            kernel_id (str | None): Existing kernel to bind, or None to start one
+
+        Returns:
+            str: The ID of the kernel the session is bound to
+        """
+        response = await self._request(
+            "POST", "/api/sessions", json=session_model(user, language, kernel_id)
+        )
+        return response.json()["kernel"]["id"]
+
+    async def find_kernel(self, user: Hashable, language: str) -> str | None:
+        """Get the ID of the user's kernel in the given language without starting one
+
+        Args:
+            user (Hashable): Key identifying the user
+            language (str): Kernel name
+
+        Returns:
+            str | None: The kernel ID, or None if no kernel is running
+        """
+        kernel_id = self.kernels.get(user, language)
+        if kernel_id is None:
+            kernel_id = session_kernel(await self.list_sessions(), user, language)
+            if kernel_id is not None:
+                self.kernels.set(user, language, kernel_id)
+        return kernel_id
+
+    async def get_kernel(self, user: Hashable, language: str) -> str:
+        """Get the ID of the user's kernel in the given language, starting one if needed
+
+        Args:
+            user (Hashable): Key identifying the user
+            language (str): Kernel name
+
+        Returns:
+            str: The kernel ID
+        """
+        kernel_id = await self.find_kernel(user, language)
+        if kernel_id is None:
+            await asyncio.to_thread(self.reaper.make_room, language)
+            standby_id = self.standby.take(language)
+            try:
+                kernel_id = await self.create_session(user, language, standby_id)
+            except KernelNotFound:
+                # The standby kernel was shut down, e.g. by another worker's reaper
+                kernel_id = await self.create_session(user, language)
+                standby_id = None
+            except JupyterError:
+                self.standby.put(language, standby_id)
+                raise
+            if kernel_id != standby_id:
+                self.standby.put(language, standby_id)
+            self.kernels.set(user, language, kernel_id)
+        return kernel_id
+
+    async def restart_kernel(self, kernel_id: str) -> None:
+        """Restart a kernel, invalidating any cached lookups and results of it
+
+        Args:
+            kernel_id (str): The kernel to restart
+        """
+        self.kernels.invalidate(kernel_id)
+        self.results.bump(kernel_id)
+        await self._request("POST", f"/api/kernels/{kernel_id}/restart")
+
+    async def interrupt_kernel(self, kernel_id: str) -> None:
+        """Interrupt the code a kernel is running
+
+        Args:
+            kernel_id (str): The kernel to interrupt
+        """
+        await self._request("POST", f"/api/kernels/{kernel_id}/interrupt")
+
+    async def connect(self, kernel_id: str) -> ClientConnection:
+        """Open a websocket to the channels of a kernel
+
+        Args:
+            kernel_id (str): The kernel to connect to
+
+        Raises:
+            KernelNotFound: If the kernel no longer exists
+
+        Returns:
+            ClientConnection: Connection multiplexing the kernel's channels
+        """
+        try:
+            return await connect(
+                f"{self.ws_url}/api/kernels/{kernel_id}/channels",
+                additional_headers=self.headers,
+                max_size=None,
+            )
+        except InvalidStatus as e:
+            if e.response.status_code == 404:
+                forget_kernel(self, kernel_id)
+                raise KernelNotFound(kernel_id) from e
+            raise JupyterError("Could not connect to kernel") from e
+        except (WebSocketException, OSError) as e:
+            raise JupyterError("Could not connect to Jupyter Server") from e
+
+    async def execute(
+        self, user: Hashable, language: str, code: str, stop_on_error: bool = True
+    ) -> "AsyncExecution | CachedExecution":
+        """Send code to the user's kernel, retrying once if the cached kernel is gone
+
+        The cached result is returned instead if the same code was the last to
+        run on the kernel and the language's results are cached.
+
+        Args:
+            user (Hashable): Key identifying the user
+            language (str): Kernel name
+            code (str): The code to execute
+            stop_on_error (bool): Whether the kernel aborts the requests queued
+                behind this one if it fails
+
+        Returns:
+            AsyncExecution | CachedExecution: The messages the kernel sends in
+                reply, or the cached result
+        """
+        kernel_id = await self.get_kernel(user, language)
+        cached = self.results.get(self.results.key(kernel_id, language, code))
+        if cached is not None:
+            self.reaper.touch(kernel_id)
+            return cached
+
+        try:
+            execution = await self.channels.get(kernel_id).execute(code, stop_on_error)
+        except KernelNotFound:
+            await self.channels.discard(kernel_id)
+            kernel_id = await self.get_kernel(user, language)
+            execution = await self.channels.get(kernel_id).execute(code, stop_on_error)
+        execution.cache_key = self.results.record_run(kernel_id, language, code)
+        self.reaper.touch(kernel_id)
+        return execution
+
+    async def execute_batch(
+        self, user: Hashable, blocks: list[dict[str, str]], stop_on_error: bool = False
+    ) -> AsyncIterator[tuple[str, str, Any]]:
+        """Run code blocks in order, like jupyter.JupyterClient.execute_batch
+
+        Args:
+            user (Hashable): Key identifying the user
+            blocks (list[dict[str, str]]): Code blocks with id, language and code fields
+            stop_on_error (bool): Whether to skip every block after one that fails
+
+        Yields:
+            tuple[str, str, Any]: The output and status events of the blocks, as
+                they arrive
+        """
+        failed = False
+        for wave in batch_waves(blocks, stop_on_error):
+            executions = (
+                [] if failed else await self._send_wave(user, wave, stop_on_error)
+            )
+            for index, block in enumerate(wave):
+                execution = executions[index] if index < len(executions) else None
+                if execution is None or failed:
+                    # The kernel aborts requests queued behind a failed one
+                    if isinstance(execution, (AsyncExecution, CachedExecution)):
+                        execution.close()
+                    yield "status", block["id"], "skipped"
+                    continue
+
+                if isinstance(execution, JupyterError):
+                    yield "output", block["id"], jupyter_error_output()
+                    status = "error"
+                else:
+                    async for event, value in execution_events(
+                        execution, block["language"]
+                    ):
+                        if event == "status":
+                            status = value
+                        else:
+                            yield "output", block["id"], value
+                yield "status", block["id"], status
+                failed = stop_on_error and status != "ok"
+
+    async def _send_wave(
+        self, user: Hashable, wave: list[dict[str, str]], stop_on_error: bool
+    ) -> list["AsyncExecution | CachedExecution | JupyterError"]:
+        executions: list[AsyncExecution | CachedExecution | JupyterError] = []
+        for block in wave:
+            try:
+                executions.append(
+                    await self.execute(
+                        user, block["language"], block["code"], stop_on_error
+                    )
+                )
+            except JupyterError as e:
+                executions.append(e)
+                if stop_on_error:
+                    break
+        return executions
+
+
+class AsyncExecution:
+    """The reply messages to one execute request on a shared async kernel channel
+
+    Attributes:
+        channel (AsyncKernelChannel): The channel the request was sent on
+        msg_id (str): ID of the execute request
+        ws (ClientConnection | None): The websocket the request was sent on
+        messages (asyncio.Queue): Messages routed to this request by the channel
+        cache_key (tuple[str, str, str, int] | None): Where to cache the outputs
+            if the execution succeeds
+    """
+
+    def __init__(self, channel: "AsyncKernelChannel", msg_id: str) -> None:
+        self.channel = channel
+        self.msg_id = msg_id
+        self.ws: ClientConnection | None = None
+        self.messages: asyncio.Queue[dict[str, Any] | None] = asyncio.Queue()
+        self.cache_key: tuple[str, str, str, int] | None = None
+
+    async def __aiter__(self) -> AsyncIterator[dict[str, Any]]:
+        while True:
+            yield await self.next_message()
+
+    async def next_message(self, timeout: float | None = None) -> dict[str, Any]:
+        """Wait for the next message for this request
+
+        Args:
+            timeout (float | None): Seconds to wait, or None to wait indefinitely
+
+        Raises:
+            ExecutionTimeout: If no message arrives in time
+            JupyterError: If the connection to the kernel was lost
+
+        Returns:
+            dict[str, Any]: The message
+        """
+        try:
+            rsp = await asyncio.wait_for(self.messages.get(), timeout)
+        except asyncio.TimeoutError as e:
+            raise ExecutionTimeout(self.msg_id) from e
+        if rsp is None:
+            raise JupyterError("Lost connection to kernel")
+        return rsp
+
+    async def interrupt(self) -> None:
+        """Interrupt the kernel running this request"""
+        await self.channel.client.interrupt_kernel(self.channel.kernel_id)
+
+    async def events(self, language: str) -> AsyncIterator[tuple[str, Any]]:
+        """Translate the reply messages into output items as they arrive
+
+        Behaves like jupyter.Execution.outputs, interrupting the kernel at the
+        language's deadline, capping the output and caching the outputs if the
+        execution succeeded.
+
+        Args:
+            language (str): The language the code was executed in
+
+        Yields:
+            tuple[str, Any]: ("output", output item) for each output item, then
+                ("status", status) once the execution finishes
+        """
+        reader = OutputReader(language)
+        with self:
+            try:
+                while reader.status is None:
+                    try:
+                        rsp = await self.next_message(reader.timeout())
+                    except ExecutionTimeout:
+                        if not reader.interrupted:
+                            await self.interrupt()
+                        outputs = reader.timed_out()
+                    else:
+                        outputs = reader.read(rsp)
+                    for output in outputs:
+                        yield "output", output
+            except JupyterError:
+                for output in reader.failed():
+                    yield "output", output
+
+        if reader.status == "ok":
+            self.channel.client.results.set(self.cache_key, reader.outputs)
+        yield "status", reader.status
+
+    async def collect(self, language: str) -> tuple[list[dict[str, Any]], str]:
+        """Collect the output items of the execution
+
+        Args:
+            language (str): The language the code was executed in
+
+        Returns:
+            tuple[list[dict[str, Any]], str]: The output items and the execution's status
+        """
+        outputs = []
+        async for event, value in self.events(language):
+            if event == "output":
+                outputs.append(value)
+            else:
+                status = value
+        return outputs, status
+
+    def close(self) -> None:
+        """Stop routing messages to this request"""
+        self.channel.release(self.msg_id)
+
+    def __enter__(self) -> "AsyncExecution":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+class AsyncKernelChannel:
+    """A long-lived asyncio websocket to one kernel, shared by every request on a loop
+
+    A reader task routes each incoming message to the waiting request with a
+    matching parent_header.msg_id. The websocket is reopened if it drops.
+
+    Attributes:
+        client (AsyncJupyterClient): Client used to open the websocket
+        kernel_id (str): The kernel this channel talks to
+        _ws (ClientConnection | None): The open websocket, if connected
+        _reader (asyncio.Task | None): Task reading from _ws
+        _waiters (dict[str, AsyncExecution]): Pending requests by message ID
+        _lock (asyncio.Lock): Serialises connecting and sending
+    """
+
+    def __init__(self, client: AsyncJupyterClient, kernel_id: str) -> None:
+        self.client = client
+        self.kernel_id = kernel_id
+        self._ws: ClientConnection | None = None
+        self._reader: asyncio.Task | None = None
+        self._waiters: dict[str, AsyncExecution] = {}
+        self._lock = asyncio.Lock()
+
+    async def _connect(self) -> ClientConnection:
+        """Get the open websocket, connecting and starting a reader if needed
+
+        Must be called with _lock held.
+        """
+        if self._ws is None or self._reader is None or self._reader.done():
+            self._ws = await self.client.connect(self.kernel_id)
+            self._reader = asyncio.create_task(self._read(self._ws))
+        return self._ws
+
+    async def _read(self, ws: ClientConnection) -> None:
+        """Route messages from the websocket to waiting requests until it closes
+
+        Args:
+            ws (ClientConnection): The websocket to read from
+        """
+        try:
+            async for msg in ws:
+                rsp = json.loads(msg)
+                waiters = message_waiters(
+                    rsp, self._waiters, self.client, self.kernel_id
+                )
+                for waiter in waiters:
+                    waiter.messages.put_nowait(rsp)
+        except (WebSocketException, OSError, ValueError):
+            pass
+
+        # Wake any requests still waiting on this websocket
+        if self._ws is ws:
+            self._ws = None
+        for waiter in [w for w in self._waiters.values() if w.ws is ws]:
+            del self._waiters[waiter.msg_id]
+            waiter.messages.put_nowait(None)
+
+    async def execute(self, code: str, stop_on_error: bool = True) -> AsyncExecution:
+        """Send an execute request on the channel
+
+        Args:
+            code (str): The code to execute
+            stop_on_error (bool): Whether the kernel aborts the requests queued
+                behind this one if it fails
+
+        Returns:
+            AsyncExecution: The messages the kernel sends in reply
+        """
+        request = send_execute_request(code, stop_on_error)
+        execution = AsyncExecution(self, request["header"]["msg_id"])
+        payload = json.dumps(request)
+
+        async with self._lock:
+            try:
+                try:
+                    execution.ws = await self._connect()
+                    # Register before sending so no reply can arrive unrouted
+                    self._waiters[execution.msg_id] = execution
+                    await execution.ws.send(payload)
+                except (WebSocketException, OSError):
+                    # The websocket went stale while idle, so reconnect and try once more
+                    self._ws = execution.ws = None
+                    execution.ws = await self._connect()
+                    self._waiters[execution.msg_id] = execution
+                    await execution.ws.send(payload)
+            except (WebSocketException, OSError) as e:
+                self._waiters.pop(execution.msg_id, None)
+                raise JupyterError("Could not connect to kernel") from e
+            except JupyterError:
+                self._waiters.pop(execution.msg_id, None)
+                raise
+        return execution
+
+    def release(self, msg_id: str) -> None:
+        """Stop routing messages for a request
+
+        Args:
+            msg_id (str): ID of the request
+        """
+        self._waiters.pop(msg_id, None)
+
+    async def close(self) -> None:
+        """Close the websocket, waking any waiting requests"""
+        ws, self._ws = self._ws, None
+        if ws is not None:
+            await ws.close()
+
+
+class AsyncChannelManager:
+    """The kernel channels of one event loop, one per kernel
+
+    Attributes:
+        client (AsyncJupyterClient): Client used to open websockets
+        _channels (dict[str, AsyncKernelChannel]): Open channels by kernel ID
+    """
+
+    def __init__(self, client: AsyncJupyterClient) -> None:
+        self.client = client
+        self._channels: dict[str, AsyncKernelChannel] = {}
+
+    def get(self, kernel_id: str) -> AsyncKernelChannel:
+        """Get the channel to a kernel, creating it if needed
+
+        Args:
+            kernel_id (str): The kernel to talk to
+        """
+        if kernel_id not in self._channels:
+            self._channels[kernel_id] = AsyncKernelChannel(self.client, kernel_id)
+        return self._channels[kernel_id]
+
+    async def discard(self, kernel_id: str) -> None:
+        """Close and forget the channel to a kernel, if open
+
+        Args:
+            kernel_id (str): The kernel whose channel to close
+        """
+        channel = self._channels.pop(kernel_id, None)
+        if channel is not None:
+            await channel.close()
+
+
+async def execution_events(
+    execution: AsyncExecution | CachedExecution, language: str
+) -> AsyncIterator[tuple[str, Any]]:
+    """Read the output items of an execution, or of a cached result, as they arrive
+
+    Args:
+        execution (AsyncExecution | CachedExecution): The execution
+        language (str): The language the code was executed in
+
+    Yields:
+        tuple[str, Any]: ("output", output item) for each output item, then
+            ("status", status) once the execution finishes
+    """
+    if isinstance(execution, CachedExecution):
+        outputs, status = await execution.collect(language)
+        for output in outputs:
+            yield "output", output
+        yield "status", status
+        return
+    async for event in execution.events(language):
+        yield event
+
+
+# httpx clients and websockets belong to the event loop that created them, so
+# each loop (one per process under an ASGI server) gets its own client.
+_clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncJupyterClient] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_async_client() -> AsyncJupyterClient:
+    """Get the Jupyter client for the running event loop, creating it on first use
+
+    Returns:
+        AsyncJupyterClient: The loop's shared client
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _clients:
+        client = jupyter.get_client()
+        _clients[loop] = AsyncJupyterClient(
+            settings.JUPYTER_URL,
+            settings.JUPYTER_PORT,
+            settings.JUPYTER_TOKEN,
+            client.kernels,
+            client.standby,
+            client.reaper,
+            client.results,
+            timeout=(settings.JUPYTER_CONNECT_TIMEOUT, settings.JUPYTER_READ_TIMEOUT),
+            pool_size=settings.JUPYTER_POOL_SIZE,
+        )
+    return _clients[loop]
@@ -0,0 +1,354 @@
+"""
+Asynchronous versions of the views that wait on the Jupyter and handwriting servers.
+
+These are routed in place of their synchronous counterparts in views.py when
+settings.ASYNC_VIEWS is set, which is the case when the app is served from
+thesite/asgi.py by an ASGI server (see entrypoint.sh). A request waiting on a
+kernel or the handwriting model then holds no worker thread, so one process can
+serve hundreds of in-flight executions and transcriptions.
+"""
+
+from typing import IO, Any, AsyncIterator, Awaitable, Callable
+
+import asyncio
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse
+
+from backend import async_jupyter, handwriting
+from backend.jupyter import JupyterError, KernelNotFound
+from backend.streaming import AsyncStreamingHttpResponse
+from backend.utils import server_sent_event
+from backend.views import (
+    Strokes,
+    batch_results,
+    batch_server_sent_event,
+    create_transcription,
+    handwriting_error_response,
+    parse_blocks,
+    parse_image_blocks,
+    preprocess_image,
+    preprocess_lines,
+    stitch_lines,
+    uploaded_ink,
+)
+
+
+def async_login_required(
+    view: Callable[..., Awaitable[HttpResponse]],
+) -> Callable[..., Awaitable[HttpResponse]]:
+    """login_required for async views, which Django 4.1's decorator does not support
+
+    Args:
+        view (Callable[..., Awaitable[HttpResponse]]): The async view to protect
+
+    Returns:
+        Callable[..., Awaitable[HttpResponse]]: The view, redirecting to the login
+            page if the user is not logged in
+    """
+
+    @wraps(view)
+    async def wrapper(request: ASGIRequest, *args: Any, **kwargs: Any) -> HttpResponse:
+        # Loading the user touches the session and auth tables, which is blocking
+        is_authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
+        if not is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+
+    return wrapper
+
+
+@async_login_required
+async def execute(request: ASGIRequest) -> HttpResponse:
+    """Asynchronous version of views.execute
+
+    Args:
+        request (ASGIRequest): POST request with the following fields:
+            - language: The language to execute the code in
+            - code: The code to execute
+
+    Returns:
+        HttpResponse: Response with the output of the code execution
+    """
+    language = request.POST.get("language")
+    code = request.POST.get("code")
+
+    try:
+        client = async_jupyter.get_async_client()
+        execution = await client.execute(request.user.pk, language, code)
+    except JupyterError:
+        output = {
+            "success": False,
+            "type": "text",
+            "content": "Jupyter Server Error",
+        }
+        return JsonResponse({"output_stream": [output]})
+
+    full_response, _ = await execution.collect(language)
+
+    return JsonResponse({"output_stream": full_response})
+
+
+@async_login_required
+async def execute_stream(request: ASGIRequest) -> HttpResponse:
+    """Asynchronous version of views.execute_stream
+
+    Args:
+        request (ASGIRequest): POST request with the following fields:
+            - language: The language to execute the code in
+            - code: The code to execute
+
+    Returns:
+        HttpResponse: Streaming response of output and status events
+    """
+    language = request.POST.get("language")
+    code = request.POST.get("code")
+
+    try:
+        client = async_jupyter.get_async_client()
+        execution = await client.execute(request.user.pk, language, code)
+    except JupyterError:
+        output = {
+            "success": False,
+            "type": "text",
+            "content": "Jupyter Server Error",
+        }
+        response = HttpResponse(
+            server_sent_event("output", output)
+            + server_sent_event("status", {"status": "error"}),
+            content_type="text/event-stream",
+        )
+        response["Cache-Control"] = "no-cache"
+        return response
+
+    async def events() -> AsyncIterator[str]:
+        async for event, value in async_jupyter.execution_events(execution, language):
+            if event == "output":
+                yield server_sent_event("output", value)
+            else:
+                yield server_sent_event("status", {"status": value})
+
+    return _event_stream_response(events())
+
+
+def _event_stream_response(events: AsyncIterator[str]) -> AsyncStreamingHttpResponse:
+    """Asynchronous version of views._event_stream_response
+
+    Args:
+        events (AsyncIterator[str]): The encoded events
+
+    Returns:
+        AsyncStreamingHttpResponse: The streaming response
+    """
+    response = AsyncStreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Stop reverse proxies from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@async_login_required
+async def execute_batch(request: ASGIRequest) -> HttpResponse:
+    """Asynchronous version of views.execute_batch
+
+    Args:
+        request (ASGIRequest): POST request with the following fields:
+            - blocks: JSON list of code blocks, each with id, language and code fields
+            - stop_on_error: "true" to skip every block after one that fails
+
+    Returns:
+        HttpResponse: Response with the output_stream and status of each block,
+            keyed by block ID
+    """
+    try:
+        blocks = parse_blocks(request.POST.get("blocks"))
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    stop_on_error = request.POST.get("stop_on_error") == "true"
+
+    client = async_jupyter.get_async_client()
+    events = [
+        event
+        async for event in client.execute_batch(request.user.pk, blocks, stop_on_error)
+    ]
+
+    return JsonResponse({"blocks": batch_results(blocks, events)})
+
+
+@async_login_required
+async def execute_batch_stream(request: ASGIRequest) -> HttpResponse:
+    """Asynchronous version of views.execute_batch_stream
+
+    Args:
+        request (ASGIRequest): POST request with the same fields as execute_batch
+
+    Returns:
+        HttpResponse: Streaming response of output and status events
+    """
+    try:
+        blocks = parse_blocks(request.POST.get("blocks"))
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    stop_on_error = request.POST.get("stop_on_error") == "true"
+
+    client = async_jupyter.get_async_client()
+    events = client.execute_batch(request.user.pk, blocks, stop_on_error)
+
+    async def encoded_events() -> AsyncIterator[str]:
+        async for event in events:
+            yield batch_server_sent_event(*event)
+
+    return _event_stream_response(encoded_events())
+
+
+@async_login_required
+async def restart_kernel(request: ASGIRequest) -> HttpResponse:
+    """Asynchronous version of views.restart_kernel
+
+    Args:
+        request (ASGIRequest): POST request with the following fields:
+            - language: The language of the kernel to restart
+
+    Returns:
+        HttpResponse: Success if restart was successful
+    """
+    language = request.POST.get("language")
+
+    client = async_jupyter.get_async_client()
+
+    try:
+        kernel_id = await client.find_kernel(request.user.pk, language)
+    except JupyterError:
+        return HttpResponse("Could not connect to Jupyter Server")
+
+    if kernel_id is None:
+        return HttpResponse("No active kernel in given language")
+
+    try:
+        await client.restart_kernel(kernel_id)
+    except KernelNotFound:
+        return HttpResponse("No active kernel in given language")
+    except JupyterError:
+        return HttpResponse("Could not restart kernel")
+
+    return HttpResponse("Restarted Kernel")
+
+
+@async_login_required
+async def image_to_text(request: ASGIRequest) -> HttpResponse:
+    """Asynchronous version of views.image_to_text
+
+    Args:
+        request (ASGIRequest): POST request with the following fields:
+            - model_name: The name of the model to use for conversion
+            - predictions_format: "compact" for the compact predictions format
+            - strokes: JSON strokes of the code block (see views.parse_strokes), or
+            - FILE: img: The image to convert to text
+
+    Returns:
+        HttpResponse: Response with a dictionary containing the predicted characters and their probabilities,
+            or a 503 response with an error field if the handwriting server failed
+    """
+    if request.method == "POST":
+        try:
+            image = uploaded_ink(request)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        model_name = request.POST.get("model_name")
+        compact = request.POST.get("predictions_format") == "compact"
+
+        try:
+            transcription = await transcribe_image(image, model_name, compact)
+        except handwriting.HandwritingError as e:
+            return handwriting_error_response(e)
+
+        return JsonResponse(transcription)
+
+    return HttpResponse("upload failed")
+
+
+@async_login_required
+async def image_to_text_batch(request: ASGIRequest) -> HttpResponse:
+    """Asynchronous version of views.image_to_text_batch
+
+    Args:
+        request (ASGIRequest): POST request with the following fields:
+            - blocks: JSON list of code blocks, each with id and model_name fields,
+              and optionally the block's strokes (see views.parse_strokes)
+            - predictions_format: "compact" for the compact predictions format
+            - FILE: <id>: The image of each block without strokes, named by its
+              block ID
+
+    Returns:
+        HttpResponse: Response with the predicted_text and predictions of each
+            block keyed by block ID, or an error field for blocks that could not be
+            transcribed
+    """
+    try:
+        blocks = parse_image_blocks(request.POST.get("blocks"), request.FILES)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    compact = request.POST.get("predictions_format") == "compact"
+    semaphore = asyncio.Semaphore(settings.HANDWRITING_BATCH_CONCURRENCY)
+
+    async def transcribe(block: dict[str, Any]) -> dict[str, Any]:
+        async with semaphore:
+            try:
+                return await transcribe_image(
+                    block["image"], block["model_name"], compact
+                )
+            except handwriting.HandwritingError as e:
+                return {"error": str(e)}
+
+    transcriptions = await asyncio.gather(*(transcribe(block) for block in blocks))
+    results = {
+        block["id"]: transcription
+        for block, transcription in zip(blocks, transcriptions)
+    }
+
+    return JsonResponse({"blocks": results})
+
+
+async def transcribe_image(
+    image: IO[bytes] | Strokes, model_name: str | None, compact: bool = False
+) -> dict[str, Any]:
+    """Asynchronous version of views.transcribe_image
+
+    Args:
+        image (IO[bytes] | Strokes): The image or strokes of the code block
+        model_name (str | None): The name of the model to use for conversion
+        compact (bool): Whether to give the predictions in the compact format
+
+    Raises:
+        handwriting.HandwritingError: If the handwriting server failed
+
+    Returns:
+        dict[str, Any]: The predicted text and the predictions for each character
+    """
+    # Image processing is CPU-bound, so keep it off the event loop
+    if settings.HANDWRITING_SPLIT_LINES:
+        lines = [
+            line.getvalue() for line in await asyncio.to_thread(preprocess_lines, image)
+        ]
+    else:
+        lines = [(await asyncio.to_thread(preprocess_image, image)).getvalue()]
+
+    cache = handwriting.get_transcription_cache()
+    # The client caps the transcriptions in flight on this event loop
+    client = handwriting.get_async_handwriting_client()
+
+    async def transcribe(line: bytes) -> dict[str, Any]:
+        key = cache.key(line, model_name)
+        predictions = await cache.aget(key)
+        if predictions is None:
+            predictions = await client.transcribe(line, model_name)
+            await cache.aset(key, predictions)
+        return predictions
+
+    line_predictions = await asyncio.gather(*(transcribe(line) for line in lines))
+    return create_transcription(stitch_lines(list(line_predictions)), compact)
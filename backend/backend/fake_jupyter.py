@@ -0,0 +1,372 @@
+"""
+A stand-in for the Jupyter server, for measuring the backend without real kernels.
+
+FakeJupyterServer is an ASGI app implementing the parts of the Jupyter server API
+the backend uses: the kernel and session REST endpoints and the kernel channels
+websocket. Its kernels answer every execute request with a configurable number
+and size of stream messages, each sent after a configurable latency. Code starting
+with "raise" fails instead, and an interrupt stops the code running.
+
+Serve it with `python manage.py fake_jupyter`, or in-process with serve().
+"""
+
+from typing import Any, Awaitable, Callable
+
+import asyncio
+import json
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import uvicorn
+
+Receive = Callable[[], Awaitable[dict[str, Any]]]
+Send = Callable[[dict[str, Any]], Awaitable[None]]
+
+
+class FakeKernel:
+    """A kernel that echoes code instead of running it
+
+    Attributes:
+        id (str): The kernel ID
+        name (str): The kernel's language
+        execution_state (str): "idle" or "busy"
+        connections (int): Number of open websockets to the kernel
+        last_activity (datetime): When the kernel last sent a message
+        lock (asyncio.Lock): Runs one execute request at a time, like a real kernel
+        running (asyncio.Task | None): The execute request being run
+        received (int): Number of execute requests received
+        abort_until (int): Requests received up to this number are aborted, as they
+            were queued behind a request that failed
+    """
+
+    def __init__(self, name: str) -> None:
+        self.id = str(uuid.uuid4())
+        self.name = name
+        self.execution_state = "idle"
+        self.connections = 0
+        self.last_activity = datetime.now(timezone.utc)
+        self.lock = asyncio.Lock()
+        self.running: asyncio.Task | None = None
+        self.received = 0
+        self.abort_until = 0
+
+    def model(self) -> dict[str, Any]:
+        """Get the kernel model the Jupyter server reports
+
+        Returns:
+            dict[str, Any]: The kernel model
+        """
+        return {
+            "id": self.id,
+            "name": self.name,
+            "last_activity": self.last_activity.isoformat(),
+            "execution_state": self.execution_state,
+            "connections": self.connections,
+        }
+
+
+class FakeJupyterServer:
+    """ASGI app imitating the Jupyter server's kernels, sessions and channels
+
+    Attributes:
+        latency (float): Seconds the kernel waits before sending each message
+        output_messages (int): Number of stream messages sent per execute request
+        output_size (int): Characters of output in each stream message
+        kernels (dict[str, FakeKernel]): Running kernels by ID
+        sessions (dict[str, dict[str, Any]]): Session models by path
+        started (int): Number of kernels started since the server started
+    """
+
+    def __init__(
+        self, latency: float = 0.0, output_messages: int = 1, output_size: int = 0
+    ) -> None:
+        self.latency = latency
+        self.output_messages = output_messages
+        self.output_size = output_size
+        self.kernels: dict[str, FakeKernel] = {}
+        self.sessions: dict[str, dict[str, Any]] = {}
+        self.started = 0
+
+    async def __call__(
+        self, scope: dict[str, Any], receive: Receive, send: Send
+    ) -> None:
+        if scope["type"] == "http":
+            body = b""
+            while True:
+                message = await receive()
+                body += message.get("body", b"")
+                if not message.get("more_body"):
+                    break
+            status, data = self.handle(scope["method"], scope["path"], body)
+            payload = b"" if data is None else json.dumps(data).encode()
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": status,
+                    "headers": [(b"content-type", b"application/json")],
+                }
+            )
+            await send({"type": "http.response.body", "body": payload})
+        elif scope["type"] == "websocket":
+            await self.channels(scope, receive, send)
+
+    def handle(self, method: str, path: str, body: bytes) -> tuple[int, Any]:
+        """Answer a REST request
+
+        Args:
+            method (str): HTTP method
+            path (str): Request path
+            body (bytes): JSON request body
+
+        Returns:
+            tuple[int, Any]: HTTP status and JSON response body
+        """
+        data = json.loads(body) if body else {}
+
+        if path == "/api/kernels":
+            if method == "GET":
+                return 200, [kernel.model() for kernel in self.kernels.values()]
+            if method == "POST":
+                return 201, self.start_kernel(data.get("name", "python3")).model()
+
+        if path == "/api/sessions":
+            if method == "GET":
+                return 200, [
+                    session
+                    for session in self.sessions.values()
+                    if session["kernel"]["id"] in self.kernels
+                ]
+            if method == "POST":
+                kernel_id = data["kernel"].get("id")
+                if kernel_id is not None and kernel_id not in self.kernels:
+                    return 404, {"message": f"Kernel does not exist: {kernel_id}"}
+                return 201, self.create_session(data)
+
+        match = re.fullmatch(r"/api/kernels/([^/]+)(/restart|/interrupt)?", path)
+        if match is None:
+            return 404, {"message": "Not found"}
+        kernel = self.kernels.get(match[1])
+        if kernel is None:
+            return 404, {"message": f"Kernel does not exist: {match[1]}"}
+
+        if match[2] is None and method == "DELETE":
+            if kernel.running is not None:
+                kernel.running.cancel()
+            del self.kernels[kernel.id]
+            return 204, None
+        if match[2] == "/interrupt" and method == "POST":
+            if kernel.running is not None:
+                kernel.running.cancel()
+            return 204, None
+        if match[2] == "/restart" and method == "POST":
+            if kernel.running is not None:
+                kernel.running.cancel()
+            return 200, kernel.model()
+        return 405, {"message": "Method not allowed"}
+
+    def start_kernel(self, name: str) -> FakeKernel:
+        """Start a kernel
+
+        Args:
+            name (str): The kernel's language
+
+        Returns:
+            FakeKernel: The new kernel
+        """
+        kernel = FakeKernel(name)
+        self.kernels[kernel.id] = kernel
+        self.started += 1
+        return kernel
+
+    def create_session(self, data: dict[str, Any]) -> dict[str, Any]:
+        """Create a session, or get the existing session at the same path
+
+        Args:
+            data (dict[str, Any]): The requested session model
+
+        Returns:
+            dict[str, Any]: The session model
+        """
+        session = self.sessions.get(data["path"])
+        if session is not None and session["kernel"]["id"] in self.kernels:
+            return session
+
+        kernel_id = data["kernel"].get("id")
+        if kernel_id is None:
+            kernel_id = self.start_kernel(data["kernel"]["name"]).id
+        session = {
+            "id": str(uuid.uuid4()),
+            "path": data["path"],
+            "name": data.get("name"),
+            "type": data.get("type"),
+            "kernel": {"id": kernel_id},
+        }
+        self.sessions[data["path"]] = session
+        return session
+
+    async def channels(
+        self, scope: dict[str, Any], receive: Receive, send: Send
+    ) -> None:
+        """Serve the kernel channels websocket
+
+        Args:
+            scope (dict[str, Any]): The ASGI connection scope
+            receive (Receive): ASGI receive callable
+            send (Send): ASGI send callable
+        """
+        match = re.fullmatch(r"/api/kernels/([^/]+)/channels", scope["path"])
+        kernel = self.kernels.get(match[1]) if match else None
+        await receive()  # websocket.connect
+        if kernel is None:
+            if "websocket.http.response" in scope.get("extensions", {}):
+                await send(
+                    {
+                        "type": "websocket.http.response.start",
+                        "status": 404,
+                        "headers": [],
+                    }
+                )
+                await send({"type": "websocket.http.response.body", "body": b""})
+            else:
+                await send({"type": "websocket.close", "code": 1008})
+            return
+
+        await send({"type": "websocket.accept"})
+        kernel.connections += 1
+        send_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                request = json.loads(message.get("text") or message["bytes"])
+                kernel.received += 1
+                task = asyncio.create_task(
+                    self.execute(kernel, request, kernel.received, send, send_lock)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            kernel.connections -= 1
+            for task in tasks:
+                task.cancel()
+
+    async def execute(
+        self,
+        kernel: FakeKernel,
+        request: dict[str, Any],
+        number: int,
+        send: Send,
+        send_lock: asyncio.Lock,
+    ) -> None:
+        """Run one execute request on a kernel, sending its reply messages
+
+        Args:
+            kernel (FakeKernel): The kernel the request was sent to
+            request (dict[str, Any]): The execute request
+            number (int): The order the kernel received the request in
+            send (Send): ASGI send callable of the websocket
+            send_lock (asyncio.Lock): Serializes sends on the websocket
+        """
+        parent = request["header"]
+        code = request["content"]["code"]
+
+        async def reply(msg_type: str, content: dict[str, Any]) -> None:
+            kernel.last_activity = datetime.now(timezone.utc)
+            message = {
+                "header": {"msg_id": uuid.uuid4().hex, "msg_type": msg_type},
+                "parent_header": parent,
+                "msg_type": msg_type,
+                "content": content,
+                "channel": "shell" if msg_type == "execute_reply" else "iopub",
+            }
+            async with send_lock:
+                await send({"type": "websocket.send", "text": json.dumps(message)})
+
+        async with kernel.lock:
+            if number <= kernel.abort_until:
+                await reply("execute_reply", {"status": "aborted"})
+                return
+            kernel.execution_state = "busy"
+            await reply("status", {"execution_state": "busy"})
+            kernel.running = asyncio.current_task()
+            try:
+                status = await self.run(kernel, code, reply)
+            except asyncio.CancelledError:
+                if kernel.id not in self.kernels:
+                    raise
+                # Interrupted or restarted
+                status = "error"
+                await reply(
+                    "error",
+                    {"ename": "KeyboardInterrupt", "evalue": "", "traceback": []},
+                )
+            finally:
+                kernel.running = None
+                kernel.execution_state = "idle"
+            if status == "error" and request["content"].get("stop_on_error", True):
+                kernel.abort_until = kernel.received
+            await reply("execute_reply", {"status": status})
+            await reply("status", {"execution_state": "idle"})
+
+    async def run(
+        self,
+        kernel: FakeKernel,
+        code: str,
+        reply: Callable[[str, dict[str, Any]], Awaitable[None]],
+    ) -> str:
+        """Send the output messages of running code
+
+        Args:
+            kernel (FakeKernel): The kernel running the code
+            code (str): The code
+            reply (Callable[[str, dict[str, Any]], Awaitable[None]]): Sends a
+                message in reply to the request
+
+        Returns:
+            str: The status of the execution
+        """
+        if code.startswith("raise"):
+            await asyncio.sleep(self.latency)
+            await reply("stream", {"name": "stderr", "text": f"Error: {code}\n"})
+            await reply(
+                "error", {"ename": "Error", "evalue": code, "traceback": [code]}
+            )
+            return "error"
+
+        for _ in range(self.output_messages):
+            await asyncio.sleep(self.latency)
+            text = code + "x" * max(self.output_size - len(code), 0)
+            await reply("stream", {"name": "stdout", "text": text})
+        return "ok"
+
+
+def serve(
+    app: FakeJupyterServer, host: str = "127.0.0.1", port: int = 0
+) -> tuple[uvicorn.Server, int]:
+    """Serve the fake Jupyter server from a background thread
+
+    Args:
+        app (FakeJupyterServer): The server
+        host (str): Interface to listen on
+        port (int): Port to listen on, or 0 for any free port
+
+    Returns:
+        tuple[uvicorn.Server, int]: The running server, which stops when its
+            should_exit is set, and the port it listens on
+    """
+    server = uvicorn.Server(
+        uvicorn.Config(app, host=host, port=port, log_level="warning", lifespan="off")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("The fake Jupyter server failed to start")
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, port
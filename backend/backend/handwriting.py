@@ -0,0 +1,975 @@
+from typing import Any, Callable
+
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import httpx
+import requests
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache
+from requests.adapters import HTTPAdapter
+
+
+class HandwritingError(Exception):
+    """Raised when the handwriting server cannot transcribe an image
+
+    Attributes:
+        retryable (bool): Whether the request may succeed if sent again
+        retry_after (float | None): Seconds the client should wait before trying
+            again, if known
+        client_error (bool): Whether the server rejected the request itself (a
+            4xx response), which says nothing about the server's health
+    """
+
+    def __init__(
+        self,
+        message: str,
+        retryable: bool = False,
+        retry_after: float | None = None,
+        client_error: bool = False,
+    ) -> None:
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.client_error = client_error
+
+
+class CircuitOpen(HandwritingError):
+    """Raised without contacting the handwriting server while it is unhealthy"""
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__("Handwriting server is unavailable", retry_after=retry_after)
+
+
+class QueueFull(HandwritingError):
+    """Raised when too many transcriptions are already waiting for the handwriting server"""
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__("Too many transcriptions are queued", retry_after=retry_after)
+
+
+class CircuitBreaker:
+    """Fails calls fast once a service has failed too many times in a row
+
+    After settings.HANDWRITING_BREAKER_THRESHOLD consecutive failures the circuit
+    opens and calls raise CircuitOpen for settings.HANDWRITING_BREAKER_RESET
+    seconds. Then a single trial call is let through: success closes the circuit,
+    failure opens it again.
+
+    Attributes:
+        failures (int): Consecutive failed calls
+        _opened_until (float): Monotonic time until which calls fail fast
+        _lock (threading.Lock): Guards the breaker's state
+    """
+
+    def __init__(self) -> None:
+        self.failures = 0
+        self._opened_until = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        """Check that a call may be made
+
+        Raises:
+            CircuitOpen: If the circuit is open
+        """
+        with self._lock:
+            if self.failures < settings.HANDWRITING_BREAKER_THRESHOLD:
+                return
+            now = time.monotonic()
+            if now < self._opened_until:
+                raise CircuitOpen(self._opened_until - now)
+            # Let this call through as a trial and fail the others fast until it ends
+            self._opened_until = now + settings.HANDWRITING_BREAKER_RESET
+
+    def record_success(self) -> None:
+        """Close the circuit after a successful call"""
+        with self._lock:
+            self.failures = 0
+            self._opened_until = 0.0
+
+    def record_failure(self) -> None:
+        """Count a failed call, opening the circuit if there have been too many"""
+        with self._lock:
+            self.failures += 1
+            if self.failures >= settings.HANDWRITING_BREAKER_THRESHOLD:
+                self._opened_until = (
+                    time.monotonic() + settings.HANDWRITING_BREAKER_RESET
+                )
+
+
+def backoff(attempt: int) -> float:
+    """Get the seconds to wait before retrying a failed request
+
+    Uses exponential backoff with full jitter, so retries from many workers do
+    not arrive at the handwriting server together.
+
+    Args:
+        attempt (int): Number of attempts made so far
+
+    Returns:
+        float: The delay
+    """
+    return random.uniform(0, settings.HANDWRITING_RETRY_BACKOFF * 2 ** (attempt - 1))
+
+
+def check_response(status_code: int, body: bytes) -> dict[str, Any]:
+    """Get the predictions from a response of the handwriting server
+
+    Args:
+        status_code (int): HTTP status of the response
+        body (bytes): Body of the response
+
+    Raises:
+        HandwritingError: If the response is an error or malformed. Gateway errors
+            are retryable, as the request did not reach a healthy model, and 4xx
+            responses are client errors.
+
+    Returns:
+        dict[str, Any]: The handwriting server's predictions
+    """
+    if status_code >= 400:
+        raise HandwritingError(
+            f"Handwriting server responded with {status_code}",
+            retryable=status_code in (502, 503, 504),
+            client_error=status_code < 500,
+        )
+    try:
+        predictions = json.loads(body)
+    except ValueError:
+        predictions = None
+    if not isinstance(predictions, dict) or not all(
+        isinstance(predictions.get(field), list) for field in ("top_preds", "top_probs")
+    ):
+        raise HandwritingError("Handwriting server sent an invalid response")
+    return predictions
+
+
+def translate_files(image: bytes, model_name: str | None) -> dict[str, Any]:
+    """Get the multipart files of a /translate request
+
+    Args:
+        image (bytes): The preprocessed image
+        model_name (str | None): The handwriting model to use
+
+    Returns:
+        dict[str, Any]: The files
+    """
+    return {
+        "image": ("image", image),
+        "json": ("json", json.dumps({"model": model_name})),
+    }
+
+
+class Replica:
+    """A handwriting server replica
+
+    Attributes:
+        url (str): HTTP URL of the replica
+        healthy (bool): Whether the replica answered its last request or health check
+        outstanding (int): Requests sent to the replica and not yet answered
+        models (set[str | None]): Models the replica has transcribed with, so has
+            loaded
+    """
+
+    def __init__(self, address: str) -> None:
+        self.url = f"http://{address}"
+        self.healthy = True
+        self.outstanding = 0
+        self.models: set[str | None] = set()
+
+
+class HandwritingRouter:
+    """Balances transcriptions across the handwriting server replicas
+
+    Each transcription goes to the healthy replica with the fewest outstanding
+    requests, where a replica that has not yet used the requested model counts
+    settings.HANDWRITING_MODEL_LOAD_PENALTY more, as it would have to load it.
+    Replicas are marked down when a request to them fails and checked every
+    settings.HANDWRITING_HEALTH_INTERVAL seconds.
+
+    Attributes:
+        replicas (list[Replica]): The replicas
+        _lock (threading.Lock): Guards the replicas' state
+        _thread (threading.Thread | None): The health check thread, once started
+    """
+
+    def __init__(self, addresses: list[str]) -> None:
+        self.replicas = [Replica(address) for address in addresses]
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def acquire(self, model_name: str | None, exclude: set[Replica]) -> Replica | None:
+        """Choose a replica to send a transcription to
+
+        Args:
+            model_name (str | None): The model the transcription uses
+            exclude (set[Replica]): Replicas the transcription has already failed on
+
+        Returns:
+            Replica | None: The replica, which must be released, or None if every
+                replica is excluded
+        """
+        with self._lock:
+            candidates = [
+                replica for replica in self.replicas if replica not in exclude
+            ]
+            # If every replica is down, keep trying them rather than failing outright
+            candidates = [replica for replica in candidates if replica.healthy] or (
+                candidates
+            )
+            if not candidates:
+                return None
+
+            def load(replica: Replica) -> int:
+                if model_name in replica.models:
+                    return replica.outstanding
+                return replica.outstanding + settings.HANDWRITING_MODEL_LOAD_PENALTY
+
+            least = min(map(load, candidates))
+            replica = random.choice(
+                [replica for replica in candidates if load(replica) == least]
+            )
+            replica.outstanding += 1
+            return replica
+
+    def release(
+        self, replica: Replica, model_name: str | None, transcribed: bool
+    ) -> None:
+        """Finish a request to a replica
+
+        Args:
+            replica (Replica): The replica from acquire
+            model_name (str | None): The model the request used
+            transcribed (bool): Whether the replica transcribed the image, so is
+                healthy and has the model loaded
+        """
+        with self._lock:
+            replica.outstanding -= 1
+            if transcribed:
+                replica.healthy = True
+                replica.models.add(model_name)
+
+    def mark_down(self, replica: Replica) -> None:
+        """Stop sending transcriptions to a replica until it is healthy again
+
+        Args:
+            replica (Replica): The replica that failed
+        """
+        with self._lock:
+            replica.healthy = False
+
+    def check_health(self) -> None:
+        """Check whether each replica answers HTTP requests"""
+        for replica in self.replicas:
+            try:
+                response = requests.get(
+                    replica.url + settings.HANDWRITING_HEALTH_PATH,
+                    timeout=settings.HANDWRITING_HEALTH_TIMEOUT,
+                )
+                healthy = response.status_code < 500
+            except requests.RequestException:
+                healthy = False
+            with self._lock:
+                replica.healthy = healthy
+
+    def start(self) -> None:
+        """Check the replicas' health in the background, if enabled"""
+        with self._lock:
+            if self._thread is not None or not settings.HANDWRITING_HEALTH_INTERVAL:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="handwriting-health", daemon=True
+            )
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(settings.HANDWRITING_HEALTH_INTERVAL)
+            self.check_health()
+
+
+class HandwritingClient:
+    """Client for the handwriting server replicas sharing one keep-alive connection pool
+
+    Transcription has no side effects, so requests that fail to connect or get a
+    gateway error are sent to another replica straight away, and once every replica
+    has failed, retried with backoff. Read timeouts are not retried, as that would
+    pile more work onto an overloaded model. Every failed transcription counts
+    towards the circuit breaker.
+
+    The client is shared by every request and queued job of the process, and sends
+    at most `concurrency` transcriptions at once between them, however many
+    threads they fan out over.
+
+    Attributes:
+        router (HandwritingRouter): Chooses the replica for each request
+        breaker (CircuitBreaker): Fails requests fast while the server is unhealthy
+        timeout (tuple[float, float]): Connect and read timeouts in seconds
+        session (requests.Session): Session pooling connections to the replicas
+        slots (threading.BoundedSemaphore): Held by each transcription in flight
+    """
+
+    def __init__(
+        self,
+        router: HandwritingRouter,
+        breaker: CircuitBreaker,
+        timeout: tuple[float, float],
+        pool_size: int,
+        concurrency: int,
+    ) -> None:
+        self.router = router
+        self.breaker = breaker
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.session = requests.Session()
+        self.session.mount(
+            "http://",
+            HTTPAdapter(
+                pool_connections=max(len(router.replicas), 1), pool_maxsize=pool_size
+            ),
+        )
+
+    def transcribe(self, image: bytes, model_name: str | None) -> dict[str, Any]:
+        """Transcribe a preprocessed image
+
+        Args:
+            image (bytes): The preprocessed image
+            model_name (str | None): The handwriting model to use
+
+        Raises:
+            CircuitOpen: If the handwriting server is unhealthy
+            HandwritingError: If the image could not be transcribed
+
+        Returns:
+            dict[str, Any]: The handwriting server's predictions
+        """
+        self.breaker.before_call()
+        with self.slots:
+            return self._transcribe(image, model_name)
+
+    def _transcribe(self, image: bytes, model_name: str | None) -> dict[str, Any]:
+        attempt = 0
+        failed: set[Replica] = set()
+        error: HandwritingError | None = None
+        while True:
+            replica = self.router.acquire(model_name, failed)
+            if replica is None:
+                # Every replica has failed, so back off before trying them again
+                attempt += 1
+                if attempt > settings.HANDWRITING_RETRIES:
+                    self.breaker.record_failure()
+                    if error is None:
+                        raise HandwritingError(
+                            "No handwriting server replicas available", retryable=True
+                        )
+                    raise error
+                time.sleep(backoff(attempt))
+                failed.clear()
+                continue
+
+            try:
+                predictions = self._post(replica, image, model_name)
+            except HandwritingError as e:
+                self.router.release(replica, model_name, transcribed=False)
+                if not e.retryable:
+                    # A rejected request, e.g. for an unknown model, must not
+                    # lock every user out of transcription
+                    if not e.client_error:
+                        self.breaker.record_failure()
+                    raise
+                self.router.mark_down(replica)
+                failed.add(replica)
+                error = e
+            else:
+                self.router.release(replica, model_name, transcribed=True)
+                self.breaker.record_success()
+                return predictions
+
+    def _post(
+        self, replica: Replica, image: bytes, model_name: str | None
+    ) -> dict[str, Any]:
+        try:
+            response = self.session.post(
+                replica.url + "/translate",
+                files=translate_files(image, model_name),
+                timeout=self.timeout,
+            )
+        except requests.ConnectionError as e:
+            raise HandwritingError(
+                "Could not connect to handwriting server", retryable=True
+            ) from e
+        except requests.RequestException as e:
+            raise HandwritingError("Handwriting server timed out") from e
+        return check_response(response.status_code, response.content)
+
+
+class AsyncHandwritingClient:
+    """Asynchronous version of HandwritingClient
+
+    Attributes:
+        router (HandwritingRouter): Shared with the synchronous client
+        breaker (CircuitBreaker): Shared with the synchronous client
+        client (httpx.AsyncClient): Client pooling connections to the replicas
+        slots (asyncio.Semaphore): Held by each transcription in flight on the
+            client's event loop
+    """
+
+    def __init__(
+        self,
+        router: HandwritingRouter,
+        breaker: CircuitBreaker,
+        timeout: tuple[float, float],
+        pool_size: int,
+        concurrency: int,
+    ) -> None:
+        self.router = router
+        self.breaker = breaker
+        self.slots = asyncio.Semaphore(concurrency)
+        connect, read = timeout
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read, connect=connect),
+            limits=httpx.Limits(max_keepalive_connections=pool_size),
+        )
+
+    async def transcribe(self, image: bytes, model_name: str | None) -> dict[str, Any]:
+        """Asynchronous version of HandwritingClient.transcribe
+
+        Args:
+            image (bytes): The preprocessed image
+            model_name (str | None): The handwriting model to use
+
+        Raises:
+            CircuitOpen: If the handwriting server is unhealthy
+            HandwritingError: If the image could not be transcribed
+
+        Returns:
+            dict[str, Any]: The handwriting server's predictions
+        """
+        self.breaker.before_call()
+        async with self.slots:
+            return await self._transcribe(image, model_name)
+
+    async def _transcribe(self, image: bytes, model_name: str | None) -> dict[str, Any]:
+        attempt = 0
+        failed: set[Replica] = set()
+        error: HandwritingError | None = None
+        while True:
+            replica = self.router.acquire(model_name, failed)
+            if replica is None:
+                attempt += 1
+                if attempt > settings.HANDWRITING_RETRIES:
+                    self.breaker.record_failure()
+                    if error is None:
+                        raise HandwritingError(
+                            "No handwriting server replicas available", retryable=True
+                        )
+                    raise error
+                await asyncio.sleep(backoff(attempt))
+                failed.clear()
+                continue
+
+            try:
+                predictions = await self._post(replica, image, model_name)
+            except HandwritingError as e:
+                self.router.release(replica, model_name, transcribed=False)
+                if not e.retryable:
+                    # A rejected request, e.g. for an unknown model, must not
+                    # lock every user out of transcription
+                    if not e.client_error:
+                        self.breaker.record_failure()
+                    raise
+                self.router.mark_down(replica)
+                failed.add(replica)
+                error = e
+            else:
+                self.router.release(replica, model_name, transcribed=True)
+                self.breaker.record_success()
+                return predictions
+
+    async def _post(
+        self, replica: Replica, image: bytes, model_name: str | None
+    ) -> dict[str, Any]:
+        try:
+            response = await self.client.post(
+                replica.url + "/translate", files=translate_files(image, model_name)
+            )
+        except httpx.ConnectError as e:
+            raise HandwritingError(
+                "Could not connect to handwriting server", retryable=True
+            ) from e
+        except httpx.HTTPError as e:
+            raise HandwritingError("Handwriting server timed out") from e
+        return check_response(response.status_code, response.content)
+
+
+_breaker = CircuitBreaker()
+_router: HandwritingRouter | None = None
+_client: HandwritingClient | None = None
+_client_lock = threading.Lock()
+_line_executor: ThreadPoolExecutor | None = None
+# httpx clients belong to the event loop that created them
+_async_clients: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, AsyncHandwritingClient
+] = weakref.WeakKeyDictionary()
+
+
+def get_router() -> HandwritingRouter:
+    """Get the router shared by every handwriting server client
+
+    Checking the replicas' health starts with the first call.
+
+    Returns:
+        HandwritingRouter: The shared router
+    """
+    global _router
+    with _client_lock:
+        if _router is None:
+            _router = HandwritingRouter(settings.HANDWRITING_REPLICAS)
+    _router.start()
+    return _router
+
+
+def _client_options() -> dict[str, Any]:
+    return {
+        "router": get_router(),
+        "breaker": _breaker,
+        "timeout": (
+            settings.HANDWRITING_CONNECT_TIMEOUT,
+            settings.HANDWRITING_READ_TIMEOUT,
+        ),
+        "pool_size": settings.HANDWRITING_POOL_SIZE,
+        "concurrency": settings.HANDWRITING_CONCURRENCY,
+    }
+
+
+def get_handwriting_client() -> HandwritingClient:
+    """Get the process-wide handwriting server client
+
+    Returns:
+        HandwritingClient: The shared client
+    """
+    global _client
+    if _client is None:
+        options = _client_options()
+        with _client_lock:
+            if _client is None:
+                _client = HandwritingClient(**options)
+    return _client
+
+
+def get_async_handwriting_client() -> AsyncHandwritingClient:
+    """Get the handwriting server client for the running event loop
+
+    Returns:
+        AsyncHandwritingClient: The loop's shared client
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        _async_clients[loop] = AsyncHandwritingClient(**_client_options())
+    return _async_clients[loop]
+
+
+def get_line_executor() -> ThreadPoolExecutor:
+    """Get the process-wide pool that sends the lines of code blocks to the
+    handwriting server
+
+    It has settings.HANDWRITING_CONCURRENCY threads, as many as the handwriting
+    client lets through at once, however many requests and jobs are
+    transcribing blocks.
+
+    Returns:
+        ThreadPoolExecutor: The shared pool
+    """
+    global _line_executor
+    if _line_executor is None:
+        with _client_lock:
+            if _line_executor is None:
+                _line_executor = ThreadPoolExecutor(
+                    settings.HANDWRITING_CONCURRENCY, thread_name_prefix="handwriting"
+                )
+    return _line_executor
+
+
+def get_circuit_breaker() -> CircuitBreaker:
+    """Get the circuit breaker shared by every handwriting server client
+
+    Returns:
+        CircuitBreaker: The shared breaker
+    """
+    return _breaker
+
+
+class TranscriptionCache:
+    """Cache of handwriting server predictions keyed by preprocessed image and model
+
+    Lookups check a bounded in-process LRU first, then the Django cache named by
+    settings.TRANSCRIPTION_CACHE_ALIAS if one is configured, which worker processes
+    share. A shared hit is copied into the LRU.
+
+    Attributes:
+        hits (int): Lookups answered by the in-process LRU
+        shared_hits (int): Lookups answered by the shared Django cache
+        misses (int): Lookups that needed the handwriting server
+        _transcriptions (OrderedDict[str, dict[str, Any]]): Cached transcriptions,
+            least recently used first
+        _lock (threading.Lock): Guards _transcriptions and the counters
+    """
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._transcriptions: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(image: bytes, model_name: str | None) -> str:
+        """Get the cache key for transcribing an image with a model
+
+        Args:
+            image (bytes): The preprocessed image
+            model_name (str | None): The handwriting model
+
+        Returns:
+            str: The cache key
+        """
+        return f"predictions:{model_name}:{hashlib.sha256(image).hexdigest()}"
+
+    def get(self, key: str) -> dict[str, Any] | None:
+        """Get a cached transcription
+
+        Args:
+            key (str): Key from TranscriptionCache.key
+
+        Returns:
+            dict[str, Any] | None: The transcription, or None on a miss
+        """
+        transcription = self._get_local(key)
+        if transcription is None and self._shared() is not None:
+            transcription = self._shared().get(key)
+            self._count_shared(key, transcription)
+        return transcription
+
+    async def aget(self, key: str) -> dict[str, Any] | None:
+        """Asynchronous version of TranscriptionCache.get
+
+        Args:
+            key (str): Key from TranscriptionCache.key
+
+        Returns:
+            dict[str, Any] | None: The transcription, or None on a miss
+        """
+        transcription = self._get_local(key)
+        if transcription is None and self._shared() is not None:
+            transcription = await self._shared().aget(key)
+            self._count_shared(key, transcription)
+        return transcription
+
+    def set(self, key: str, transcription: dict[str, Any]) -> None:
+        """Cache a transcription
+
+        Args:
+            key (str): Key from TranscriptionCache.key
+            transcription (dict[str, Any]): The transcription
+        """
+        self._set_local(key, transcription)
+        if self._shared() is not None:
+            self._shared().set(key, transcription, settings.TRANSCRIPTION_CACHE_TIMEOUT)
+
+    async def aset(self, key: str, transcription: dict[str, Any]) -> None:
+        """Asynchronous version of TranscriptionCache.set
+
+        Args:
+            key (str): Key from TranscriptionCache.key
+            transcription (dict[str, Any]): The transcription
+        """
+        self._set_local(key, transcription)
+        if self._shared() is not None:
+            await self._shared().aset(
+                key, transcription, settings.TRANSCRIPTION_CACHE_TIMEOUT
+            )
+
+    def stats(self) -> dict[str, int]:
+        """Get the hit and miss counters
+
+        Returns:
+            dict[str, int]: The counters and the number of locally cached entries
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "size": len(self._transcriptions),
+            }
+
+    def clear(self) -> None:
+        """Forget every locally cached transcription and reset the counters"""
+        with self._lock:
+            self._transcriptions.clear()
+            self.hits = self.shared_hits = self.misses = 0
+
+    def _shared(self) -> BaseCache | None:
+        alias = settings.TRANSCRIPTION_CACHE_ALIAS
+        return caches[alias] if alias else None
+
+    def _get_local(self, key: str) -> dict[str, Any] | None:
+        with self._lock:
+            transcription = self._transcriptions.get(key)
+            if transcription is not None:
+                self._transcriptions.move_to_end(key)
+                self.hits += 1
+            elif self._shared() is None:
+                self.misses += 1
+            return transcription
+
+    def _count_shared(self, key: str, transcription: dict[str, Any] | None) -> None:
+        if transcription is None:
+            with self._lock:
+                self.misses += 1
+            return
+        with self._lock:
+            self.shared_hits += 1
+        self._set_local(key, transcription)
+
+    def _set_local(self, key: str, transcription: dict[str, Any]) -> None:
+        with self._lock:
+            self._transcriptions[key] = transcription
+            self._transcriptions.move_to_end(key)
+            while len(self._transcriptions) > settings.TRANSCRIPTION_CACHE_SIZE:
+                self._transcriptions.popitem(last=False)
+
+
+_transcription_cache = TranscriptionCache()
+
+
+def get_transcription_cache() -> TranscriptionCache:
+    """Get the process-wide transcription cache
+
+    Returns:
+        TranscriptionCache: The shared cache
+    """
+    return _transcription_cache
+
+
+class TranscriptionQueue:
+    """Queue of transcription jobs run by a bounded pool of worker threads
+
+    At most settings.TRANSCRIPTION_WORKERS jobs run at once, and at most
+    settings.TRANSCRIPTION_QUEUE_SIZE more wait for a worker. The load the jobs put
+    on the handwriting server is capped by the process-wide HandwritingClient, which
+    they share with every request, at settings.HANDWRITING_CONCURRENCY
+    transcriptions at once. Beyond that, jobs are refused with QueueFull rather than piling up.
+    The state of each job is kept in the Django cache named by
+    settings.TRANSCRIPTION_JOB_CACHE_ALIAS, so with a shared cache any worker process
+    can report on a job.
+
+    Code blocks can also be transcribed speculatively, before they are run: each
+    user has at most one speculative job per code block, and a newer one supersedes
+    it. When the block is run with the same ink, the speculative job is claimed in
+    place of queueing another.
+
+    Attributes:
+        average_duration (float): Moving average of the seconds a job takes to run
+        _outstanding (int): Jobs queued or running in this process
+        _executor (ThreadPoolExecutor | None): Runs the jobs, started by the first one
+        _futures (dict[str, Future]): The jobs of this process yet to finish
+        _lock (threading.Lock): Guards the attributes above
+    """
+
+    def __init__(self) -> None:
+        self.average_duration = 1.0
+        self._outstanding = 0
+        self._executor: ThreadPoolExecutor | None = None
+        self._futures: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, user_id: Any, transcribe: Callable[[], dict[str, Any]]) -> str:
+        """Queue a transcription
+
+        Args:
+            user_id (Any): The user the job belongs to
+            transcribe (Callable[[], dict[str, Any]]): Transcribes the image, raising
+                HandwritingError if the handwriting server fails
+
+        Raises:
+            QueueFull: If the queue is full, with the time it should take to drain
+
+        Returns:
+            str: The job's ID
+        """
+        workers = settings.TRANSCRIPTION_WORKERS
+        with self._lock:
+            if self._outstanding >= workers + settings.TRANSCRIPTION_QUEUE_SIZE:
+                raise QueueFull(
+                    self.average_duration * settings.TRANSCRIPTION_QUEUE_SIZE / workers
+                )
+            self._outstanding += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    workers, thread_name_prefix="transcription"
+                )
+
+        job_id = uuid.uuid4().hex
+        self._save(job_id, {"user": user_id, "status": "queued"})
+        future = self._executor.submit(self._run, job_id, user_id, transcribe)
+        with self._lock:
+            self._futures[job_id] = future
+        # Called straight away if the job has already finished
+        future.add_done_callback(lambda _: self._futures.pop(job_id, None))
+        return job_id
+
+    def cancel(self, job_id: str, user_id: Any) -> bool:
+        """Cancel a job that has not started running
+
+        Args:
+            job_id (str): The job's ID
+            user_id (Any): The user the job belongs to
+
+        Returns:
+            bool: Whether the job was cancelled, which it cannot be once running or
+                if it was queued by another process
+        """
+        with self._lock:
+            future = self._futures.get(job_id)
+        if future is None or not future.cancel():
+            return False
+        with self._lock:
+            self._outstanding -= 1
+        self._save(job_id, {"user": user_id, "status": "cancelled"})
+        return True
+
+    def speculate(
+        self,
+        user_id: Any,
+        block_id: str,
+        ink: str,
+        transcribe: Callable[[], dict[str, Any]],
+    ) -> str:
+        """Queue a transcription of a code block before it is run
+
+        The block's last speculative job is kept if it was for the same ink, and
+        otherwise cancelled if it has not started.
+
+        Args:
+            user_id (Any): The user the job belongs to
+            block_id (str): The ID of the code block
+            ink (str): Digest of the block's ink and how it is transcribed
+            transcribe (Callable[[], dict[str, Any]]): Transcribes the image, raising
+                HandwritingError if the handwriting server fails
+
+        Raises:
+            QueueFull: If the queue is full, with the time it should take to drain
+
+        Returns:
+            str: The job's ID
+        """
+        key = self._speculation_key(user_id, block_id)
+        previous = self._jobs().get(key)
+        if previous is not None:
+            if previous["ink"] == ink and self._usable(previous["job_id"], user_id):
+                return previous["job_id"]
+            self.cancel(previous["job_id"], user_id)
+
+        job_id = self.submit(user_id, transcribe)
+        self._jobs().set(
+            key, {"ink": ink, "job_id": job_id}, settings.TRANSCRIPTION_JOB_TIMEOUT
+        )
+        return job_id
+
+    def claim_speculation(self, user_id: Any, block_id: str, ink: str) -> str | None:
+        """Take the speculative job of a code block that is being run
+
+        Once claimed, the job is no longer superseded by later speculation.
+
+        Args:
+            user_id (Any): The user running the block
+            block_id (str): The ID of the code block
+            ink (str): Digest of the block's ink and how it is transcribed
+
+        Returns:
+            str | None: The ID of the block's speculative job, or None if there is
+                none for the same ink that has not failed
+        """
+        key = self._speculation_key(user_id, block_id)
+        speculation = self._jobs().get(key)
+        if speculation is None or speculation["ink"] != ink:
+            return None
+        self._jobs().delete(key)
+        if not self._usable(speculation["job_id"], user_id):
+            return None
+        return speculation["job_id"]
+
+    def get(self, job_id: str, user_id: Any) -> dict[str, Any] | None:
+        """Get the state of a job
+
+        Args:
+            job_id (str): The job's ID
+            user_id (Any): The user asking, who must own the job
+
+        Returns:
+            dict[str, Any] | None: The job's status ("queued", "running", "done",
+                "failed" or "cancelled") with its transcription once done or error
+                once failed, or None if the user has no such job
+        """
+        job = self._jobs().get(self._key(job_id))
+        if job is None or job["user"] != user_id:
+            return None
+        return {field: value for field, value in job.items() if field != "user"}
+
+    def _run(
+        self, job_id: str, user_id: Any, transcribe: Callable[[], dict[str, Any]]
+    ) -> None:
+        self._save(job_id, {"user": user_id, "status": "running"})
+        start = time.monotonic()
+        try:
+            job = {"status": "done", "transcription": transcribe()}
+        except HandwritingError as e:
+            job = {"status": "failed", "error": str(e)}
+        except Exception:
+            job = {"status": "failed", "error": "Transcription failed"}
+        finally:
+            with self._lock:
+                self._outstanding -= 1
+                self.average_duration += 0.2 * (
+                    time.monotonic() - start - self.average_duration
+                )
+        self._save(job_id, {"user": user_id, **job})
+
+    def _usable(self, job_id: str, user_id: Any) -> bool:
+        job = self.get(job_id, user_id)
+        return job is not None and job["status"] not in ("failed", "cancelled")
+
+    def _jobs(self) -> BaseCache:
+        return caches[settings.TRANSCRIPTION_JOB_CACHE_ALIAS]
+
+    def _key(self, job_id: str) -> str:
+        return f"transcription-job:{job_id}"
+
+    def _speculation_key(self, user_id: Any, block_id: str) -> str:
+        return f"transcription-speculation:{user_id}:{block_id}"
+
+    def _save(self, job_id: str, job: dict[str, Any]) -> None:
+        self._jobs().set(self._key(job_id), job, settings.TRANSCRIPTION_JOB_TIMEOUT)
+
+
+_transcription_queue = TranscriptionQueue()
+
+
+def get_transcription_queue() -> TranscriptionQueue:
+    """Get the process-wide transcription job queue
+
+    Returns:
+        TranscriptionQueue: The shared queue
+    """
+    return _transcription_queue
@@ -0,0 +1,1455 @@
+from typing import Any, Generator, Hashable, Iterator
+
+import hashlib
+import json
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from websocket import (
+    WebSocket,
+    WebSocketBadStatusException,
+    WebSocketException,
+    create_connection,
+)
+
+from backend.utils import OutputLimiter, send_execute_request, translate_output
+
+
+class JupyterError(Exception):
+    """Raised when the Jupyter server cannot be reached or rejects a request"""
+
+
+class KernelNotFound(JupyterError):
+    """Raised when a kernel no longer exists on the Jupyter server"""
+
+
+class ExecutionTimeout(JupyterError):
+    """Raised when a kernel does not send a message in time"""
+
+
+def execution_deadline(language: str) -> float:
+    """Get the number of seconds code in a language may run before it is interrupted
+
+    Args:
+        language (str): Kernel name
+
+    Returns:
+        float: The deadline, in seconds
+    """
+    return settings.EXECUTION_DEADLINES.get(
+        language, max(settings.EXECUTION_DEADLINES.values())
+    )
+
+
+def timeout_output(message: str) -> dict[str, Any]:
+    """Build the output item telling the user their code ran out of time
+
+    Args:
+        message (str): What happened
+
+    Returns:
+        dict[str, Any]: The output item
+    """
+    return {"success": False, "type": "text", "content": f"\n{message}\n"}
+
+
+def batch_waves(
+    blocks: list[dict[str, str]], stop_on_error: bool
+) -> list[list[dict[str, str]]]:
+    """Split code blocks into groups whose execute requests are sent together
+
+    Without stop_on_error every block is sent at once, so blocks in different
+    languages run in parallel. With it, each run of consecutive blocks in one
+    language is sent together, relying on the kernel to abort the rest of the run
+    if a block fails, and the next run is only sent once the previous one succeeds.
+
+    Args:
+        blocks (list[dict[str, str]]): Code blocks with id, language and code fields
+        stop_on_error (bool): Whether to stop at the first block that fails
+
+    Returns:
+        list[list[dict[str, str]]]: The groups, in order
+    """
+    if not stop_on_error:
+        return [blocks] if blocks else []
+
+    waves: list[list[dict[str, str]]] = []
+    for block in blocks:
+        if waves and waves[-1][-1]["language"] == block["language"]:
+            waves[-1].append(block)
+        else:
+            waves.append([block])
+    return waves
+
+
+def jupyter_error_output() -> dict[str, Any]:
+    """Build the output item telling the user the Jupyter server failed
+
+    Returns:
+        dict[str, Any]: The output item
+    """
+    return {"success": False, "type": "text", "content": "Jupyter Server Error"}
+
+
+def session_path(user: Hashable, language: str) -> str:
+    """Get the Jupyter session path that identifies a user's kernel in a language
+
+    Args:
+        user (Hashable): Key identifying the user
+        language (str): Kernel name
+
+    Returns:
+        str: The session path
+    """
+    return f"enscribe/{user}/{language}"
+
+
+def session_model(
+    user: Hashable, language: str, kernel_id: str | None = None
+) -> dict[str, Any]:
+    """Build the request body that creates a user's session in a language
+
+    Args:
+        user (Hashable): Key identifying the user
+        language (str): Kernel name
+        kernel_id (str | None): Existing kernel to bind, or None to start one
+
+    Returns:
+        dict[str, Any]: The session model
+    """
+    kernel = {"id": kernel_id} if kernel_id is not None else {"name": language}
+    return {
+        "path": session_path(user, language),
+        "name": language,
+        "type": "notebook",
+        "kernel": kernel,
+    }
+
+
+def session_kernel(
+    sessions: list[dict[str, Any]], user: Hashable, language: str
+) -> str | None:
+    """Find the kernel bound to a user's session in a language
+
+    Args:
+        sessions (list[dict[str, Any]]): The session models reported by the
+            Jupyter server
+        user (Hashable): Key identifying the user
+        language (str): Kernel name
+
+    Returns:
+        str | None: The kernel ID, or None if the user has no session
+    """
+    path = session_path(user, language)
+    for session in sessions:
+        if session["path"] == path:
+            return session["kernel"]["id"]
+    return None
+
+
+def forget_kernel(client: Any, kernel_id: str) -> None:
+    """Forget what the process keeps about a kernel that no longer exists
+
+    Args:
+        client (Any): The sync or async Jupyter client, whose kernel lookups,
+            reaper and result cache are shared
+        kernel_id (str): The kernel ID
+    """
+    client.kernels.invalidate(kernel_id)
+    client.reaper.forget(kernel_id)
+    client.results.forget(kernel_id)
+
+
+def message_waiters(
+    rsp: dict[str, Any], waiters: dict[str, Any], client: Any, kernel_id: str
+) -> list[Any]:
+    """Find the requests a message from a kernel's channel is for
+
+    Args:
+        rsp (dict[str, Any]): The message
+        waiters (dict[str, Any]): The channel's pending requests by message ID
+        client (Any): The sync or async Jupyter client, to forget the kernel if
+            it died
+        kernel_id (str): The kernel the channel talks to
+
+    Returns:
+        list[Any]: The requests to pass the message to
+    """
+    if (
+        rsp.get("msg_type") == "status"
+        and rsp["content"].get("execution_state") == "dead"
+    ):
+        # Kernel death is not a reply to any request, so tell everyone
+        forget_kernel(client, kernel_id)
+        return list(waiters.values())
+    msg_id = rsp.get("parent_header", {}).get("msg_id")
+    return [waiters[msg_id]] if msg_id in waiters else []
+
+
+class OutputReader:
+    """Turns the reply messages to one execute request into output items
+
+    Holds the rules Execution.outputs and async_jupyter.AsyncExecution.events
+    share: the kernel is interrupted once the language's deadline passes,
+    output beyond settings.EXECUTION_OUTPUT_LIMIT is dropped, and the reply
+    decides the status. The executions only wait for messages and interrupt.
+
+    Attributes:
+        language (str): The language the code was executed in
+        deadline (float): Seconds the code may run before it is interrupted
+        expires_at (float): When the deadline passes, in time.monotonic() seconds
+        limiter (OutputLimiter): Caps the output kept
+        interrupted (bool): Whether the kernel has been interrupted
+        outputs (list[dict[str, Any]]): Every output item produced so far
+        status (str | None): The status of the execution ("ok", "error",
+            "aborted", "timeout" or "dead"), or None until it finishes
+    """
+
+    def __init__(self, language: str) -> None:
+        self.language = language
+        self.deadline = execution_deadline(language)
+        self.expires_at = time.monotonic() + self.deadline
+        self.limiter = OutputLimiter(settings.EXECUTION_OUTPUT_LIMIT)
+        self.interrupted = False
+        self.outputs: list[dict[str, Any]] = []
+        self.status: str | None = None
+
+    def timeout(self) -> float:
+        """Get how long to wait for the next message
+
+        Returns:
+            float: Seconds until the deadline, or settings.EXECUTION_RECV_TIMEOUT
+                once the kernel has been interrupted
+        """
+        if self.interrupted:
+            return settings.EXECUTION_RECV_TIMEOUT
+        return max(self.expires_at - time.monotonic(), 0)
+
+    def read(self, rsp: dict[str, Any]) -> list[dict[str, Any]]:
+        """Handle a reply message
+
+        Args:
+            rsp (dict[str, Any]): The message
+
+        Returns:
+            list[dict[str, Any]]: The output items to send on
+        """
+        output = translate_output(self.language, rsp)
+        items = self.limiter.add(output) if output else []
+
+        msg_type = rsp["msg_type"]
+        if msg_type == "execute_reply":
+            if self.interrupted:
+                self.status = "timeout"
+            else:
+                self.status = rsp["content"].get("status", "ok")
+        elif msg_type == "status" and rsp["content"]["execution_state"] == "dead":
+            # The kernel died, so its reply will never arrive
+            self.status = "dead"
+        return self._emit(items)
+
+    def timed_out(self) -> list[dict[str, Any]]:
+        """Handle no message arriving within timeout()
+
+        The caller interrupts the kernel first unless it already has been.
+
+        Returns:
+            list[dict[str, Any]]: The output items to send on
+        """
+        if self.interrupted:
+            # The kernel ignored the interrupt, so stop waiting for it
+            self.status = "timeout"
+            return self._emit([timeout_output("Kernel is not responding")])
+        self.interrupted = True
+        return self._emit(
+            [timeout_output(f"Execution interrupted after {self.deadline:g} seconds")]
+        )
+
+    def failed(self) -> list[dict[str, Any]]:
+        """Handle losing the connection to the Jupyter server
+
+        Returns:
+            list[dict[str, Any]]: The output items to send on
+        """
+        self.status = "error"
+        return self._emit([jupyter_error_output()])
+
+    def _emit(self, items: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        self.outputs.extend(items)
+        return items
+
+
+class KernelCache:
+    """Thread-safe in-process map from (user, language) to a Jupyter kernel ID
+
+    Attributes:
+        _kernels (dict[tuple[Hashable, str], str]): Cached kernel IDs
+        _lock (threading.Lock): Guards _kernels across request threads
+    """
+
+    def __init__(self) -> None:
+        self._kernels: dict[tuple[Hashable, str], str] = {}
+        self._lock = threading.Lock()
+
+    def get(self, user: Hashable, language: str) -> str | None:
+        """Get the cached kernel ID for a user and language, if any
+
+        Args:
+            user (Hashable): Key identifying the user
+            language (str): Kernel name
+
+        Returns:
+            str | None: The cached kernel ID
+        """
+        with self._lock:
+            return self._kernels.get((user, language))
+
+    def set(self, user: Hashable, language: str, kernel_id: str) -> None:
+        """Cache the kernel ID for a user and language
+
+        Args:
+            user (Hashable): Key identifying the user
+            language (str): Kernel name
+            kernel_id (str): The kernel ID to cache
+        """
+        with self._lock:
+            self._kernels[(user, language)] = kernel_id
+
+    def invalidate(self, kernel_id: str) -> None:
+        """Forget every cache entry that points at the given kernel
+
+        Args:
+            kernel_id (str): The kernel ID to forget
+        """
+        with self._lock:
+            self._kernels = {
+                key: cached_id
+                for key, cached_id in self._kernels.items()
+                if cached_id != kernel_id
+            }
+
+    def clear(self) -> None:
+        """Forget every cached kernel"""
+        with self._lock:
+            self._kernels.clear()
+
+
+class ResultCache:
+    """Size-bounded LRU cache of execution outputs for deterministic languages
+
+    Only languages listed in settings.EXECUTION_CACHE_LANGUAGES are cached.
+    Entries are keyed by the kernel and its generation, which is bumped whenever
+    code reaches the kernel or the kernel restarts. Only re-running the cell
+    the kernel last ran is therefore answered from the cache, so a cell that
+    changes the kernel's state, e.g. reassigning a variable, always runs.
+
+    Attributes:
+        _results (OrderedDict[tuple[str, str, str, int], tuple[dict[str, Any], ...]]):
+            Cached outputs, least recently used first
+        _generations (dict[str, int]): Number of runs and restarts per kernel ID
+        _lock (threading.Lock): Guards _results and _generations
+    """
+
+    def __init__(self) -> None:
+        self._results: OrderedDict[
+            tuple[str, str, str, int], tuple[dict[str, Any], ...]
+        ] = OrderedDict()
+        self._generations: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def key(
+        self, kernel_id: str, language: str, code: str
+    ) -> tuple[str, str, str, int] | None:
+        """Get the cache key for running code on a kernel
+
+        Args:
+            kernel_id (str): The kernel the code runs on
+            language (str): Kernel name
+            code (str): The code to execute
+
+        Returns:
+            tuple[str, str, str, int] | None: The key, or None if the language's
+                results are not cached
+        """
+        if language not in settings.EXECUTION_CACHE_LANGUAGES:
+            return None
+        with self._lock:
+            generation = self._generations.get(kernel_id, 0)
+        return (language, _code_digest(code), kernel_id, generation)
+
+    def get(self, key: tuple[str, str, str, int] | None) -> "CachedExecution | None":
+        """Get the cached result for a key, if any
+
+        Args:
+            key (tuple[str, str, str, int] | None): Key from ResultCache.key
+
+        Returns:
+            CachedExecution | None: The cached result
+        """
+        if key is None:
+            return None
+        with self._lock:
+            outputs = self._results.get(key)
+            if outputs is None:
+                return None
+            self._results.move_to_end(key)
+        return CachedExecution(outputs)
+
+    def set(
+        self, key: tuple[str, str, str, int] | None, outputs: list[dict[str, Any]]
+    ) -> None:
+        """Cache the outputs of a successful execution
+
+        Args:
+            key (tuple[str, str, str, int] | None): Key from ResultCache.key
+            outputs (list[dict[str, Any]]): The execution's output items
+        """
+        if key is None:
+            return
+        with self._lock:
+            if key[3] != self._generations.get(key[2], 0):
+                # The kernel restarted while the code ran
+                return
+            self._results[key] = tuple(outputs)
+            self._results.move_to_end(key)
+            while len(self._results) > settings.EXECUTION_CACHE_SIZE:
+                self._results.popitem(last=False)
+
+    def record_run(
+        self, kernel_id: str, language: str, code: str
+    ) -> tuple[str, str, str, int] | None:
+        """Record that code was sent to a kernel, which may change its state
+
+        Args:
+            kernel_id (str): The kernel the code runs on
+            language (str): Kernel name
+            code (str): The code being executed
+
+        Returns:
+            tuple[str, str, str, int] | None: The key to cache the outputs under,
+                or None if the language's results are not cached
+        """
+        if language not in settings.EXECUTION_CACHE_LANGUAGES:
+            return None
+        self.bump(kernel_id)
+        return self.key(kernel_id, language, code)
+
+    def bump(self, kernel_id: str) -> None:
+        """Forget the results of a kernel whose state is changing
+
+        Args:
+            kernel_id (str): The kernel ID
+        """
+        with self._lock:
+            self._generations[kernel_id] = self._generations.get(kernel_id, 0) + 1
+            self._drop(kernel_id)
+
+    def forget(self, kernel_id: str) -> None:
+        """Forget the results and generation of a kernel that no longer exists
+
+        Args:
+            kernel_id (str): The kernel ID
+        """
+        with self._lock:
+            self._generations.pop(kernel_id, None)
+            self._drop(kernel_id)
+
+    def _drop(self, kernel_id: str) -> None:
+        """Drop a kernel's results. Must be called with _lock held."""
+        for key in [key for key in self._results if key[2] == kernel_id]:
+            del self._results[key]
+
+
+class CachedExecution:
+    """An earlier execution's result, replayed without touching the kernel
+
+    Has the same interface for reading outputs as Execution and
+    async_jupyter.AsyncExecution.
+
+    Attributes:
+        _outputs (tuple[dict[str, Any], ...]): The output items
+    """
+
+    def __init__(self, outputs: tuple[dict[str, Any], ...]) -> None:
+        self._outputs = outputs
+
+    def outputs(self, language: str) -> Generator[dict[str, Any], None, str]:
+        """Replay the cached output items
+
+        Args:
+            language (str): The language the code was executed in
+
+        Yields:
+            dict[str, Any]: Output items with success, type and content fields
+
+        Returns:
+            str: The status of the execution, which is always "ok"
+        """
+        yield from self._outputs
+        return "ok"
+
+    async def collect(self, language: str) -> tuple[list[dict[str, Any]], str]:
+        """Get the cached output items
+
+        Args:
+            language (str): The language the code was executed in
+
+        Returns:
+            tuple[list[dict[str, Any]], str]: The output items and "ok"
+        """
+        return list(self._outputs), "ok"
+
+    def close(self) -> None:
+        """Do nothing, as no request is waiting on a kernel"""
+
+
+def _code_digest(code: str) -> str:
+    """Hash code, ignoring line endings and trailing whitespace"""
+    lines = (line.rstrip() for line in code.splitlines())
+    normalized = "\n".join(lines).rstrip("\n")
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+class StandbyPool:
+    """Kernels started ahead of time and handed to users on their first run
+
+    The number kept ready per language is read from settings.KERNEL_STANDBY_POOL
+    on every refill. Kernels are started in a background thread, so taking one
+    never waits on a kernel starting up.
+
+    Attributes:
+        client (JupyterClient): Client used to start kernels
+        _kernels (dict[str, list[str]]): IDs of ready kernels per language
+        _filling (set[str]): Languages with a refill in progress
+        _lock (threading.Lock): Guards _kernels and _filling
+    """
+
+    def __init__(self, client: "JupyterClient") -> None:
+        self.client = client
+        self._kernels: dict[str, list[str]] = {}
+        self._filling: set[str] = set()
+        self._lock = threading.Lock()
+
+    def take(self, language: str) -> str | None:
+        """Take a ready kernel, starting a refill in the background
+
+        Args:
+            language (str): Kernel name
+
+        Returns:
+            str | None: The kernel ID, or None if no kernel is ready
+        """
+        with self._lock:
+            ready = self._kernels.get(language)
+            kernel_id = ready.pop() if ready else None
+        self.refill(language)
+        return kernel_id
+
+    def put(self, language: str, kernel_id: str | None) -> None:
+        """Return a kernel that was taken but not used
+
+        Args:
+            language (str): Kernel name
+            kernel_id (str | None): The kernel ID, or None to do nothing
+        """
+        if kernel_id is None:
+            return
+        with self._lock:
+            self._kernels.setdefault(language, []).append(kernel_id)
+
+    def discard(self, kernel_id: str) -> None:
+        """Forget a kernel that has been shut down
+
+        Args:
+            kernel_id (str): The kernel ID
+        """
+        with self._lock:
+            for ready in self._kernels.values():
+                if kernel_id in ready:
+                    ready.remove(kernel_id)
+
+    def kernel_ids(self) -> set[str]:
+        """Get the IDs of every ready kernel
+
+        Returns:
+            set[str]: The kernel IDs
+        """
+        with self._lock:
+            return {
+                kernel_id for ready in self._kernels.values() for kernel_id in ready
+            }
+
+    def refill(self, language: str) -> None:
+        """Top up the ready kernels in a language in a background thread
+
+        Args:
+            language (str): Kernel name
+        """
+        with self._lock:
+            if language in self._filling or not self._missing(language):
+                return
+            self._filling.add(language)
+        threading.Thread(target=self._fill, args=(language,), daemon=True).start()
+
+    def fill(self, language: str) -> None:
+        """Start kernels until the configured number are ready, as long as they
+        fit in the kernel budget
+
+        Args:
+            language (str): Kernel name
+        """
+        while self._missing(language) and self.client.reaper.has_room(language):
+            kernel_id = self.client.start_kernel(language)["id"]
+            self.put(language, kernel_id)
+
+    def _fill(self, language: str) -> None:
+        try:
+            self.fill(language)
+        except JupyterError:
+            # The next user to take a kernel triggers another attempt
+            pass
+        finally:
+            with self._lock:
+                self._filling.discard(language)
+
+    def _missing(self, language: str) -> int:
+        ready = len(self._kernels.get(language, ()))
+        return max(settings.KERNEL_STANDBY_POOL.get(language, 0) - ready, 0)
+
+
+class KernelReaper:
+    """Shuts down idle kernels and keeps the number of kernels within budget
+
+    Last use is the later of the last execute sent by this process and the
+    activity the Jupyter server reports, so kernels used through other worker
+    processes are not mistaken for idle ones. Busy kernels are never shut down.
+
+    Attributes:
+        client (JupyterClient): Client used to list and shut down kernels
+        _last_used (dict[str, float]): Time of the last execute per kernel ID
+        _lock (threading.Lock): Guards _last_used
+        _thread (threading.Thread | None): The background sweeping thread
+    """
+
+    def __init__(self, client: "JupyterClient") -> None:
+        self.client = client
+        self._last_used: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def touch(self, kernel_id: str) -> None:
+        """Record that code was just sent to a kernel
+
+        Args:
+            kernel_id (str): The kernel that was used
+        """
+        with self._lock:
+            self._last_used[kernel_id] = time.time()
+
+    def forget(self, kernel_id: str) -> None:
+        """Forget when a kernel that no longer exists was last used
+
+        Args:
+            kernel_id (str): The kernel ID
+        """
+        with self._lock:
+            self._last_used.pop(kernel_id, None)
+
+    def inventory(self) -> list[dict[str, Any]]:
+        """Describe every kernel on the Jupyter server, least recently used first
+
+        Returns:
+            list[dict[str, Any]]: One item per kernel with the following fields:
+                - id: The kernel ID
+                - name: The kernel's language
+                - path: Path of the session using the kernel, or None
+                - execution_state: As reported by the Jupyter server
+                - connections: Number of open websockets to the kernel
+                - last_used: Time of last use, in seconds since the epoch
+                - standby: Whether the kernel is in this process's standby pool
+        """
+        kernels = self.client.list_kernels()
+        paths = {
+            session["kernel"]["id"]: session["path"]
+            for session in self.client.list_sessions()
+        }
+        standby = self.client.standby.kernel_ids()
+        with self._lock:
+            last_used = dict(self._last_used)
+
+        inventory = [
+            {
+                "id": kernel["id"],
+                "name": kernel["name"],
+                "path": paths.get(kernel["id"]),
+                "execution_state": kernel.get("execution_state"),
+                "connections": kernel.get("connections", 0),
+                "last_used": max(
+                    last_used.get(kernel["id"], 0.0),
+                    _timestamp(kernel.get("last_activity")),
+                ),
+                "standby": kernel["id"] in standby,
+            }
+            for kernel in kernels
+        ]
+        return sorted(inventory, key=lambda kernel: kernel["last_used"])
+
+    def sweep(self) -> list[str]:
+        """Shut down kernels idle for longer than settings.KERNEL_IDLE_TTL, then
+        evict least recently used kernels until the budget is met
+
+        Returns:
+            list[str]: IDs of the kernels shut down
+        """
+        inventory = self.inventory()
+        reaped = []
+        if settings.KERNEL_IDLE_TTL:
+            cutoff = time.time() - settings.KERNEL_IDLE_TTL
+            for kernel in inventory:
+                if (
+                    not kernel["standby"]
+                    and kernel["execution_state"] != "busy"
+                    and kernel["last_used"] < cutoff
+                ):
+                    self.shutdown(kernel["id"])
+                    reaped.append(kernel["id"])
+
+        live = [kernel for kernel in inventory if kernel["id"] not in reaped]
+        return reaped + self._evict(live)
+
+    def make_room(self, language: str) -> list[str]:
+        """Evict least recently used kernels so one more kernel fits in the budget
+
+        Args:
+            language (str): Language of the kernel about to be started
+
+        Returns:
+            list[str]: IDs of the kernels shut down
+        """
+        if not _has_budget():
+            return []
+        return self._evict(self.inventory(), language)
+
+    def has_room(self, language: str) -> bool:
+        """Check whether one more kernel fits in the budget without evicting
+
+        Args:
+            language (str): Language of the kernel about to be started
+
+        Returns:
+            bool: Whether the kernel fits
+        """
+        if not _has_budget():
+            return True
+        return _over_budget(self.inventory(), language) is None
+
+    def shutdown(self, kernel_id: str) -> None:
+        """Shut down a kernel and forget everything this process knows about it
+
+        Args:
+            kernel_id (str): The kernel to shut down
+        """
+        forget_kernel(self.client, kernel_id)
+        self.client.standby.discard(kernel_id)
+        self.client.channels.discard(kernel_id)
+        try:
+            self.client.shutdown_kernel(kernel_id)
+        except KernelNotFound:
+            # Already shut down, e.g. by another worker's reaper
+            pass
+
+    def start(self) -> None:
+        """Start sweeping every settings.KERNEL_REAP_INTERVAL seconds in a
+        background thread, if not already started"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(settings.KERNEL_REAP_INTERVAL)
+            try:
+                self.sweep()
+            except JupyterError:
+                # Try again on the next sweep
+                pass
+
+    def _evict(
+        self, live: list[dict[str, Any]], language: str | None = None
+    ) -> list[str]:
+        # Pooled kernels are the cheapest to lose, then the least recently used
+        candidates = sorted(
+            (kernel for kernel in live if kernel["execution_state"] != "busy"),
+            key=lambda kernel: (not kernel["standby"], kernel["last_used"]),
+        )
+        live = list(live)
+        evicted = []
+        while (languages := _over_budget(live, language)) is not None:
+            victim = next(
+                (kernel for kernel in candidates if kernel["name"] in languages), None
+            )
+            if victim is None:
+                break
+            candidates.remove(victim)
+            live.remove(victim)
+            self.shutdown(victim["id"])
+            evicted.append(victim["id"])
+        return evicted
+
+
+def _has_budget() -> bool:
+    return bool(
+        settings.KERNEL_MAX_COUNT or any(settings.KERNEL_MAX_PER_LANGUAGE.values())
+    )
+
+
+def _over_budget(
+    live: list[dict[str, Any]], language: str | None = None
+) -> set[str] | None:
+    """Find which kernels must be evicted to stay within budget
+
+    Args:
+        live (list[dict[str, Any]]): Inventory of the running kernels
+        language (str | None): Language of a kernel about to be started, if any
+
+    Returns:
+        set[str] | None: Languages whose kernels may be evicted, or None if
+            the kernels are within budget
+    """
+    counts = Counter(kernel["name"] for kernel in live)
+    if language is not None:
+        counts[language] += 1
+
+    for name, count in counts.items():
+        limit = settings.KERNEL_MAX_PER_LANGUAGE.get(name, 0)
+        if limit and count > limit:
+            return {name}
+    if settings.KERNEL_MAX_COUNT and counts.total() > settings.KERNEL_MAX_COUNT:
+        return set(counts)
+    return None
+
+
+def _timestamp(iso_time: str | None) -> float:
+    """Convert a time reported by the Jupyter server to seconds since the epoch"""
+    if not iso_time:
+        return 0.0
+    return datetime.fromisoformat(iso_time.replace("Z", "+00:00")).timestamp()
+
+
+class JupyterClient:
+    """Client for the Jupyter server REST API sharing one pooled HTTP session
+
+    Each user gets their own kernel per language, bound to them by a Jupyter
+    session so that every worker process finds the same kernel.
+
+    Kernel lookups are cached per (user, language) and each kernel keeps one open
+    websocket, so a warm cell run makes no REST calls or handshakes before the send.
+
+    Attributes:
+        base_url (str): HTTP URL of the Jupyter server
+        ws_url (str): Websocket URL of the Jupyter server
+        headers (dict[str, str]): Authentication headers for the Jupyter server
+        timeout (tuple[float, float]): Connect and read timeouts for REST calls
+        session (requests.Session): Keep-alive session shared by all requests
+        kernels (KernelCache): Cache of kernel IDs per user and language
+        standby (StandbyPool): Pre-started kernels waiting for new sessions
+        reaper (KernelReaper): Shuts down idle kernels
+        results (ResultCache): Outputs of deterministic executions
+        channels (ChannelManager): Long-lived websockets to each kernel
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: str,
+        token: str,
+        timeout: tuple[float, float] = (3.05, 30),
+        pool_size: int = 10,
+    ) -> None:
+        self.base_url = f"http://{host}:{port}"
+        self.ws_url = f"ws://{host}:{port}"
+        self.headers = {"Authorization": f"Token {token}"}
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.kernels = KernelCache()
+        self.standby = StandbyPool(self)
+        self.reaper = KernelReaper(self)
+        self.results = ResultCache()
+        self.channels = ChannelManager(self)
+
+    def _request(self, method: str, path: str, **kwargs: Any) -> requests.Response:
+        """Send a request to the Jupyter server using the pooled session
+
+        Args:
+            method (str): HTTP method
+            path (str): Path on the Jupyter server, e.g. "/api/kernels"
+
+        Raises:
+            KernelNotFound: If the server responds with 404
+            JupyterError: If the server cannot be reached or responds with an error
+
+        Returns:
+            requests.Response: The server's response
+        """
+        try:
+            response = self.session.request(
+                method, self.base_url + path, timeout=self.timeout, **kwargs
+            )
+        except requests.exceptions.RequestException as e:
+            raise JupyterError("Could not connect to Jupyter Server") from e
+
+        if response.status_code == 404:
+            raise KernelNotFound(path)
+        if not response.ok:
+            raise JupyterError(f"Jupyter Server responded with {response.status_code}")
+        return response
+
+    def list_kernels(self) -> list[dict[str, Any]]:
+        """Get the list of running kernels
+
+        Returns:
+            list[dict[str, Any]]: The kernel models reported by the Jupyter server
+        """
+        return self._request("GET", "/api/kernels").json()
+
+    def start_kernel(self, language: str) -> dict[str, Any]:
+        """Start a new kernel
+
+        Args:
+            language (str): The kernel name to start
+
+        Returns:
+            dict[str, Any]: The new kernel's model
+        """
+        return self._request("POST", "/api/kernels", json={"name": language}).json()
+
+    def list_sessions(self) -> list[dict[str, Any]]:
+        """Get the list of sessions binding a path to a kernel
+
+        Returns:
+            list[dict[str, Any]]: The session models reported by the Jupyter server
+        """
+        return self._request("GET", "/api/sessions").json()
+
+    def create_session(
+        self, user: Hashable, language: str, kernel_id: str | None = None
+    ) -> str:
+        """Bind the user's session in a language to a kernel
+
+        If another worker created the session first, the Jupyter server returns
+        that session unchanged, so every worker agrees on the user's kernel.
+
+        Args:
+            user (Hashable): Key identifying the user
+            language (str): Kernel name
+            kernel_id (str | None): Existing kernel to bind, or None to start one
+
+        Returns:
+            str: The ID of the kernel the session is bound to
+        """
+        session = self._request(
+            "POST", "/api/sessions", json=session_model(user, language, kernel_id)
+        ).json()
+        return session["kernel"]["id"]
+
+    def find_kernel(self, user: Hashable, language: str) -> str | None:
+        """Get the ID of the user's kernel in the given language without starting one
+
+        Args:
+            user (Hashable): Key identifying the user
+            language (str): Kernel name
+
+        Returns:
+            str | None: The kernel ID, or None if no kernel is running
+        """
+        kernel_id = self.kernels.get(user, language)
+        if kernel_id is None:
+            kernel_id = session_kernel(self.list_sessions(), user, language)
+            if kernel_id is not None:
+                self.kernels.set(user, language, kernel_id)
+        return kernel_id
+
+    def get_kernel(self, user: Hashable, language: str) -> str:
+        """Get the ID of the user's kernel in the given language, starting one if needed
+
+        A new session is handed a standby kernel if one is ready, so the user's
+        first run does not wait for the kernel to start. Least recently used
+        kernels are shut down first if the kernel budget is full.
+
+        Args:
+            user (Hashable): Key identifying the user
+            language (str): Kernel name
+
+        Returns:
+            str: The kernel ID
+        """
+        kernel_id = self.find_kernel(user, language)
+        if kernel_id is None:
+            self.reaper.make_room(language)
+            standby_id = self.standby.take(language)
+            try:
+                kernel_id = self.create_session(user, language, standby_id)
+            except KernelNotFound:
+                # The standby kernel was shut down, e.g. by another worker's reaper
+                kernel_id = self.create_session(user, language)
+                standby_id = None
+            except JupyterError:
+                self.standby.put(language, standby_id)
+                raise
+            if kernel_id != standby_id:
+                self.standby.put(language, standby_id)
+            self.kernels.set(user, language, kernel_id)
+        return kernel_id
+
+    def restart_kernel(self, kernel_id: str) -> None:
+        """Restart a kernel, invalidating any cached lookups and results of it
+
+        Args:
+            kernel_id (str): The kernel to restart
+        """
+        self.kernels.invalidate(kernel_id)
+        self.results.bump(kernel_id)
+        self._request("POST", f"/api/kernels/{kernel_id}/restart")
+
+    def interrupt_kernel(self, kernel_id: str) -> None:
+        """Interrupt the code a kernel is running
+
+        Args:
+            kernel_id (str): The kernel to interrupt
+        """
+        self._request("POST", f"/api/kernels/{kernel_id}/interrupt")
+
+    def shutdown_kernel(self, kernel_id: str) -> None:
+        """Shut down a kernel
+
+        Args:
+            kernel_id (str): The kernel to shut down
+        """
+        self._request("DELETE", f"/api/kernels/{kernel_id}")
+
+    def connect(self, kernel_id: str) -> WebSocket:
+        """Open a websocket to the channels of a kernel
+
+        Args:
+            kernel_id (str): The kernel to connect to
+
+        Raises:
+            KernelNotFound: If the kernel no longer exists
+
+        Returns:
+            WebSocket: Connection multiplexing the kernel's channels
+        """
+        try:
+            return create_connection(
+                f"{self.ws_url}/api/kernels/{kernel_id}/channels",
+                header=self.headers,
+            )
+        except WebSocketBadStatusException as e:
+            if e.status_code == 404:
+                forget_kernel(self, kernel_id)
+                raise KernelNotFound(kernel_id) from e
+            raise JupyterError("Could not connect to kernel") from e
+        except OSError as e:
+            raise JupyterError("Could not connect to Jupyter Server") from e
+
+    def execute(
+        self, user: Hashable, language: str, code: str, stop_on_error: bool = True
+    ) -> "Execution | CachedExecution":
+        """Send code to the user's kernel, retrying once if the cached kernel is gone
+
+        The cached result is returned instead if the same code was the last to
+        run on the kernel and the language's results are cached.
+
+        Args:
+            user (Hashable): Key identifying the user
+            language (str): Kernel name
+            code (str): The code to execute
+            stop_on_error (bool): Whether the kernel aborts the requests queued
+                behind this one if it fails
+
+        Returns:
+            Execution | CachedExecution: The messages the kernel sends in reply, or
+                the cached result
+        """
+        kernel_id = self.get_kernel(user, language)
+        cached = self.results.get(self.results.key(kernel_id, language, code))
+        if cached is not None:
+            self.reaper.touch(kernel_id)
+            return cached
+
+        try:
+            execution = self.channels.get(kernel_id).execute(code, stop_on_error)
+        except KernelNotFound:
+            self.channels.discard(kernel_id)
+            kernel_id = self.get_kernel(user, language)
+            execution = self.channels.get(kernel_id).execute(code, stop_on_error)
+        execution.cache_key = self.results.record_run(kernel_id, language, code)
+        self.reaper.touch(kernel_id)
+        return execution
+
+    def execute_batch(
+        self, user: Hashable, blocks: list[dict[str, str]], stop_on_error: bool = False
+    ) -> Iterator[tuple[str, str, Any]]:
+        """Run code blocks in order, sending the execute requests for each group of
+        blocks (see batch_waves) before reading any of their replies
+
+        Args:
+            user (Hashable): Key identifying the user
+            blocks (list[dict[str, str]]): Code blocks with id, language and code fields
+            stop_on_error (bool): Whether to skip every block after one that fails
+
+        Yields:
+            tuple[str, str, Any]: ("output", block ID, output item) for each output
+                item of a block, then ("status", block ID, status) once it finishes.
+                Blocks not run after a failure have the status "skipped".
+        """
+        failed = False
+        for wave in batch_waves(blocks, stop_on_error):
+            executions = [] if failed else self._send_wave(user, wave, stop_on_error)
+            for index, block in enumerate(wave):
+                execution = executions[index] if index < len(executions) else None
+                if execution is None or failed:
+                    # The kernel aborts requests queued behind a failed one
+                    if isinstance(execution, (Execution, CachedExecution)):
+                        execution.close()
+                    yield "status", block["id"], "skipped"
+                    continue
+
+                if isinstance(execution, JupyterError):
+                    yield "output", block["id"], jupyter_error_output()
+                    status = "error"
+                else:
+                    outputs = execution.outputs(block["language"])
+                    while True:
+                        try:
+                            output = next(outputs)
+                        except StopIteration as stop:
+                            status = stop.value
+                            break
+                        yield "output", block["id"], output
+                yield "status", block["id"], status
+                failed = stop_on_error and status != "ok"
+
+    def _send_wave(
+        self, user: Hashable, wave: list[dict[str, str]], stop_on_error: bool
+    ) -> list["Execution | CachedExecution | JupyterError"]:
+        executions: list[Execution | CachedExecution | JupyterError] = []
+        for block in wave:
+            try:
+                executions.append(
+                    self.execute(user, block["language"], block["code"], stop_on_error)
+                )
+            except JupyterError as e:
+                executions.append(e)
+                if stop_on_error:
+                    break
+        return executions
+
+
+class Execution:
+    """The reply messages to one execute request on a shared kernel channel
+
+    Iterating yields the messages whose parent is this request, in the order
+    the kernel sent them, plus any broadcast status messages (e.g. kernel death).
+
+    Attributes:
+        channel (KernelChannel): The channel the request was sent on
+        msg_id (str): ID of the execute request
+        ws (WebSocket | None): The websocket the request was sent on
+        messages (queue.Queue): Messages routed to this request by the channel
+        cache_key (tuple[str, str, str, int] | None): Where to cache the outputs
+            if the execution succeeds
+    """
+
+    def __init__(self, channel: "KernelChannel", msg_id: str) -> None:
+        self.channel = channel
+        self.msg_id = msg_id
+        self.ws: WebSocket | None = None
+        self.messages: queue.Queue[dict[str, Any] | None] = queue.Queue()
+        self.cache_key: tuple[str, str, str, int] | None = None
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        while True:
+            yield self.next_message()
+
+    def next_message(self, timeout: float | None = None) -> dict[str, Any]:
+        """Wait for the next message for this request
+
+        Args:
+            timeout (float | None): Seconds to wait, or None to wait indefinitely
+
+        Raises:
+            ExecutionTimeout: If no message arrives in time
+            JupyterError: If the connection to the kernel was lost
+
+        Returns:
+            dict[str, Any]: The message
+        """
+        try:
+            rsp = self.messages.get(timeout=timeout)
+        except queue.Empty as e:
+            raise ExecutionTimeout(self.msg_id) from e
+        if rsp is None:
+            raise JupyterError("Lost connection to kernel")
+        return rsp
+
+    def interrupt(self) -> None:
+        """Interrupt the kernel running this request"""
+        self.channel.client.interrupt_kernel(self.channel.kernel_id)
+
+    def outputs(self, language: str) -> Generator[dict[str, Any], None, str]:
+        """Translate the reply messages into output items as they arrive
+
+        The kernel is interrupted if the language's deadline passes before the
+        reply arrives, and output beyond settings.EXECUTION_OUTPUT_LIMIT is dropped.
+        The request is released once the reply arrives, and the outputs are cached
+        if it succeeded.
+
+        Args:
+            language (str): The language the code was executed in
+
+        Yields:
+            dict[str, Any]: Output items with success, type and content fields
+
+        Returns:
+            str: The status of the execution ("ok", "error", "aborted", "timeout"
+                or "dead")
+        """
+        reader = OutputReader(language)
+        with self:
+            try:
+                while reader.status is None:
+                    try:
+                        rsp = self.next_message(reader.timeout())
+                    except ExecutionTimeout:
+                        if not reader.interrupted:
+                            self.interrupt()
+                        yield from reader.timed_out()
+                    else:
+                        yield from reader.read(rsp)
+            except JupyterError:
+                yield from reader.failed()
+
+        if reader.status == "ok":
+            self.channel.client.results.set(self.cache_key, reader.outputs)
+        return reader.status
+
+    def close(self) -> None:
+        """Stop routing messages to this request"""
+        self.channel.release(self.msg_id)
+
+    def __enter__(self) -> "Execution":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+class KernelChannel:
+    """A long-lived websocket to one kernel, shared by every request in this process
+
+    A reader thread routes each incoming message to the waiting request with a
+    matching parent_header.msg_id, so concurrent executions never see each
+    other's output. The websocket is reopened transparently if it drops.
+
+    Attributes:
+        client (JupyterClient): Client used to open the websocket
+        kernel_id (str): The kernel this channel talks to
+        _ws (WebSocket | None): The open websocket, if connected
+        _waiters (dict[str, Execution]): Pending requests by message ID
+        _lock (threading.Lock): Guards _ws and _waiters
+    """
+
+    def __init__(self, client: JupyterClient, kernel_id: str) -> None:
+        self.client = client
+        self.kernel_id = kernel_id
+        self._ws: WebSocket | None = None
+        self._waiters: dict[str, Execution] = {}
+        self._lock = threading.Lock()
+
+    def _connect(self) -> WebSocket:
+        """Get the open websocket, connecting and starting a reader if needed
+
+        Must be called with _lock held.
+        """
+        if self._ws is None or not self._ws.connected:
+            self._ws = self.client.connect(self.kernel_id)
+            threading.Thread(target=self._read, args=(self._ws,), daemon=True).start()
+        return self._ws
+
+    def _read(self, ws: WebSocket) -> None:
+        """Route messages from the websocket to waiting requests until it closes
+
+        Args:
+            ws (WebSocket): The websocket to read from
+        """
+        while True:
+            try:
+                rsp = json.loads(ws.recv())
+            except (WebSocketException, OSError, ValueError):
+                break
+
+            with self._lock:
+                waiters = message_waiters(
+                    rsp, self._waiters, self.client, self.kernel_id
+                )
+            for waiter in waiters:
+                waiter.messages.put(rsp)
+
+        # Wake any requests still waiting on this websocket
+        with self._lock:
+            if self._ws is ws:
+                self._ws = None
+            waiters = [waiter for waiter in self._waiters.values() if waiter.ws is ws]
+            for waiter in waiters:
+                del self._waiters[waiter.msg_id]
+        for waiter in waiters:
+            waiter.messages.put(None)
+
+    def execute(self, code: str, stop_on_error: bool = True) -> Execution:
+        """Send an execute request on the channel
+
+        Args:
+            code (str): The code to execute
+            stop_on_error (bool): Whether the kernel aborts the requests queued
+                behind this one if it fails
+
+        Returns:
+            Execution: The messages the kernel sends in reply
+        """
+        request = send_execute_request(code, stop_on_error)
+        execution = Execution(self, request["header"]["msg_id"])
+        payload = json.dumps(request)
+
+        with self._lock:
+            try:
+                try:
+                    execution.ws = self._connect()
+                    execution.ws.send(payload)
+                except (WebSocketException, OSError):
+                    # The websocket went stale while idle, so reconnect and try once more
+                    self._ws = None
+                    execution.ws = self._connect()
+                    execution.ws.send(payload)
+            except (WebSocketException, OSError) as e:
+                raise JupyterError("Could not connect to kernel") from e
+            self._waiters[execution.msg_id] = execution
+        return execution
+
+    def release(self, msg_id: str) -> None:
+        """Stop routing messages for a request
+
+        Args:
+            msg_id (str): ID of the request
+        """
+        with self._lock:
+            self._waiters.pop(msg_id, None)
+
+    def close(self) -> None:
+        """Close the websocket, waking any waiting requests"""
+        with self._lock:
+            ws, self._ws = self._ws, None
+        if ws is not None:
+            ws.close()
+
+
+class ChannelManager:
+    """The process's kernel channels, one per kernel
+
+    Attributes:
+        client (JupyterClient): Client used to open websockets
+        _channels (dict[str, KernelChannel]): Open channels by kernel ID
+        _lock (threading.Lock): Guards _channels
+    """
+
+    def __init__(self, client: JupyterClient) -> None:
+        self.client = client
+        self._channels: dict[str, KernelChannel] = {}
+        self._lock = threading.Lock()
+
+    def get(self, kernel_id: str) -> KernelChannel:
+        """Get the channel to a kernel, creating it if needed
+
+        Args:
+            kernel_id (str): The kernel to talk to
+
+        Returns:
+            KernelChannel: The shared channel
+        """
+        with self._lock:
+            if kernel_id not in self._channels:
+                self._channels[kernel_id] = KernelChannel(self.client, kernel_id)
+            return self._channels[kernel_id]
+
+    def discard(self, kernel_id: str) -> None:
+        """Close and forget the channel to a kernel, if open
+
+        Args:
+            kernel_id (str): The kernel whose channel to close
+        """
+        with self._lock:
+            channel = self._channels.pop(kernel_id, None)
+        if channel is not None:
+            channel.close()
+
+    def close_all(self) -> None:
+        """Close every channel"""
+        with self._lock:
+            channels = list(self._channels.values())
+            self._channels.clear()
+        for channel in channels:
+            channel.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def create_client() -> JupyterClient:
+    """Create a Jupyter client from the settings, without starting any
+    background work
+
+    Returns:
+        JupyterClient: The new client
+    """
+    return JupyterClient(
+        settings.JUPYTER_URL,
+        settings.JUPYTER_PORT,
+        settings.JUPYTER_TOKEN,
+        timeout=(settings.JUPYTER_CONNECT_TIMEOUT, settings.JUPYTER_READ_TIMEOUT),
+        pool_size=settings.JUPYTER_POOL_SIZE,
+    )
+
+
+def get_client() -> JupyterClient:
+    """Get the process-wide Jupyter client, creating it on first use
+
+    Creating the client starts filling the standby kernel pool and sweeping
+    idle kernels.
+
+    Returns:
+        JupyterClient: The shared client
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = create_client()
+            for language in settings.KERNEL_STANDBY_POOL:
+                _client.standby.refill(language)
+            if settings.KERNEL_REAP_INTERVAL:
+                _client.reaper.start()
+        return _client
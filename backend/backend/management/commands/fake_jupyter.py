@@ -0,0 +1,42 @@
+import uvicorn
+from django.core.management.base import BaseCommand
+
+from backend.fake_jupyter import FakeJupyterServer
+
+
+class Command(BaseCommand):
+    help = "Serve a fake Jupyter server whose kernels echo code instead of running it"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8888)
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.0,
+            help="Seconds the kernels wait before sending each output message",
+        )
+        parser.add_argument(
+            "--output-messages",
+            type=int,
+            default=1,
+            help="Number of output messages per execution",
+        )
+        parser.add_argument(
+            "--output-size",
+            type=int,
+            default=0,
+            help="Characters of output in each output message",
+        )
+
+    def handle(self, *args, **options):
+        app = FakeJupyterServer(
+            latency=options["latency"],
+            output_messages=options["output_messages"],
+            output_size=options["output_size"],
+        )
+        self.stdout.write(
+            f"Set JUPYTER_URL={options['host']} and JUPYTER_PORT={options['port']} "
+            "to use the fake Jupyter server"
+        )
+        uvicorn.run(app, host=options["host"], port=options["port"], lifespan="off")
@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from backend import jupyter
+
+
+class Command(BaseCommand):
+    help = "Report the kernels running on the Jupyter server"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sweep",
+            action="store_true",
+            help="Shut down idle kernels and enforce the kernel budget first",
+        )
+
+    def handle(self, *args, **options):
+        # A client of its own, so the command starts no standby kernels
+        reaper = jupyter.create_client().reaper
+
+        try:
+            if options["sweep"]:
+                for kernel_id in reaper.sweep():
+                    self.stdout.write(f"Shut down {kernel_id}")
+            inventory = reaper.inventory()
+        except jupyter.JupyterError as e:
+            raise CommandError(str(e)) from e
+
+        now = time.time()
+        self.stdout.write(
+            f"{'KERNEL':<36}  {'LANGUAGE':<16}  {'STATE':<8}  {'CONN':>4}  "
+            f"{'IDLE':>8}  SESSION"
+        )
+        for kernel in reversed(inventory):
+            idle = f"{now - kernel['last_used']:.0f}s" if kernel["last_used"] else "-"
+            self.stdout.write(
+                f"{kernel['id']:<36}  {kernel['name']:<16}  "
+                f"{kernel['execution_state'] or '-':<8}  {kernel['connections']:>4}  "
+                f"{idle:>8}  {kernel['path'] or '(standby)'}"
+            )
+        self.stdout.write(f"{len(inventory)} kernels")
@@ -0,0 +1,156 @@
+import threading
+import time
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from backend import jupyter
+from backend.fake_jupyter import FakeJupyterServer, serve
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure /execute/ latency and throughput with concurrent simulated users "
+        "against a fake Jupyter server, using a throwaway test database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--users", type=int, default=10, help="Number of concurrent users"
+        )
+        parser.add_argument(
+            "--requests", type=int, default=20, help="Executions per user"
+        )
+        parser.add_argument("--language", default="python3")
+        parser.add_argument("--code", default="1 + 1")
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.0,
+            help="Seconds the kernels wait before sending each output message",
+        )
+        parser.add_argument(
+            "--output-messages",
+            type=int,
+            default=1,
+            help="Number of output messages per execution",
+        )
+        parser.add_argument(
+            "--output-size",
+            type=int,
+            default=0,
+            help="Characters of output in each output message",
+        )
+        parser.add_argument(
+            "--standby",
+            type=int,
+            default=0,
+            help="Standby kernels kept ready in the language",
+        )
+        parser.add_argument(
+            "--warmup",
+            action="store_true",
+            help="Run one untimed execution per user first, so every user has a kernel",
+        )
+
+    def handle(self, *args, **options):
+        app = FakeJupyterServer(
+            latency=options["latency"],
+            output_messages=options["output_messages"],
+            output_size=options["output_size"],
+        )
+        server, port = serve(app)
+
+        setup_test_environment()
+        test_database = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        try:
+            with override_settings(
+                JUPYTER_URL="127.0.0.1",
+                JUPYTER_PORT=str(port),
+                JUPYTER_TOKEN="loadtest",
+                KERNEL_STANDBY_POOL={options["language"]: options["standby"]},
+                KERNEL_REAP_INTERVAL=0,
+            ):
+                client = jupyter.get_client()
+                client.standby.fill(options["language"])
+                latencies, errors, elapsed = self.run(options)
+                client.channels.close_all()
+        finally:
+            connection.creation.destroy_test_db(test_database, verbosity=0)
+            teardown_test_environment()
+            server.should_exit = True
+
+        total = len(latencies)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        self.stdout.write(
+            f"{total} executions by {options['users']} users in {elapsed:.2f}s "
+            f"({errors} errors)"
+        )
+        self.stdout.write(f"Throughput: {total / elapsed:.1f} executions/s")
+        self.stdout.write(f"Latency: p50 {p50:.1f}ms, p95 {p95:.1f}ms, p99 {p99:.1f}ms")
+        self.stdout.write(f"Kernels started: {app.started}")
+
+    def run(self, options) -> tuple[np.ndarray, int, float]:
+        """Run the simulated users
+
+        Returns:
+            tuple[np.ndarray, int, float]: Latency of each timed execution in
+                seconds, the number of failed executions and the wall-clock time
+        """
+        clients = []
+        for i in range(options["users"]):
+            user = User.objects.create_user(username=f"loadtest-{i}")
+            http = Client()
+            http.force_login(user)
+            clients.append(http)
+
+        data = {"language": options["language"], "code": options["code"]}
+        url = reverse("execute")
+        latencies = [[] for _ in clients]
+        errors = [0 for _ in clients]
+        start = threading.Barrier(len(clients) + 1)
+
+        def simulate(index: int, http: Client) -> None:
+            try:
+                if options["warmup"]:
+                    http.post(url, data)
+                start.wait()
+                for _ in range(options["requests"]):
+                    sent_at = time.perf_counter()
+                    response = http.post(url, data)
+                    latencies[index].append(time.perf_counter() - sent_at)
+                    outputs = response.json()["output_stream"]
+                    if response.status_code != 200 or not all(
+                        output["success"] for output in outputs
+                    ):
+                        errors[index] += 1
+            except BaseException:
+                # Release the other users instead of leaving them at the barrier
+                start.abort()
+                raise
+            finally:
+                connections.close_all()
+
+        threads = [
+            threading.Thread(target=simulate, args=(index, http))
+            for index, http in enumerate(clients)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            start.wait()
+        except threading.BrokenBarrierError:
+            pass
+        started_at = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started_at
+
+        return np.array([t for user in latencies for t in user]), sum(errors), elapsed
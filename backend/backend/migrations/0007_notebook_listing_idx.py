@@ -0,0 +1,19 @@
+# Generated by Django 4.1.13 on 2026-10-17 23:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("backend", "0006_alter_notebook_notebook_modified_at"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="notebook",
+            index=models.Index(
+                fields=["user", "-notebook_modified_at", "-id"],
+                name="notebook_listing_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.1.13 on 2026-10-17 23:39
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("backend", "0007_notebook_listing_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="notebook",
+            name="revision",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name="NotebookPatch",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("revision", models.PositiveIntegerField()),
+                ("patch", models.JSONField()),
+                (
+                    "notebook",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="patches",
+                        to="backend.notebook",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="notebookpatch",
+            constraint=models.UniqueConstraint(
+                fields=("notebook", "revision"), name="notebook_patch_revision"
+            ),
+        ),
+    ]
@@ -0,0 +1,249 @@
+import json
+import struct
+import zlib
+from typing import Any
+
+import numpy as np
+from django.db import migrations, models
+
+# A frozen copy of backend.notebook_encoding as this migration first wrote it, so
+# later changes to the encoding do not change what the migration writes and reads.
+# Notebooks in this format stay readable, as their first byte names the format.
+
+# Formats of encoded notebooks, given by their first byte
+RAW_FORMAT = 0
+COMPACT_FORMAT = 1
+
+# Steps per pixel that stroke coordinates are quantized to
+COORDINATE_SCALE = 10
+
+# Coordinate array types, by the character given in the compact format
+COORDINATE_TYPES = {"h": np.dtype("<i2"), "i": np.dtype("<i4")}
+
+
+def encode_notebook(notebook_data: str | dict[str, Any]) -> bytes:
+    """Encode a notebook to store it
+
+    Args:
+        notebook_data (str | dict[str, Any]): The notebook, serialised as the
+            frontend saves it, or parsed
+
+    Returns:
+        bytes: The encoded notebook
+    """
+    text = notebook_data
+    if not isinstance(text, str):
+        text = json.dumps(notebook_data, separators=(",", ":"), ensure_ascii=False)
+    try:
+        notebook = json.loads(text)
+    except json.JSONDecodeError:
+        notebook = None
+    if not isinstance(notebook, dict):
+        return bytes([RAW_FORMAT]) + zlib.compress(text.encode())
+
+    coordinates = []
+    for line in notebook_lines(notebook):
+        points = line_points(line)
+        if points is None:
+            return bytes([RAW_FORMAT]) + zlib.compress(text.encode())
+        quantized = np.rint(points * COORDINATE_SCALE).astype(np.int64)
+        # The first point is kept as it is, and the rest as steps from the last
+        coordinates.append(np.diff(quantized, axis=0, prepend=np.zeros((1, 2), int)))
+        line["n"] = len(points)
+        for field in ("points", "boundingRect", "creatingLine"):
+            line.pop(field, None)
+
+    parsed_predictions = []
+    for index, block in enumerate(notebook.get("code_blocks") or []):
+        predictions = parse_predictions(block)
+        if predictions is not None:
+            block["predictions"] = predictions
+            parsed_predictions.append(index)
+
+    skeleton = json.dumps(
+        {"notebook": notebook, "parsed_predictions": parsed_predictions},
+        separators=(",", ":"),
+        ensure_ascii=False,
+    ).encode()
+    deltas = np.concatenate(coordinates) if coordinates else np.zeros((0, 2), int)
+    type_code = "h" if np.abs(deltas).max(initial=0) < 2**15 else "i"
+    payload = b"".join(
+        [
+            struct.pack("<I", len(skeleton)),
+            skeleton,
+            type_code.encode(),
+            deltas.astype(COORDINATE_TYPES[type_code]).tobytes(),
+        ]
+    )
+    return bytes([COMPACT_FORMAT]) + zlib.compress(payload)
+
+
+def decode_notebook(encoded: bytes | memoryview) -> str:
+    """Decode a stored notebook
+
+    Args:
+        encoded (bytes | memoryview): The notebook, from encode_notebook
+
+    Raises:
+        ValueError: If the notebook is not in a known format
+
+    Returns:
+        str: The notebook, serialised as the frontend loads it, with its stroke
+            coordinates rounded to 1 / COORDINATE_SCALE pixels
+    """
+    encoded = bytes(encoded)
+    if not encoded:
+        return ""
+    payload = zlib.decompress(encoded[1:])
+    if encoded[0] == RAW_FORMAT:
+        return payload.decode()
+    if encoded[0] != COMPACT_FORMAT:
+        raise ValueError(f"Unknown notebook format {encoded[0]}")
+
+    (skeleton_length,) = struct.unpack_from("<I", payload)
+    skeleton = json.loads(payload[4 : 4 + skeleton_length])
+    type_code = chr(payload[4 + skeleton_length])
+    deltas = np.frombuffer(
+        payload, COORDINATE_TYPES[type_code], offset=5 + skeleton_length
+    ).reshape(-1, 2)
+
+    notebook = skeleton["notebook"]
+    start = 0
+    for line in notebook_lines(notebook):
+        end = start + line.pop("n")
+        points = np.cumsum(deltas[start:end], axis=0) / COORDINATE_SCALE
+        start = end
+        line["points"] = [
+            {"x": coordinate(x), "y": coordinate(y)} for x, y in points.tolist()
+        ]
+    for index in skeleton["parsed_predictions"]:
+        block = notebook["code_blocks"][index]
+        block["predictions"] = json.dumps(
+            block["predictions"], separators=(",", ":"), ensure_ascii=False
+        )
+    return json.dumps(notebook, separators=(",", ":"), ensure_ascii=False)
+
+
+def notebook_lines(notebook: dict[str, Any]) -> list[dict[str, Any]]:
+    """Get the lines of every layer of every page of a notebook, in order
+
+    Args:
+        notebook (dict[str, Any]): The notebook's pages and code_blocks
+
+    Returns:
+        list[dict[str, Any]]: The lines, leaving out the gaps of erased lines
+    """
+    lines = []
+    pages = notebook.get("pages")
+    for entry in pages if isinstance(pages, list) else []:
+        page = entry[1] if isinstance(entry, list) and len(entry) == 2 else None
+        layers = page.get("layers") if isinstance(page, dict) else None
+        for layer in layers if isinstance(layers, list) else []:
+            layer_lines = layer.get("lines") if isinstance(layer, dict) else None
+            if isinstance(layer_lines, list):
+                lines.extend(line for line in layer_lines if isinstance(line, dict))
+    return lines
+
+
+def line_points(line: dict[str, Any]) -> np.ndarray | None:
+    """Get the points of a line as an array
+
+    Args:
+        line (dict[str, Any]): The line, with a list of points
+
+    Returns:
+        np.ndarray | None: The x and y coordinates of each point, or None if the
+            line is not in the frontend's format, so the notebook must be stored
+            as it is
+    """
+    points = line.get("points")
+    if not isinstance(points, list) or not points or "n" in line:
+        return None
+    try:
+        coordinates = np.array(
+            [[point["x"], point["y"]] for point in points], dtype=float
+        )
+    except (TypeError, KeyError, ValueError):
+        return None
+    if not all(len(point) == 2 for point in points):
+        return None
+    scaled = coordinates * COORDINATE_SCALE
+    if not np.isfinite(scaled).all() or np.abs(scaled).max() >= 2**30:
+        return None
+    return coordinates
+
+
+def parse_predictions(block: Any) -> Any | None:
+    """Parse the predictions of a code block, which the frontend saves as a JSON string
+
+    Args:
+        block (Any): The code block's attributes
+
+    Returns:
+        Any | None: The predictions, or None if they would not serialise back to the
+            same string and must be stored as it is
+    """
+    predictions = block.get("predictions") if isinstance(block, dict) else None
+    if not isinstance(predictions, str):
+        return None
+    try:
+        parsed = json.loads(predictions)
+    except json.JSONDecodeError:
+        return None
+    if json.dumps(parsed, separators=(",", ":"), ensure_ascii=False) != predictions:
+        return None
+    return parsed
+
+
+def coordinate(value: float) -> int | float:
+    """Write a decoded coordinate as the frontend would, without a trailing .0
+
+    Args:
+        value (float): The coordinate
+
+    Returns:
+        int | float: The coordinate, rounded to 1 / COORDINATE_SCALE pixels
+    """
+    value = round(value * COORDINATE_SCALE) / COORDINATE_SCALE
+    return int(value) if value.is_integer() else value
+
+
+def encode_notebooks(apps, schema_editor):
+    Notebook = apps.get_model("backend", "Notebook")
+    for notebook in Notebook.objects.only("notebook_data").iterator():
+        Notebook.objects.filter(id=notebook.id).update(
+            encoded_data=encode_notebook(notebook.notebook_data)
+        )
+
+
+def decode_notebooks(apps, schema_editor):
+    Notebook = apps.get_model("backend", "Notebook")
+    for notebook in Notebook.objects.only("encoded_data").iterator():
+        Notebook.objects.filter(id=notebook.id).update(
+            notebook_data=decode_notebook(notebook.encoded_data)
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("backend", "0008_notebook_patches"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="notebook",
+            name="encoded_data",
+            field=models.BinaryField(default=b""),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name="notebook",
+            name="notebook_data",
+            field=models.JSONField(null=True),
+        ),
+        migrations.RunPython(encode_notebooks, decode_notebooks),
+        migrations.RemoveField(
+            model_name="notebook",
+            name="notebook_data",
+        ),
+    ]
@@ -0,0 +1,80 @@
+import importlib
+import json
+
+from django.db import migrations, models
+
+# The frozen notebook encoding of 0009, which patches are encoded with too
+encoding = importlib.import_module("backend.migrations.0009_notebook_encoded_data")
+
+
+def encode_patch(patch):
+    if "pages" in patch:
+        patch = {
+            **patch,
+            "pages": [
+                [
+                    key,
+                    {
+                        "page": change.get("page", {}),
+                        "indexes": list(change.get("layers", {})),
+                        "layers": list(change.get("layers", {}).values()),
+                    },
+                ]
+                for key, change in patch["pages"].items()
+            ],
+        }
+    return encoding.encode_notebook(patch)
+
+
+def decode_patch(encoded):
+    patch = json.loads(encoding.decode_notebook(encoded))
+    if "pages" in patch:
+        patch["pages"] = {
+            key: {
+                "page": change["page"],
+                "layers": dict(zip(change["indexes"], change["layers"])),
+            }
+            for key, change in patch["pages"]
+        }
+    return patch
+
+
+def encode_patches(apps, schema_editor):
+    NotebookPatch = apps.get_model("backend", "NotebookPatch")
+    for patch in NotebookPatch.objects.only("patch").iterator():
+        NotebookPatch.objects.filter(id=patch.id).update(
+            encoded_patch=encode_patch(patch.patch)
+        )
+
+
+def decode_patches(apps, schema_editor):
+    NotebookPatch = apps.get_model("backend", "NotebookPatch")
+    for patch in NotebookPatch.objects.only("encoded_patch").iterator():
+        NotebookPatch.objects.filter(id=patch.id).update(
+            patch=decode_patch(patch.encoded_patch)
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("backend", "0009_notebook_encoded_data"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="notebookpatch",
+            name="encoded_patch",
+            field=models.BinaryField(default=b""),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name="notebookpatch",
+            name="patch",
+            field=models.JSONField(null=True),
+        ),
+        migrations.RunPython(encode_patches, decode_patches),
+        migrations.RemoveField(
+            model_name="notebookpatch",
+            name="patch",
+        ),
+    ]
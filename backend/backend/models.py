@@ -1,23 +1,190 @@
+from typing import Any
+
+import json
+
 from django.db import models  # noqa: F401
 from django.contrib.auth.models import User
 
+from backend.notebook_encoding import (
+    decode_notebook,
+    decode_patch,
+    encode_notebook,
+    encode_patch,
+)
+
 
 class Notebook(models.Model):
     """model representing a notebook for the application
 
+    The notebook's data is kept as of its last compaction, with the patches saved
+    since then in NotebookPatch, so saving an edit only writes the edit. It is stored
+    compactly encoded by notebook_encoding, and encoded and decoded as it is set and
+    read through notebook_data.
+
     Inherits:
         Model: Django's base model class
 
     Attributes:
         user (User): The user who owns the notebook.
         notebook_name (str): The name of the notebook.
-        notebook_data (dict): The data of the notebook in JSON format.
+        notebook_data (str): The data of the notebook in JSON format, as of its last compaction.
+        encoded_data (bytes): The data of the notebook, encoded by encode_notebook.
         notebook_modified_at (datetime): The timestamp when the notebook was last modified.
+        revision (int): The number of times the notebook has been saved.
     """
 
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="entries")
     notebook_name = models.CharField(max_length=255)
-    notebook_data = models.JSONField()
+    encoded_data = models.BinaryField()
     notebook_modified_at = models.DateTimeField(
         auto_now=True
     )  # Automatically sets the timestamp
+    revision = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Lists a user's notebooks, most recently modified first
+            models.Index(
+                fields=["user", "-notebook_modified_at", "-id"],
+                name="notebook_listing_idx",
+            )
+        ]
+
+    @property
+    def notebook_data(self) -> str:
+        return decode_notebook(self.encoded_data)
+
+    @notebook_data.setter
+    def notebook_data(self, notebook_data: str | dict[str, Any]) -> None:
+        self.encoded_data = encode_notebook(notebook_data)
+
+    def contents(self) -> str:
+        """Get the notebook's data with the patches saved since its last compaction
+
+        Returns:
+            str: The serialised notebook
+        """
+        patches = list(
+            self.patches.order_by("revision").values_list("encoded_patch", flat=True)
+        )
+        if not patches:
+            return self.notebook_data
+        data = load_notebook_data(self.notebook_data)
+        for patch in patches:
+            apply_notebook_patch(data, decode_patch(patch))
+        return json.dumps(data, separators=(",", ":"))
+
+    def compact(self) -> None:
+        """Fold the patches saved since the last compaction into the notebook's data
+
+        Must be called in a transaction holding the notebook's row, so no patch is
+        saved in between.
+        """
+        self.notebook_data = self.contents()
+        Notebook.objects.filter(id=self.id).update(encoded_data=self.encoded_data)
+        self.patches.all().delete()
+
+
+class NotebookPatch(models.Model):
+    """model representing the changes made to a notebook by one save
+
+    The changes are stored compactly encoded by notebook_encoding, like the
+    notebook's data, and encoded and decoded as they are set and read through patch.
+
+    Inherits:
+        Model: Django's base model class
+
+    Attributes:
+        notebook (Notebook): The notebook that was changed.
+        revision (int): The notebook's revision once the patch is applied.
+        patch (dict): The changes, as applied by apply_notebook_patch.
+        encoded_patch (bytes): The changes, encoded by encode_patch.
+    """
+
+    notebook = models.ForeignKey(
+        Notebook, on_delete=models.CASCADE, related_name="patches"
+    )
+    revision = models.PositiveIntegerField()
+    encoded_patch = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["notebook", "revision"], name="notebook_patch_revision"
+            )
+        ]
+
+    @property
+    def patch(self) -> dict[str, Any]:
+        return decode_patch(self.encoded_patch)
+
+    @patch.setter
+    def patch(self, patch: dict[str, Any]) -> None:
+        self.encoded_patch = encode_patch(patch)
+
+
+def load_notebook_data(notebook_data: str | dict[str, Any]) -> dict[str, Any]:
+    """Parse a notebook's data, which the frontend saves serialised as a string
+
+    Args:
+        notebook_data (str | dict[str, Any]): The data, as stored
+
+    Raises:
+        ValueError: If the data is not a serialised JSON object
+
+    Returns:
+        dict[str, Any]: The notebook's pages and code_blocks
+    """
+    if isinstance(notebook_data, str):
+        notebook_data = json.loads(notebook_data)
+    if not isinstance(notebook_data, dict):
+        raise ValueError("The notebook's data is not a JSON object")
+    return notebook_data
+
+
+def apply_notebook_patch(data: dict[str, Any], patch: dict[str, Any]) -> None:
+    """Apply the changes of one save to a notebook's data, in place
+
+    A patch has any of the following fields:
+        - pages: The changed pages by key, each with the page's fields other than its
+          layers under "page", and its changed layers by index under "layers"
+        - page_order: The keys of the notebook's pages in order, dropping the
+          pages that are not listed
+        - code_blocks: The notebook's code blocks, replacing them all
+
+    Args:
+        data (dict[str, Any]): The notebook's pages and code_blocks
+        patch (dict[str, Any]): The changes, as parsed by views.parse_notebook_patch
+
+    Raises:
+        ValueError: If the patch does not apply to the notebook, which may then be
+            partly changed
+    """
+    # Keys are numbers in the notebook and strings in the patch's pages
+    pages = {str(key): page for key, page in data.get("pages", [])}
+    order = [key for key, _ in data.get("pages", [])]
+
+    for key, change in patch.get("pages", {}).items():
+        if key not in pages:
+            pages[key] = {"layers": []}
+            order.append(key)
+        page = pages[key]
+        if not isinstance(page, dict) or not isinstance(page.get("layers"), list):
+            raise ValueError(f"Page {key} of the notebook has no layers")
+        page.update(change.get("page", {}))
+        # Layers are changed in place or added after the last one
+        layers = change.get("layers", {}).items()
+        for index, layer in sorted(layers, key=lambda item: int(item[0])):
+            index = int(index)
+            if index > len(page["layers"]):
+                raise ValueError(f"Page {key} has no layer before layer {index}")
+            if index == len(page["layers"]):
+                page["layers"].append(layer)
+            else:
+                page["layers"][index] = layer
+
+    if "page_order" in patch:
+        order = [key for key in patch["page_order"] if str(key) in pages]
+    data["pages"] = [[key, pages[str(key)]] for key in order]
+    if "code_blocks" in patch:
+        data["code_blocks"] = patch["code_blocks"]
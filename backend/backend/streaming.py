@@ -0,0 +1,73 @@
+"""
+Streaming responses from async iterators under ASGI.
+
+Django 4.1's ASGIHandler iterates a StreamingHttpResponse synchronously, so an
+async view cannot stream what it awaits without blocking the event loop. An
+AsyncStreamingHttpResponse holds an async iterator instead, which
+StreamingASGIHandler (served by thesite/asgi.py) sends a chunk at a time.
+Django 4.2 supports async iterators in StreamingHttpResponse itself, so this
+module can go once the app is upgraded.
+"""
+
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+from django.core.handlers.asgi import ASGIHandler
+from django.http import HttpResponseBase, StreamingHttpResponse
+
+
+class AsyncStreamingHttpResponse(StreamingHttpResponse):
+    """A streaming response whose content is produced by an async iterator
+
+    Only StreamingASGIHandler sends the content; iterating the response
+    synchronously, as WSGI handlers and the test client do, gives nothing.
+
+    Attributes:
+        async_streaming_content (AsyncIterator[bytes | str]): The content
+    """
+
+    def __init__(
+        self, streaming_content: AsyncIterator[bytes | str], *args: Any, **kwargs: Any
+    ) -> None:
+        super().__init__((), *args, **kwargs)
+        self.async_streaming_content = streaming_content
+
+
+class StreamingASGIHandler(ASGIHandler):
+    """ASGIHandler that also sends AsyncStreamingHttpResponse content as it arrives"""
+
+    async def send_response(
+        self,
+        response: HttpResponseBase,
+        send: Callable[[dict[str, Any]], Awaitable[None]],
+    ) -> None:
+        """Encode and send a response out over ASGI
+
+        Args:
+            response (HttpResponseBase): The response
+            send (Callable[[dict[str, Any]], Awaitable[None]]): The ASGI send callable
+        """
+        if not isinstance(response, AsyncStreamingHttpResponse):
+            await super().send_response(response, send)
+            return
+
+        async def send_content(message: dict[str, Any]) -> None:
+            # The synchronous content is empty, so the base class follows the
+            # headers with the closing message straight away
+            if message["type"] == "http.response.body" and not message.get("more_body"):
+                content = response.async_streaming_content
+                try:
+                    async for part in content:
+                        for chunk, _ in self.chunk_bytes(response.make_bytes(part)):
+                            await send(
+                                {
+                                    "type": "http.response.body",
+                                    "body": chunk,
+                                    "more_body": True,
+                                }
+                            )
+                finally:
+                    if hasattr(content, "aclose"):
+                        await content.aclose()
+            await send(message)
+
+        await super().send_response(response, send_content)
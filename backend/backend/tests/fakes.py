@@ -0,0 +1,86 @@
+import asyncio
+import json
+import queue
+
+from websocket import WebSocketConnectionClosedException
+
+
+class FakeKernelSocket:
+    """Stand-in for a kernel channels websocket
+
+    Every execute request sent is answered with a stream message echoing the code
+    followed by an execute_reply, unless auto_reply is False. The reply's status is
+    "error" if the code starts with "raise".
+    """
+
+    def __init__(self, auto_reply: bool = True) -> None:
+        self.auto_reply = auto_reply
+        self.connected = True
+        self.sent = []
+        self.inbox = queue.Queue()
+
+    def push(self, parent: dict | None, msg_type: str, content: dict) -> None:
+        """Queue a message for the reader as if the kernel had sent it"""
+        self.inbox.put(
+            json.dumps(
+                {
+                    "msg_type": msg_type,
+                    "parent_header": parent or {},
+                    "content": content,
+                }
+            )
+        )
+
+    def send(self, payload: str) -> None:
+        if not self.connected:
+            raise WebSocketConnectionClosedException()
+        request = json.loads(payload)
+        self.sent.append(request)
+        if self.auto_reply:
+            header = request["header"]
+            self.push(
+                header,
+                "stream",
+                {"name": "stdout", "text": request["content"]["code"]},
+            )
+            status = "error" if request["content"]["code"].startswith("raise") else "ok"
+            self.push(header, "execute_reply", {"status": status})
+
+    def recv(self) -> str:
+        msg = self.inbox.get()
+        if msg is None:
+            raise WebSocketConnectionClosedException()
+        return msg
+
+    def close(self) -> None:
+        self.connected = False
+        self.inbox.put(None)
+
+
+class FakeAsyncKernelSocket:
+    """Asyncio counterpart of FakeKernelSocket, for the async views"""
+
+    def __init__(self) -> None:
+        self.sent = []
+        self.inbox = asyncio.Queue()
+
+    async def send(self, payload: str) -> None:
+        request = json.loads(payload)
+        self.sent.append(request)
+        header = request["header"]
+        for msg_type, content in (
+            ("stream", {"name": "stdout", "text": request["content"]["code"]}),
+            ("execute_reply", {"status": "ok"}),
+        ):
+            self.inbox.put_nowait(
+                json.dumps(
+                    {"msg_type": msg_type, "parent_header": header, "content": content}
+                )
+            )
+
+    async def __aiter__(self):
+        while (msg := await self.inbox.get()) is not None:
+            yield msg
+
+    async def close(self) -> None:
+        self.inbox.put_nowait(None)
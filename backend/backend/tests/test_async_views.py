@@ -0,0 +1,227 @@
+import json
+from io import BytesIO
+from unittest.mock import AsyncMock, patch
+
+import httpx
+from django.contrib.auth.models import AnonymousUser, User
+from django.test import RequestFactory, TestCase, override_settings
+from PIL import Image
+
+from backend import async_views, handwriting, jupyter
+from backend.streaming import AsyncStreamingHttpResponse
+from backend.tests.fakes import FakeAsyncKernelSocket
+
+
+@override_settings(
+    JUPYTER_URL="jupyter",
+    JUPYTER_PORT="8888",
+    HANDWRITING_HEALTH_INTERVAL=0,
+    KERNEL_STANDBY_POOL={},
+    KERNEL_REAP_INTERVAL=0,
+)
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(username="testuser", password="12345")
+
+    def tearDown(self):
+        jupyter.get_client().kernels.clear()
+        handwriting.get_transcription_cache().clear()
+        handwriting.get_circuit_breaker().record_success()
+
+    def post(self, data):
+        request = self.factory.post("/", data)
+        request.user = self.user
+        return request
+
+    @patch("backend.async_jupyter.connect", new_callable=AsyncMock)
+    @patch("httpx.AsyncClient.request", new_callable=AsyncMock)
+    async def test_execute(self, mock_request, mock_connect):
+        mock_request.return_value = httpx.Response(
+            200,
+            json=[
+                {
+                    "path": f"enscribe/{self.user.pk}/python3",
+                    "kernel": {"id": "kernel-1"},
+                }
+            ],
+        )
+        mock_connect.return_value = FakeAsyncKernelSocket()
+
+        for _ in range(2):
+            response = await async_views.execute(
+                self.post({"language": "python3", "code": "1 + 1"})
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.content,
+            b'{"output_stream": [{"success": true, "type": "text", "content": "1 + 1"}]}',
+        )
+        # The kernel lookup and websocket are reused by the warm run
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertEqual(mock_connect.call_count, 1)
+
+    @patch("backend.async_jupyter.connect", new_callable=AsyncMock)
+    async def test_execute_batch(self, mock_connect):
+        jupyter.get_client().kernels.set(self.user.pk, "python3", "kernel-1")
+        jupyter.get_client().kernels.set(self.user.pk, "lambda-calculus", "kernel-2")
+        sockets = []
+        mock_connect.side_effect = lambda *args, **kwargs: (
+            sockets.append(FakeAsyncKernelSocket()) or sockets[-1]
+        )
+        blocks = [
+            {"id": "a", "language": "python3", "code": "1"},
+            {"id": "b", "language": "python3", "code": "2"},
+            {"id": "c", "language": "lambda-calculus", "code": "x"},
+        ]
+
+        response = await async_views.execute_batch(
+            self.post({"blocks": json.dumps(blocks)})
+        )
+
+        results = json.loads(response.content)["blocks"]
+        self.assertEqual(list(results), ["a", "b", "c"])
+        self.assertEqual(
+            [results[block_id]["status"] for block_id in results], ["ok", "ok", "ok"]
+        )
+        self.assertEqual(results["c"]["output_stream"][0]["content"], "x")
+        # The python3 blocks are sent together on one websocket
+        self.assertEqual([len(socket.sent) for socket in sockets], [2, 1])
+
+    async def read_stream(self, response):
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        parts = [part async for part in response.async_streaming_content]
+        return "".join(parts).split("\n\n")[:-1]
+
+    @patch("backend.async_jupyter.connect", new_callable=AsyncMock)
+    async def test_execute_stream(self, mock_connect):
+        jupyter.get_client().kernels.set(self.user.pk, "python3", "kernel-1")
+        mock_connect.return_value = FakeAsyncKernelSocket()
+
+        response = await async_views.execute_stream(
+            self.post({"language": "python3", "code": "1 + 1"})
+        )
+
+        self.assertIsInstance(response, AsyncStreamingHttpResponse)
+        self.assertEqual(
+            await self.read_stream(response),
+            [
+                'event: output\ndata: {"success": true, "type": "text", '
+                '"content": "1 + 1"}',
+                'event: status\ndata: {"status": "ok"}',
+            ],
+        )
+
+    @patch("backend.async_jupyter.connect", new_callable=AsyncMock)
+    async def test_execute_batch_stream(self, mock_connect):
+        jupyter.get_client().kernels.set(self.user.pk, "python3", "kernel-1")
+        mock_connect.side_effect = lambda *args, **kwargs: FakeAsyncKernelSocket()
+        blocks = [
+            {"id": "a", "language": "python3", "code": "1"},
+            {"id": "b", "language": "python3", "code": "2"},
+        ]
+
+        response = await async_views.execute_batch_stream(
+            self.post({"blocks": json.dumps(blocks)})
+        )
+
+        events = await self.read_stream(response)
+        self.assertEqual(
+            [event for event in events if event.startswith("event: status")],
+            [
+                'event: status\ndata: {"id": "a", "status": "ok"}',
+                'event: status\ndata: {"id": "b", "status": "ok"}',
+            ],
+        )
+        self.assertIn('data: {"id": "a", "output": {', events[0])
+
+    @patch("httpx.AsyncClient.request", new_callable=AsyncMock)
+    async def test_execute_stream_jupyter_unavailable(self, mock_request):
+        mock_request.side_effect = httpx.ConnectError("refused")
+
+        response = await async_views.execute_stream(
+            self.post({"language": "python3", "code": "1 + 1"})
+        )
+
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertIn(b"Jupyter Server Error", response.content)
+        self.assertTrue(
+            response.content.endswith(b'event: status\ndata: {"status": "error"}\n\n')
+        )
+
+    @patch("httpx.AsyncClient.request", new_callable=AsyncMock)
+    async def test_restart_kernel(self, mock_request):
+        jupyter.get_client().kernels.set(self.user.pk, "python3", "kernel-1")
+        mock_request.return_value = httpx.Response(200)
+
+        response = await async_views.restart_kernel(self.post({"language": "python3"}))
+
+        self.assertEqual(response.content, b"Restarted Kernel")
+        mock_request.assert_called_once_with("POST", "/api/kernels/kernel-1/restart")
+
+    @patch("httpx.AsyncClient.post", new_callable=AsyncMock)
+    async def test_image_to_text(self, mock_post):
+        mock_post.return_value = httpx.Response(
+            200,
+            json={
+                "top_preds": [["a", "b", "c"], ["b", "a", "c"]],
+                "top_probs": [[0.8, 0.1, 0.1], [0.9, 0.05, 0.05]],
+            },
+        )
+        buffer = BytesIO()
+        Image.new("RGBA", (100, 30), (255, 255, 255, 128)).save(buffer, format="PNG")
+        buffer.seek(0)
+        buffer.name = "img.png"
+
+        response = await async_views.image_to_text(
+            self.post({"model_name": "default", "img": buffer})
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'"predicted_text": "ab"', response.content)
+
+        buffer.seek(0)
+        cached = await async_views.image_to_text(
+            self.post({"model_name": "default", "img": buffer})
+        )
+
+        self.assertEqual(cached.content, response.content)
+        mock_post.assert_called_once()
+
+    @patch("httpx.AsyncClient.post", new_callable=AsyncMock)
+    async def test_image_to_text_batch(self, mock_post):
+        mock_post.return_value = httpx.Response(
+            200, json={"top_preds": [["a"]], "top_probs": [[1.0]]}
+        )
+        images = {}
+        for block_id, width in [("block-1", 20), ("block-2", 30)]:
+            buffer = BytesIO()
+            img = Image.new("RGBA", (100, 30), (0, 0, 0, 0))
+            img.paste((0, 0, 0, 255), (10, 10, width, 20))
+            img.save(buffer, format="PNG")
+            buffer.seek(0)
+            buffer.name = f"{block_id}.png"
+            images[block_id] = buffer
+        blocks = [
+            {"id": "block-1", "model_name": "default"},
+            {"id": "block-2", "model_name": "default"},
+        ]
+
+        response = await async_views.image_to_text_batch(
+            self.post({"blocks": json.dumps(blocks), **images})
+        )
+
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)["blocks"]
+        self.assertEqual(list(results), ["block-1", "block-2"])
+        self.assertEqual(results["block-2"]["predicted_text"], "a")
+        self.assertEqual(mock_post.call_count, 2)
+
+    async def test_login_required(self):
+        request = self.factory.post("/execute/")
+        request.user = AnonymousUser()
+
+        response = await async_views.execute(request)
+
+        self.assertEqual(response.status_code, 302)
@@ -0,0 +1,57 @@
+from django.test import SimpleTestCase, override_settings
+
+from backend.fake_jupyter import FakeJupyterServer, serve
+from backend.jupyter import JupyterClient, KernelNotFound
+
+
+@override_settings(
+    KERNEL_STANDBY_POOL={"python3": 1},
+    KERNEL_MAX_COUNT=0,
+    KERNEL_MAX_PER_LANGUAGE={},
+    EXECUTION_DEADLINES={"python3": 0.5},
+)
+class FakeJupyterTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.app = FakeJupyterServer(output_messages=2, output_size=4)
+        cls.server, cls.port = serve(cls.app)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.should_exit = True
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client = JupyterClient("127.0.0.1", self.port, "token")
+
+    def tearDown(self):
+        self.client.channels.close_all()
+
+    def test_execute_on_standby_kernel(self):
+        self.client.standby.fill("python3")
+        (standby_id,) = self.client.standby.kernel_ids()
+
+        outputs = list(
+            self.client.execute("user-1", "python3", "ab").outputs("python3")
+        )
+
+        self.assertEqual([output["content"] for output in outputs], ["abxx", "abxx"])
+        self.assertEqual(self.client.find_kernel("user-1", "python3"), standby_id)
+
+    def test_batch_stops_on_error(self):
+        blocks = [
+            {"id": "a", "language": "python3", "code": "raise 1"},
+            {"id": "b", "language": "python3", "code": "b"},
+        ]
+
+        events = list(self.client.execute_batch("user-2", blocks, stop_on_error=True))
+
+        self.assertEqual(
+            [event[1:] for event in events if event[0] == "status"],
+            [("a", "error"), ("b", "skipped")],
+        )
+
+    def test_connecting_to_missing_kernel(self):
+        with self.assertRaises(KernelNotFound):
+            self.client.connect("missing")
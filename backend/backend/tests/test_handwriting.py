@@ -0,0 +1,423 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock, patch
+
+import requests
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, override_settings
+
+from backend.apps import check_shared_caches
+from backend.handwriting import (
+    CircuitBreaker,
+    CircuitOpen,
+    HandwritingClient,
+    HandwritingError,
+    HandwritingRouter,
+    QueueFull,
+    TranscriptionCache,
+    TranscriptionQueue,
+)
+
+
+@override_settings(
+    CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "transcriptions": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "transcriptions",
+        },
+    },
+    TRANSCRIPTION_CACHE_SIZE=2,
+    TRANSCRIPTION_CACHE_ALIAS=None,
+)
+class TranscriptionCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = TranscriptionCache()
+        self.transcription = {"predicted_text": "a", "predictions": {}}
+
+    def tearDown(self):
+        caches["transcriptions"].clear()
+
+    def test_key_depends_on_image_and_model(self):
+        key = self.cache.key(b"image", "default")
+
+        self.assertEqual(key, self.cache.key(b"image", "default"))
+        self.assertNotEqual(key, self.cache.key(b"image", "other"))
+        self.assertNotEqual(key, self.cache.key(b"other", "default"))
+
+    def test_evicts_least_recently_used(self):
+        for key in ("a", "b"):
+            self.cache.set(key, self.transcription)
+        self.cache.get("a")
+        self.cache.set("c", self.transcription)
+
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("a"), self.transcription)
+        self.assertEqual(
+            self.cache.stats(), {"hits": 2, "shared_hits": 0, "misses": 1, "size": 2}
+        )
+
+    @override_settings(TRANSCRIPTION_CACHE_ALIAS="transcriptions")
+    def test_shared_tier_is_used_across_processes(self):
+        self.cache.set("a", self.transcription)
+        other_process = TranscriptionCache()
+
+        self.assertEqual(other_process.get("a"), self.transcription)
+        self.assertEqual(other_process.get("a"), self.transcription)
+        self.assertIsNone(other_process.get("b"))
+        self.assertEqual(
+            other_process.stats(),
+            {"hits": 1, "shared_hits": 1, "misses": 1, "size": 1},
+        )
+
+
+def handwriting_response(status_code, body=b""):
+    return MagicMock(status_code=status_code, content=body)
+
+
+PREDICTIONS = {"top_preds": [["a"]], "top_probs": [[1.0]]}
+
+
+@override_settings(
+    HANDWRITING_RETRIES=2,
+    HANDWRITING_RETRY_BACKOFF=0,
+    HANDWRITING_BREAKER_THRESHOLD=2,
+    HANDWRITING_BREAKER_RESET=30,
+)
+class HandwritingClientTests(SimpleTestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker()
+        self.client = HandwritingClient(
+            HandwritingRouter(["handwriting:5000"]),
+            self.breaker,
+            timeout=(1, 5),
+            pool_size=2,
+            concurrency=2,
+        )
+
+    @patch("requests.Session.post")
+    def test_retries_gateway_errors(self, mock_post):
+        mock_post.side_effect = [
+            handwriting_response(503),
+            handwriting_response(200, json.dumps(PREDICTIONS).encode()),
+        ]
+
+        self.assertEqual(self.client.transcribe(b"image", "default"), PREDICTIONS)
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(self.breaker.failures, 0)
+        self.assertEqual(mock_post.call_args.kwargs["timeout"], (1, 5))
+
+    @patch("requests.Session.post")
+    def test_does_not_retry_read_timeouts(self, mock_post):
+        mock_post.side_effect = requests.exceptions.ReadTimeout()
+
+        with self.assertRaisesMessage(HandwritingError, "timed out"):
+            self.client.transcribe(b"image", "default")
+        self.assertEqual(mock_post.call_count, 1)
+
+    @patch("requests.Session.post")
+    def test_rejects_malformed_responses(self, mock_post):
+        mock_post.return_value = handwriting_response(200, b'{"top_preds": []}')
+
+        with self.assertRaisesMessage(HandwritingError, "invalid response"):
+            self.client.transcribe(b"image", "default")
+        self.assertEqual(mock_post.call_count, 1)
+
+    @patch("requests.Session.post")
+    def test_client_errors_leave_circuit_closed(self, mock_post):
+        mock_post.return_value = handwriting_response(422)
+
+        for _ in range(3):
+            with self.assertRaises(HandwritingError) as raised:
+                self.client.transcribe(b"image", "unknown-model")
+            self.assertTrue(raised.exception.client_error)
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertEqual(self.breaker.failures, 0)
+        self.breaker.before_call()
+
+    @patch("time.sleep")
+    def test_fails_retryably_without_replicas(self, mock_sleep):
+        client = HandwritingClient(
+            HandwritingRouter([]),
+            self.breaker,
+            timeout=(1, 5),
+            pool_size=2,
+            concurrency=2,
+        )
+
+        with self.assertRaisesMessage(HandwritingError, "No handwriting server") as cm:
+            client.transcribe(b"image", "default")
+        self.assertTrue(cm.exception.retryable)
+
+    @patch("time.monotonic")
+    @patch("requests.Session.post")
+    def test_circuit_opens_after_repeated_failures(self, mock_post, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        mock_post.side_effect = requests.exceptions.ConnectionError()
+
+        for _ in range(2):
+            with self.assertRaises(HandwritingError):
+                self.client.transcribe(b"image", "default")
+        self.assertEqual(mock_post.call_count, 6)
+
+        with self.assertRaises(CircuitOpen) as raised:
+            self.client.transcribe(b"image", "default")
+        self.assertEqual(raised.exception.retry_after, 30)
+        self.assertEqual(mock_post.call_count, 6)
+
+        # Once the server has had time to recover, one trial request is let through
+        mock_monotonic.return_value = 130.0
+        mock_post.side_effect = None
+        mock_post.return_value = handwriting_response(
+            200, json.dumps(PREDICTIONS).encode()
+        )
+        self.breaker.before_call()
+        with self.assertRaises(CircuitOpen):
+            self.client.transcribe(b"image", "default")
+
+        self.breaker.record_success()
+        self.assertEqual(self.client.transcribe(b"image", "default"), PREDICTIONS)
+
+
+class StubReplica(ThreadingHTTPServer):
+    """Handwriting server replica transcribing every image as its name"""
+
+    def __init__(self, name, delay=0.0):
+        super().__init__(("127.0.0.1", 0), StubReplicaHandler)
+        self.name = name
+        self.delay = delay
+        self.transcribed = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def address(self):
+        return f"127.0.0.1:{self.server_address[1]}"
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubReplicaHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(self.server.delay)
+        self.server.transcribed += 1
+        body = json.dumps({"top_preds": [[self.server.name]], "top_probs": [[1.0]]})
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, format, *args):
+        pass
+
+
+@override_settings(
+    HANDWRITING_RETRIES=0,
+    HANDWRITING_BREAKER_THRESHOLD=100,
+    HANDWRITING_MODEL_LOAD_PENALTY=2,
+    HANDWRITING_HEALTH_PATH="/",
+    HANDWRITING_HEALTH_TIMEOUT=1,
+)
+class HandwritingRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.replicas = [StubReplica("a", delay=0.2), StubReplica("b", delay=0.2)]
+        for replica in self.replicas:
+            self.addCleanup(replica.stop)
+        self.router = HandwritingRouter([replica.address for replica in self.replicas])
+        self.client = HandwritingClient(
+            self.router, CircuitBreaker(), timeout=(1, 5), pool_size=4, concurrency=4
+        )
+
+    def test_balances_outstanding_requests(self):
+        threads = [
+            threading.Thread(target=self.client.transcribe, args=(b"image", "default"))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([replica.transcribed for replica in self.replicas], [2, 2])
+        self.assertEqual(
+            [replica.outstanding for replica in self.router.replicas], [0, 0]
+        )
+
+    def test_caps_concurrent_transcriptions(self):
+        client = HandwritingClient(
+            self.router, CircuitBreaker(), timeout=(1, 5), pool_size=4, concurrency=1
+        )
+        lock = threading.Lock()
+        in_flight = peak = 0
+        post = client._post
+
+        def counting_post(*args):
+            nonlocal in_flight, peak
+            with lock:
+                in_flight += 1
+                peak = max(peak, in_flight)
+            try:
+                return post(*args)
+            finally:
+                with lock:
+                    in_flight -= 1
+
+        client._post = counting_post
+        threads = [
+            threading.Thread(target=client.transcribe, args=(b"image", "default"))
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sum(replica.transcribed for replica in self.replicas), 3)
+        self.assertEqual(peak, 1)
+
+    def test_prefers_replicas_with_model_loaded(self):
+        for replica in self.replicas:
+            replica.delay = 0
+
+        names = {
+            self.client.transcribe(b"image", "default")["top_preds"][0][0]
+            for _ in range(5)
+        }
+
+        self.assertEqual(len(names), 1)
+
+    def test_fails_over_when_replica_stops(self):
+        self.replicas[0].stop()
+        # Requests prefer the stopped replica until it is marked down
+        self.router.replicas[0].models.add("default")
+
+        for _ in range(4):
+            predictions = self.client.transcribe(b"image", "default")
+            self.assertEqual(predictions["top_preds"], [["b"]])
+
+        self.assertFalse(self.router.replicas[0].healthy)
+        self.assertTrue(self.router.replicas[1].healthy)
+
+    def test_health_checks(self):
+        self.replicas[0].stop()
+        self.router.mark_down(self.router.replicas[1])
+
+        self.router.check_health()
+
+        self.assertEqual(
+            [replica.healthy for replica in self.router.replicas], [False, True]
+        )
+
+
+@override_settings(
+    TRANSCRIPTION_WORKERS=1,
+    TRANSCRIPTION_QUEUE_SIZE=1,
+    TRANSCRIPTION_JOB_CACHE_ALIAS="default",
+)
+class TranscriptionQueueTests(SimpleTestCase):
+    def setUp(self):
+        self.queue = TranscriptionQueue()
+
+    def wait(self, job_id, user_id=1):
+        for _ in range(100):
+            job = self.queue.get(job_id, user_id)
+            if job["status"] in ("done", "failed"):
+                return job
+            time.sleep(0.01)
+        self.fail("Job did not finish")
+
+    def test_several_workers_refuse_a_process_local_job_cache(self):
+        with override_settings(WEB_CONCURRENCY=2):
+            with self.assertRaisesMessage(
+                ImproperlyConfigured, "TRANSCRIPTION_JOB_CACHE_ALIAS"
+            ):
+                check_shared_caches()
+        check_shared_caches()
+
+        with override_settings(
+            WEB_CONCURRENCY=2,
+            CACHES={
+                "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+                "shared": {
+                    "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                    "LOCATION": "/tmp/enscribe-test-cache",
+                },
+            },
+            TRANSCRIPTION_JOB_CACHE_ALIAS="shared",
+        ):
+            check_shared_caches()
+
+    def test_refuses_jobs_beyond_queue_size(self):
+        release = threading.Event()
+
+        def transcribe():
+            release.wait(5)
+            return {"predicted_text": "a"}
+
+        running = self.queue.submit(1, transcribe)
+        queued = self.queue.submit(1, transcribe)
+        with self.assertRaises(QueueFull) as raised:
+            self.queue.submit(1, transcribe)
+        self.assertEqual(raised.exception.retry_after, self.queue.average_duration)
+        self.assertEqual(self.queue.get(queued, 1), {"status": "queued"})
+
+        release.set()
+
+        for job_id in (running, queued):
+            self.assertEqual(
+                self.wait(job_id),
+                {"status": "done", "transcription": {"predicted_text": "a"}},
+            )
+        # There is room once the jobs have finished
+        self.wait(self.queue.submit(1, transcribe))
+
+    def test_reports_failures(self):
+        def transcribe():
+            raise HandwritingError("Handwriting server timed out")
+
+        job_id = self.queue.submit(1, transcribe)
+
+        self.assertEqual(
+            self.wait(job_id),
+            {"status": "failed", "error": "Handwriting server timed out"},
+        )
+
+    def test_jobs_belong_to_their_user(self):
+        job_id = self.queue.submit(1, lambda: {"predicted_text": "a"})
+        self.wait(job_id)
+
+        self.assertIsNone(self.queue.get(job_id, 2))
+        self.assertIsNone(self.queue.get("missing", 1))
+
+    def test_newer_speculation_supersedes_queued_one(self):
+        release = threading.Event()
+
+        def transcribe():
+            release.wait(5)
+            return {"predicted_text": "a"}
+
+        running = self.queue.submit(1, transcribe)
+        superseded = self.queue.speculate(1, "block", "ink", transcribe)
+        # The same ink keeps its job
+        self.assertEqual(
+            self.queue.speculate(1, "block", "ink", transcribe), superseded
+        )
+        latest = self.queue.speculate(1, "block", "new ink", transcribe)
+
+        self.assertEqual(self.queue.get(superseded, 1), {"status": "cancelled"})
+        release.set()
+        self.wait(running)
+        self.wait(latest)
+        self.assertIsNone(self.queue.claim_speculation(1, "block", "ink"))
+        self.assertEqual(self.queue.claim_speculation(1, "block", "new ink"), latest)
+        # Claimed jobs are not handed out twice
+        self.assertIsNone(self.queue.claim_speculation(1, "block", "new ink"))
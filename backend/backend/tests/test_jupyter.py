@@ -0,0 +1,361 @@
+import threading
+from datetime import datetime, timezone
+from unittest.mock import MagicMock
+
+from django.test import SimpleTestCase, override_settings
+
+from backend.jupyter import (
+    JupyterError,
+    KernelCache,
+    KernelChannel,
+    KernelReaper,
+    ResultCache,
+    StandbyPool,
+)
+from backend.utils import OutputLimiter
+from backend.tests.fakes import FakeKernelSocket
+
+
+class KernelChannelTests(SimpleTestCase):
+    def setUp(self):
+        self.sockets = []
+        self.client = MagicMock(kernels=KernelCache())
+        self.client.connect.side_effect = self.connect
+        self.channel = KernelChannel(self.client, "kernel-1")
+
+    def tearDown(self):
+        self.channel.close()
+
+    def connect(self, kernel_id):
+        socket = FakeKernelSocket(auto_reply=False)
+        self.sockets.append(socket)
+        return socket
+
+    def test_messages_are_routed_by_parent_msg_id(self):
+        first = self.channel.execute("a")
+        second = self.channel.execute("b")
+        socket = self.sockets[0]
+        first_header, second_header = (request["header"] for request in socket.sent)
+
+        # Interleave the two requests' output on the shared websocket
+        socket.push(second_header, "stream", {"text": "b"})
+        socket.push(first_header, "stream", {"text": "a"})
+        socket.push(None, "status", {"execution_state": "busy"})
+        socket.push(second_header, "execute_reply", {})
+        socket.push(first_header, "execute_reply", {})
+
+        for execution, text in ((first, "a"), (second, "b")):
+            with execution:
+                messages = iter(execution)
+                rsp = next(messages)
+                self.assertEqual(rsp["content"]["text"], text)
+                self.assertEqual(next(messages)["msg_type"], "execute_reply")
+
+        self.assertEqual(len(self.sockets), 1)
+
+    def test_concurrent_executions_share_one_websocket(self):
+        results = {}
+
+        def run(code):
+            with self.channel.execute(code) as execution:
+                rsp = next(iter(execution))
+                results[code] = rsp["content"]["text"]
+
+        self.client.connect.side_effect = lambda kernel_id: (
+            self.sockets.append(FakeKernelSocket()) or self.sockets[-1]
+        )
+        threads = [threading.Thread(target=run, args=(str(i),)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=5)
+
+        self.assertEqual(results, {str(i): str(i) for i in range(8)})
+        self.assertEqual(len(self.sockets), 1)
+
+    def test_reconnects_after_websocket_drops(self):
+        self.channel.execute("a").close()
+        self.sockets[0].close()
+
+        self.channel.execute("b").close()
+
+        self.assertEqual(len(self.sockets), 2)
+        self.assertEqual(self.sockets[1].sent[0]["content"]["code"], "b")
+
+    def test_waiting_requests_are_woken_when_websocket_drops(self):
+        execution = self.channel.execute("a")
+        self.sockets[0].close()
+
+        with self.assertRaises(JupyterError):
+            next(iter(execution))
+
+    def test_kernel_death_is_broadcast_and_invalidates_cache(self):
+        self.client.kernels.set(1, "python3", "kernel-1")
+        execution = self.channel.execute("a")
+        self.sockets[0].push(None, "status", {"execution_state": "dead"})
+
+        rsp = next(iter(execution))
+
+        self.assertEqual(rsp["content"]["execution_state"], "dead")
+        self.assertIsNone(self.client.kernels.get(1, "python3"))
+        self.client.reaper.forget.assert_called_once_with("kernel-1")
+        self.client.results.forget.assert_called_once_with("kernel-1")
+
+
+@override_settings(KERNEL_STANDBY_POOL={"python3": 2})
+class StandbyPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.started = iter(range(100))
+        self.client = MagicMock()
+        self.client.start_kernel.side_effect = lambda language: {
+            "id": f"{language}-{next(self.started)}"
+        }
+        self.pool = StandbyPool(self.client)
+        self.pool.refill = MagicMock()
+
+    def test_fill_starts_configured_number_of_kernels(self):
+        self.pool.fill("python3")
+        self.pool.fill("dyalog_apl")
+
+        self.assertEqual(self.pool.kernel_ids(), {"python3-0", "python3-1"})
+
+    def test_take_hands_out_ready_kernel_and_refills(self):
+        self.pool.fill("python3")
+
+        first = self.pool.take("python3")
+        second = self.pool.take("python3")
+
+        self.assertEqual({first, second}, {"python3-0", "python3-1"})
+        self.assertIsNone(self.pool.take("python3"))
+        self.pool.refill.assert_called_with("python3")
+
+    def test_put_returns_unused_kernel(self):
+        self.pool.put("python3", "kernel-1")
+        self.pool.put("python3", None)
+
+        self.assertEqual(self.pool.take("python3"), "kernel-1")
+        self.assertIsNone(self.pool.take("python3"))
+
+
+@override_settings(
+    KERNEL_IDLE_TTL=60,
+    KERNEL_MAX_COUNT=0,
+    KERNEL_MAX_PER_LANGUAGE={},
+    KERNEL_STANDBY_POOL={},
+)
+class KernelReaperTests(SimpleTestCase):
+    def setUp(self):
+        self.client = MagicMock(kernels=KernelCache())
+        self.client.standby = StandbyPool(self.client)
+        self.client.list_sessions.return_value = []
+        self.reaper = self.client.reaper = KernelReaper(self.client)
+        self.client.results = ResultCache()
+        self.kernels = []
+        self.client.list_kernels.side_effect = lambda: list(self.kernels)
+        self.client.shutdown_kernel.side_effect = self.shutdown
+
+    def shutdown(self, kernel_id):
+        self.kernels = [kernel for kernel in self.kernels if kernel["id"] != kernel_id]
+
+    def add_kernel(self, kernel_id, name="python3", idle=0, state="idle"):
+        self.kernels.append({"id": kernel_id, "name": name, "execution_state": state})
+        self.reaper.touch(kernel_id)
+        self.reaper._last_used[kernel_id] -= idle
+
+    def test_sweep_shuts_down_idle_kernels(self):
+        self.add_kernel("fresh", idle=10)
+        self.add_kernel("stale", idle=120)
+        self.add_kernel("busy", idle=120, state="busy")
+        self.add_kernel("standby", idle=120)
+        self.client.standby.put("python3", "standby")
+        self.client.kernels.set(1, "python3", "stale")
+
+        self.assertEqual(self.reaper.sweep(), ["stale"])
+        self.assertIsNone(self.client.kernels.get(1, "python3"))
+        self.client.channels.discard.assert_called_once_with("stale")
+
+    def test_shutdown_forgets_kernel_bookkeeping(self):
+        self.add_kernel("old")
+        self.client.results.bump("old")
+
+        self.reaper.shutdown("old")
+
+        self.assertNotIn("old", self.reaper._last_used)
+        self.assertNotIn("old", self.client.results._generations)
+
+    def test_jupyter_activity_counts_as_use(self):
+        self.add_kernel("kernel-1", idle=120)
+        self.kernels[0]["last_activity"] = datetime.now(timezone.utc).isoformat()
+
+        self.assertEqual(self.reaper.sweep(), [])
+
+    @override_settings(KERNEL_MAX_COUNT=3)
+    def test_make_room_evicts_least_recently_used(self):
+        self.add_kernel("old", idle=30)
+        self.add_kernel("busy", idle=40, state="busy")
+        self.add_kernel("new", name="dyalog_apl", idle=5)
+
+        self.assertEqual(self.reaper.make_room("python3"), ["old"])
+        self.assertTrue(self.reaper.has_room("python3"))
+
+    @override_settings(KERNEL_MAX_PER_LANGUAGE={"python3": 1})
+    def test_sweep_enforces_per_language_budget(self):
+        self.add_kernel("apl", name="dyalog_apl", idle=50)
+        self.add_kernel("old", idle=30)
+        self.add_kernel("new", idle=5)
+
+        self.assertEqual(self.reaper.sweep(), ["old"])
+        self.assertFalse(self.reaper.has_room("python3"))
+        self.assertTrue(self.reaper.has_room("dyalog_apl"))
+
+
+@override_settings(
+    EXECUTION_CACHE_LANGUAGES=["lambda-calculus"], EXECUTION_CACHE_SIZE=2
+)
+class ResultCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = ResultCache()
+        self.output = [{"success": True, "type": "text", "content": "y"}]
+
+    def test_only_configured_languages_are_cached(self):
+        self.assertIsNone(self.cache.key("kernel-1", "python3", "1"))
+
+    def test_keys_ignore_only_trailing_whitespace_and_line_endings(self):
+        self.assertEqual(
+            self.cache.key("kernel-1", "lambda-calculus", "a \r\n  b\t\n\n"),
+            self.cache.key("kernel-1", "lambda-calculus", "a\n  b"),
+        )
+        self.assertNotEqual(
+            self.cache.key("kernel-1", "lambda-calculus", "a\n  b"),
+            self.cache.key("kernel-1", "lambda-calculus", "a\nb"),
+        )
+        self.assertNotEqual(
+            self.cache.key("kernel-1", "lambda-calculus", "a b"),
+            self.cache.key("kernel-1", "lambda-calculus", "ab"),
+        )
+
+    def test_running_code_forgets_earlier_results(self):
+        first = self.cache.record_run("kernel-1", "lambda-calculus", "x")
+        self.cache.set(first, self.output)
+        self.assertIsNotNone(
+            self.cache.get(self.cache.key("kernel-1", "lambda-calculus", "x"))
+        )
+
+        second = self.cache.record_run("kernel-1", "lambda-calculus", "y")
+        # The first run finishing late is not cached either
+        self.cache.set(first, self.output)
+        self.cache.set(second, self.output)
+
+        self.assertIsNone(
+            self.cache.get(self.cache.key("kernel-1", "lambda-calculus", "x"))
+        )
+        self.assertIsNotNone(
+            self.cache.get(self.cache.key("kernel-1", "lambda-calculus", "y"))
+        )
+
+    def test_evicts_least_recently_used(self):
+        keys = [self.cache.key("kernel-1", "lambda-calculus", str(i)) for i in range(3)]
+        self.cache.set(keys[0], self.output)
+        self.cache.set(keys[1], self.output)
+        self.cache.get(keys[0])
+        self.cache.set(keys[2], self.output)
+
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.assertIsNone(self.cache.get(keys[1]))
+        self.assertEqual(list(self.cache.get(keys[2]).outputs("")), self.output)
+
+    def test_restart_forgets_kernel_results(self):
+        key = self.cache.key("kernel-1", "lambda-calculus", "x")
+        other = self.cache.key("kernel-2", "lambda-calculus", "x")
+        self.cache.set(key, self.output)
+        self.cache.set(other, self.output)
+
+        self.cache.bump("kernel-1")
+        # A result from before the restart arriving late is not cached
+        self.cache.set(key, self.output)
+
+        self.assertIsNone(
+            self.cache.get(self.cache.key("kernel-1", "lambda-calculus", "x"))
+        )
+        self.assertIsNotNone(self.cache.get(other))
+
+
+@override_settings(
+    EXECUTION_DEADLINES={"python3": 0.05},
+    EXECUTION_RECV_TIMEOUT=0.05,
+    EXECUTION_OUTPUT_LIMIT=10,
+)
+class ExecutionLimitTests(SimpleTestCase):
+    def setUp(self):
+        self.socket = FakeKernelSocket(auto_reply=False)
+        self.client = MagicMock(kernels=KernelCache())
+        self.client.connect.return_value = self.socket
+        self.channel = KernelChannel(self.client, "kernel-1")
+
+    def tearDown(self):
+        self.channel.close()
+
+    def run_outputs(self, execution):
+        outputs = execution.outputs("python3")
+        items = []
+        while True:
+            try:
+                items.append(next(outputs))
+            except StopIteration as stop:
+                return items, stop.value
+
+    def test_deadline_interrupts_kernel(self):
+        execution = self.channel.execute("while True: pass")
+        header = self.socket.sent[0]["header"]
+        # The kernel replies once interrupted
+        self.client.interrupt_kernel.side_effect = lambda kernel_id: (
+            self.socket.push(header, "execute_reply", {"status": "error"})
+        )
+
+        items, status = self.run_outputs(execution)
+
+        self.client.interrupt_kernel.assert_called_once_with("kernel-1")
+        self.assertEqual(status, "timeout")
+        self.assertIn("interrupted after 0.05 seconds", items[0]["content"])
+
+    def test_gives_up_when_kernel_ignores_interrupt(self):
+        execution = self.channel.execute("while True: pass")
+
+        items, status = self.run_outputs(execution)
+
+        self.assertEqual(status, "timeout")
+        self.assertIn("not responding", items[-1]["content"])
+        self.assertEqual(self.channel._waiters, {})
+
+    def test_output_is_capped(self):
+        execution = self.channel.execute("print('x' * 100)")
+        header = self.socket.sent[0]["header"]
+        for _ in range(3):
+            self.socket.push(header, "stream", {"text": "0123456789abc"})
+        self.socket.push(header, "execute_reply", {"status": "ok"})
+
+        items, status = self.run_outputs(execution)
+
+        self.assertEqual(status, "ok")
+        self.assertEqual([item["content"] for item in items][0], "0123456789")
+        self.assertIn("truncated after 10 bytes", items[1]["content"])
+        self.assertEqual(len(items), 2)
+
+
+class OutputLimiterTests(SimpleTestCase):
+    def test_truncates_traceback_lines(self):
+        limiter = OutputLimiter(8)
+        error = {"success": False, "type": "ansi-text", "content": ["abcde", "fghij"]}
+
+        kept, marker = limiter.add(error)
+
+        self.assertEqual(kept["content"], ["abcde", "fgh"])
+        self.assertTrue(limiter.truncated)
+        self.assertEqual(limiter.add(error), [])
+
+    def test_keeps_output_under_limit(self):
+        limiter = OutputLimiter(8)
+        output = {"success": True, "type": "text", "content": "abc"}
+
+        self.assertEqual(limiter.add(output), [output])
+        self.assertEqual(limiter.size, 3)
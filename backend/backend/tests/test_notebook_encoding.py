@@ -0,0 +1,127 @@
+import json
+import random
+
+from django.test import SimpleTestCase
+
+from backend.notebook_encoding import (
+    COMPACT_FORMAT,
+    RAW_FORMAT,
+    decode_notebook,
+    decode_patch,
+    encode_notebook,
+    encode_patch,
+)
+
+
+def line(points, width=2):
+    return {
+        "color": "auto",
+        "lineWidth": width,
+        "creatingLine": False,
+        "points": [{"x": x, "y": y} for x, y in points],
+        "boundingRect": {"left": 0, "top": 0, "right": 0, "bottom": 0},
+    }
+
+
+def notebook(lines, predictions='{"format":"compact","ranks":["a"]}'):
+    page = {
+        "layers": [
+            {"name": "code", "lines": lines, "is_code": True},
+            {"name": "annotations", "lines": [None], "is_code": False},
+        ],
+        "id": 1,
+        "name": "Page 1",
+        "scrollLeft": 0,
+        "scrollTop": 0,
+    }
+    return json.dumps(
+        {
+            "pages": [[1, page]],
+            "code_blocks": [{"data-x": "10", "predictions": predictions}],
+        }
+    )
+
+
+class NotebookEncodingTests(SimpleTestCase):
+    def test_round_trip(self):
+        data = notebook([line([(10, 20), (10.5, 21.25), (9, 20)]), line([(5, 5)])])
+
+        encoded = encode_notebook(data)
+
+        self.assertEqual(encoded[0], COMPACT_FORMAT)
+        decoded = json.loads(decode_notebook(encoded))
+        lines = decoded["pages"][0][1]["layers"][0]["lines"]
+        # Coordinates are kept to a tenth of a pixel
+        self.assertEqual(
+            lines[0]["points"],
+            [{"x": 10, "y": 20}, {"x": 10.5, "y": 21.2}, {"x": 9, "y": 20}],
+        )
+        self.assertEqual(
+            lines[1], {"color": "auto", "lineWidth": 2, "points": [{"x": 5, "y": 5}]}
+        )
+        self.assertEqual(decoded["pages"][0][1]["layers"][1]["lines"], [None])
+        self.assertEqual(
+            decoded["code_blocks"],
+            [{"data-x": "10", "predictions": '{"format":"compact","ranks":["a"]}'}],
+        )
+
+    def test_is_much_smaller_than_json(self):
+        rng = random.Random(0)
+        lines = []
+        for _ in range(200):
+            x, y = rng.randrange(2000), rng.randrange(2000)
+            points = []
+            for _ in range(50):
+                x, y = x + rng.randint(-3, 3), y + rng.randint(-3, 3)
+                points.append((x, y))
+            lines.append(line(points))
+        data = notebook(lines)
+
+        encoded = encode_notebook(data)
+
+        self.assertLess(len(encoded), len(data) / 20)
+        self.assertEqual(
+            json.loads(decode_notebook(encoded))["pages"][0][1]["layers"][0]["lines"][
+                7
+            ]["points"],
+            json.loads(data)["pages"][0][1]["layers"][0]["lines"][7]["points"],
+        )
+
+    def test_keeps_predictions_that_do_not_reserialise_the_same(self):
+        data = notebook([], predictions='{"ranks": ["a"]}')
+
+        decoded = json.loads(decode_notebook(encode_notebook(data)))
+
+        self.assertEqual(decoded["code_blocks"][0]["predictions"], '{"ranks": ["a"]}')
+
+    def test_stores_other_data_as_it_is(self):
+        for data in ["sample data", "{}", notebook([{"points": "none"}])]:
+            with self.subTest(data=data):
+                encoded = encode_notebook(data)
+
+                self.assertEqual(decode_notebook(encoded), data)
+        self.assertEqual(encode_notebook("sample data")[0], RAW_FORMAT)
+
+    def test_patch_round_trip(self):
+        layer = {"name": "code", "lines": [line([(10, 20), (10.5, 21.25)])]}
+        patch = {
+            "pages": {"1": {"page": {"name": "Page 1"}, "layers": {"2": layer}}},
+            "page_order": [1],
+            "code_blocks": [{"predictions": '{"ranks":["a"]}'}],
+        }
+
+        encoded = encode_patch(patch)
+
+        self.assertEqual(encoded[0], COMPACT_FORMAT)
+        self.assertLess(len(encoded), len(json.dumps(patch)))
+        decoded = decode_patch(encoded)
+        self.assertEqual(
+            decoded["pages"]["1"]["layers"]["2"]["lines"][0]["points"],
+            [{"x": 10, "y": 20}, {"x": 10.5, "y": 21.2}],
+        )
+        self.assertEqual(decoded["pages"]["1"]["page"], {"name": "Page 1"})
+        self.assertEqual(decoded["page_order"], [1])
+        self.assertEqual(decoded["code_blocks"], patch["code_blocks"])
+        self.assertEqual(
+            decode_patch(encode_patch({"page_order": [2]})), {"page_order": [2]}
+        )
@@ -0,0 +1,69 @@
+from django.http import HttpResponse
+from django.test import SimpleTestCase
+
+from backend.streaming import AsyncStreamingHttpResponse, StreamingASGIHandler
+
+
+class StreamingASGIHandlerTests(SimpleTestCase):
+    def setUp(self):
+        self.handler = StreamingASGIHandler()
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(message)
+
+    def bodies(self):
+        return [
+            (message.get("body", b""), message.get("more_body", False))
+            for message in self.sent
+            if message["type"] == "http.response.body"
+        ]
+
+    async def test_sends_each_part_as_it_is_produced(self):
+        closed = []
+
+        async def content():
+            try:
+                yield "first"
+                # The first part went out before the second was produced
+                self.assertEqual(self.bodies(), [(b"first", True)])
+                yield b"second"
+            finally:
+                closed.append(True)
+
+        response = AsyncStreamingHttpResponse(
+            content(), content_type="text/event-stream"
+        )
+        await self.handler.send_response(response, self.send)
+
+        self.assertEqual(self.sent[0]["type"], "http.response.start")
+        self.assertIn((b"Content-Type", b"text/event-stream"), self.sent[0]["headers"])
+        self.assertEqual(
+            self.bodies(), [(b"first", True), (b"second", True), (b"", False)]
+        )
+        self.assertEqual(closed, [True])
+
+    async def test_closes_content_if_sending_fails(self):
+        closed = []
+
+        async def content():
+            try:
+                yield "first"
+                yield "second"
+            finally:
+                closed.append(True)
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                raise OSError("disconnected")
+
+        with self.assertRaises(OSError):
+            await self.handler.send_response(
+                AsyncStreamingHttpResponse(content()), send
+            )
+        self.assertEqual(closed, [True])
+
+    async def test_sends_other_responses_unchanged(self):
+        await self.handler.send_response(HttpResponse("body"), self.send)
+
+        self.assertEqual(self.bodies(), [(b"body", False)])
@@ -1,16 +1,34 @@
-import json
 from io import BytesIO
+import requests
 from PIL import Image
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
 from django.urls import reverse
 from django.contrib.auth.models import User
-from unittest.mock import patch, MagicMock
+from unittest.mock import DEFAULT, patch, MagicMock
+from django.core.exceptions import ImproperlyConfigured
+from backend import handwriting, jupyter
+from backend.apps import check_shared_caches
 from backend.models import Notebook
+from backend.tests.fakes import FakeKernelSocket
 from ..forms import CustomUserCreationForm
 from ..utils import send_execute_request, strip_html_div
+from ..views import (
+    cached_notebook,
+    create_transcription,
+    notebook_cache,
+    parse_strokes,
+    preprocess_image,
+    preprocess_lines,
+)
+import json
+import threading
+import time
 import uuid
 
 
+@override_settings(
+    KERNEL_STANDBY_POOL={}, KERNEL_REAP_INTERVAL=0, HANDWRITING_HEALTH_INTERVAL=0
+)
 class ViewTests(TestCase):
     def setUp(self):
         self.client = Client()
@@ -25,22 +43,35 @@ class ViewTests(TestCase):
         self.assertTemplateUsed(response, "main_app.html")
         self.assertIn("notebooks", response.context)
 
-    @patch("requests.get")
-    @patch("requests.post")
-    @patch("websocket.create_connection")
-    def test_execute_python_code(self, mock_ws_conn, mock_post, mock_get):
-        mock_get.return_value.status_code = 200
-        mock_get.return_value.text = json.dumps([])
+    def tearDown(self):
+        jupyter.get_client().kernels.clear()
+        jupyter.get_client().channels.close_all()
+        handwriting.get_transcription_cache().clear()
+        handwriting.get_circuit_breaker().record_success()
+        notebook_cache().clear()
 
-        mock_post.return_value.status_code = 201
-        mock_post.return_value.text = json.dumps({"id": "fake-kernel-id"})
+    def sessions(self, kernel_id):
+        return [
+            {"path": "enscribe/other/python3", "kernel": {"id": "other-kernel"}},
+            {
+                "path": f"enscribe/{self.user.pk}/python3",
+                "kernel": {"id": kernel_id},
+            },
+        ]
 
-        ws_mock = MagicMock()
-        ws_mock.recv.side_effect = [
-            json.dumps({"msg_type": "stream", "content": {"text": "Hello"}}),
-            json.dumps({"msg_type": "execute_reply"}),
+    @patch("backend.jupyter.create_connection")
+    @patch("requests.Session.request")
+    def test_execute_python_code(self, mock_request, mock_ws_conn):
+        mock_request.side_effect = [
+            MagicMock(status_code=200, ok=True, json=MagicMock(return_value=[])),
+            MagicMock(
+                status_code=201,
+                ok=True,
+                json=MagicMock(return_value={"kernel": {"id": "fake-kernel-id"}}),
+            ),
         ]
-        mock_ws_conn.return_value = ws_mock
+
+        mock_ws_conn.return_value = FakeKernelSocket()
 
         response = self.client.post(
             reverse("execute"),
@@ -53,13 +84,240 @@ class ViewTests(TestCase):
         self.assertIsNotNone(data["output_stream"][0]["type"])
         self.assertIsNotNone(data["output_stream"][0]["content"])
 
-    @patch("requests.post")
+    @patch("backend.jupyter.create_connection")
+    @patch("requests.Session.request")
+    def test_execute_reuses_cached_kernel(self, mock_request, mock_ws_conn):
+        mock_request.return_value = MagicMock(
+            status_code=200,
+            ok=True,
+            json=MagicMock(return_value=self.sessions("kernel-1")),
+        )
+        mock_ws_conn.return_value = FakeKernelSocket()
+
+        for _ in range(3):
+            response = self.client.post(
+                reverse("execute"), {"language": "python3", "code": "1 + 1"}
+            )
+            self.assertEqual(response.json()["output_stream"][0]["content"], "1 + 1")
+
+        # Only the first (cold) run needs to look up the kernel and open a websocket
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertEqual(mock_ws_conn.call_count, 1)
+        self.assertIn("/api/kernels/kernel-1/channels", mock_ws_conn.call_args.args[0])
+
+    @patch("backend.jupyter.create_connection")
+    @patch("requests.Session.request")
+    def test_execute_binds_new_session_to_user(self, mock_request, mock_ws_conn):
+        mock_request.side_effect = [
+            MagicMock(status_code=200, ok=True, json=MagicMock(return_value=[])),
+            MagicMock(
+                status_code=201,
+                ok=True,
+                json=MagicMock(return_value={"kernel": {"id": "kernel-2"}}),
+            ),
+        ]
+        mock_ws_conn.return_value = FakeKernelSocket()
+
+        self.client.post(reverse("execute"), {"language": "python3", "code": "1"})
+
+        method, url = mock_request.call_args.args
+        self.assertEqual((method, url.split("/api")[1]), ("POST", "/sessions"))
+        self.assertEqual(
+            mock_request.call_args.kwargs["json"]["path"],
+            f"enscribe/{self.user.pk}/python3",
+        )
+        self.assertEqual(
+            jupyter.get_client().kernels.get(self.user.pk, "python3"), "kernel-2"
+        )
+
+    @patch("backend.jupyter.create_connection")
+    @patch("requests.Session.request")
+    def test_execute_stream(self, mock_request, mock_ws_conn):
+        mock_request.return_value = MagicMock(
+            status_code=200,
+            ok=True,
+            json=MagicMock(return_value=self.sessions("kernel-1")),
+        )
+        mock_ws_conn.return_value = FakeKernelSocket()
+
+        response = self.client.post(
+            reverse("execute_stream"), {"language": "python3", "code": "1 + 1"}
+        )
+
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = b"".join(response.streaming_content).decode().split("\n\n")
+        self.assertEqual(
+            events[0],
+            'event: output\ndata: {"success": true, "type": "text", "content": "1 + 1"}',
+        )
+        self.assertEqual(events[1], 'event: status\ndata: {"status": "ok"}')
+
+    @patch("requests.Session.request")
+    def test_execute_stream_jupyter_unavailable(self, mock_request):
+        mock_request.side_effect = requests.exceptions.ConnectionError()
+
+        response = self.client.post(
+            reverse("execute_stream"), {"language": "python3", "code": "1 + 1"}
+        )
+
+        events = b"".join(response.streaming_content).decode()
+        self.assertIn("Jupyter Server Error", events)
+        self.assertTrue(events.endswith('event: status\ndata: {"status": "error"}\n\n'))
+
+    @override_settings(EXECUTION_CACHE_LANGUAGES=["lambda-calculus"])
+    @patch("backend.jupyter.create_connection")
+    @patch("requests.Session.request")
+    def test_execute_caches_results_until_restart(self, mock_request, mock_ws_conn):
+        jupyter.get_client().kernels.set(self.user.pk, "lambda-calculus", "kernel-1")
+        mock_request.return_value = MagicMock(status_code=200, ok=True)
+        socket = mock_ws_conn.return_value = FakeKernelSocket()
+
+        def run(code):
+            response = self.client.post(
+                reverse("execute"), {"language": "lambda-calculus", "code": code}
+            )
+            return response.json()["output_stream"]
+
+        first = run("(\\x.x) y")
+        self.assertEqual(run("(\\x.x) y  \r\n\n"), first)
+        self.assertEqual(len(socket.sent), 1)
+
+        self.client.post(reverse("restart_kernel"), {"language": "lambda-calculus"})
+        jupyter.get_client().kernels.set(self.user.pk, "lambda-calculus", "kernel-1")
+        run("(\\x.x) y")
+        self.assertEqual(len(socket.sent), 2)
+
+    @override_settings(EXECUTION_CACHE_LANGUAGES=["python3"])
+    @patch("backend.jupyter.create_connection")
+    def test_execute_reruns_cells_after_kernel_state_changes(self, mock_ws_conn):
+        jupyter.get_client().kernels.set(self.user.pk, "python3", "kernel-1")
+        socket = mock_ws_conn.return_value = FakeKernelSocket()
+
+        for code in ("x = 1", "x = 2", "x = 1"):
+            self.client.post(reverse("execute"), {"language": "python3", "code": code})
+
+        # Re-running x = 1 reached the kernel, so x really is 1 again
+        self.assertEqual(
+            [request["content"]["code"] for request in socket.sent],
+            ["x = 1", "x = 2", "x = 1"],
+        )
+
+    def post_batch(self, url, blocks, stop_on_error=False):
+        return self.client.post(
+            reverse(url),
+            {
+                "blocks": json.dumps(
+                    [
+                        {"id": block_id, "language": language, "code": code}
+                        for block_id, language, code in blocks
+                    ]
+                ),
+                "stop_on_error": "true" if stop_on_error else "false",
+            },
+        )
+
+    @patch("backend.jupyter.create_connection")
+    def test_execute_batch(self, mock_ws_conn):
+        jupyter.get_client().kernels.set(self.user.pk, "python3", "kernel-1")
+        jupyter.get_client().kernels.set(self.user.pk, "lambda-calculus", "kernel-2")
+        mock_ws_conn.side_effect = lambda url, header: FakeKernelSocket()
+
+        response = self.post_batch(
+            "execute_batch",
+            [
+                ("a", "python3", "raise 1"),
+                ("b", "lambda-calculus", "x"),
+                ("c", "python3", "2"),
+            ],
+        )
+
+        blocks = response.json()["blocks"]
+        self.assertEqual(list(blocks), ["a", "b", "c"])
+        self.assertEqual(
+            [blocks[block_id]["status"] for block_id in blocks], ["error", "ok", "ok"]
+        )
+        self.assertEqual(blocks["b"]["output_stream"][0]["content"], "x")
+        self.assertEqual(mock_ws_conn.call_count, 2)
+
+    @patch("backend.jupyter.create_connection")
+    def test_execute_batch_stream_stops_on_error(self, mock_ws_conn):
+        jupyter.get_client().kernels.set(self.user.pk, "python3", "kernel-1")
+        jupyter.get_client().kernels.set(self.user.pk, "lambda-calculus", "kernel-2")
+        sockets = []
+        mock_ws_conn.side_effect = lambda url, header: (
+            sockets.append(FakeKernelSocket()) or sockets[-1]
+        )
+
+        response = self.post_batch(
+            "execute_batch_stream",
+            [
+                ("a", "python3", "1"),
+                ("b", "python3", "raise 1"),
+                ("c", "python3", "2"),
+                ("d", "lambda-calculus", "x"),
+            ],
+            stop_on_error=True,
+        )
+
+        events = b"".join(response.streaming_content).decode().split("\n\n")
+        self.assertIn('data: {"id": "a", "output": {', events[0])
+        statuses = [event for event in events if event.startswith("event: status")]
+        self.assertEqual(
+            statuses,
+            [
+                'event: status\ndata: {"id": "a", "status": "ok"}',
+                'event: status\ndata: {"id": "b", "status": "error"}',
+                'event: status\ndata: {"id": "c", "status": "skipped"}',
+                'event: status\ndata: {"id": "d", "status": "skipped"}',
+            ],
+        )
+        # The python3 blocks are sent together, but the next language never is
+        self.assertEqual(len(sockets), 1)
+        self.assertEqual(len(sockets[0].sent), 3)
+        self.assertTrue(sockets[0].sent[0]["content"]["stop_on_error"])
+
+    def test_execute_batch_rejects_malformed_blocks(self):
+        response = self.client.post(
+            reverse("execute_batch"), {"blocks": '[{"id": "a"}]'}
+        )
+
+        self.assertEqual(response.status_code, 400)
+
+    @patch("requests.Session.request")
+    def test_restart_kernel_invalidates_cache(self, mock_request):
+        jupyter.get_client().kernels.set(self.user.pk, "python3", "kernel-1")
+        mock_request.return_value = MagicMock(status_code=200, ok=True)
+
+        response = self.client.post(reverse("restart_kernel"), {"language": "python3"})
+
+        self.assertEqual(response.content.decode(), "Restarted Kernel")
+        self.assertEqual(
+            mock_request.call_args.args[1].split("/api")[1],
+            "/kernels/kernel-1/restart",
+        )
+        self.assertIsNone(jupyter.get_client().kernels.get(self.user.pk, "python3"))
+
+    @patch("requests.Session.request")
+    def test_restart_missing_kernel_invalidates_cache(self, mock_request):
+        jupyter.get_client().kernels.set(self.user.pk, "python3", "kernel-1")
+        mock_request.return_value = MagicMock(status_code=404, ok=False)
+
+        response = self.client.post(reverse("restart_kernel"), {"language": "python3"})
+
+        self.assertEqual(
+            response.content.decode(), "No active kernel in given language"
+        )
+        self.assertIsNone(jupyter.get_client().kernels.get(self.user.pk, "python3"))
+
+    @patch("requests.Session.post")
     def test_image_to_text(self, mock_post):
         mock_post.return_value.status_code = 200
-        mock_post.return_value.json.return_value = {
-            "top_preds": [["a", "b", "c"], ["b", "a", "c"]],
-            "top_probs": [[0.8, 0.1, 0.1], [0.9, 0.05, 0.05]],
-        }
+        mock_post.return_value.content = json.dumps(
+            {
+                "top_preds": [["a", "b", "c"], ["b", "a", "c"]],
+                "top_probs": [[0.8, 0.1, 0.1], [0.9, 0.05, 0.05]],
+            }
+        ).encode()
 
         # Create a fake image with an alpha channel
         img = Image.new("RGBA", (100, 30), (255, 255, 255, 128))
@@ -77,6 +335,358 @@ class ViewTests(TestCase):
         data = response.json()
         self.assertEqual(data["predicted_text"], "ab")
 
+    @patch("requests.Session.post")
+    def test_image_to_text_from_strokes(self, mock_post):
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.content = json.dumps(
+            {"top_preds": [["a", "b", "c"]], "top_probs": [[0.8, 0.1, 0.1]]}
+        ).encode()
+        strokes = {
+            "width": 200,
+            "height": 100,
+            "strokes": [{"width": 3, "points": [10, 50, 60, 50.5, 90, 40]}],
+        }
+
+        response = self.client.post(
+            reverse("image_to_text"),
+            {"model_name": "default", "strokes": json.dumps(strokes)},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["predicted_text"], "a")
+        # The server drew the strokes and sent them on as a cropped image
+        _, sent = mock_post.call_args.kwargs["files"]["image"]
+        image = Image.open(BytesIO(sent))
+        self.assertEqual(image.mode, "L")
+
+    def test_image_to_text_rejects_malformed_strokes(self):
+        for strokes in [
+            "not json",
+            json.dumps({"width": 200, "height": 100}),
+            json.dumps({"width": 0, "height": 100, "strokes": []}),
+            json.dumps({"width": 200, "height": 100, "strokes": [{"points": [1, 2]}]}),
+            json.dumps(
+                {
+                    "width": 200,
+                    "height": 100,
+                    "strokes": [{"width": 3, "points": [1, 2, 3]}],
+                }
+            ),
+        ]:
+            with self.subTest(strokes=strokes):
+                response = self.client.post(
+                    reverse("image_to_text"),
+                    {"model_name": "default", "strokes": strokes},
+                )
+
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("error", response.json())
+
+    @patch("requests.Session.post")
+    def test_image_to_text_reuses_transcription_of_same_ink(self, mock_post):
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.content = json.dumps(
+            {"top_preds": [["a", "b", "c"]], "top_probs": [[0.8, 0.1, 0.1]]}
+        ).encode()
+
+        def transcribe(model_name, ink_box):
+            img = Image.new("RGBA", (100, 30), (0, 0, 0, 0))
+            img.paste((0, 0, 0, 255), ink_box)
+            buffer = BytesIO()
+            img.save(buffer, format="PNG")
+            buffer.seek(0)
+            return self.client.post(
+                reverse("image_to_text"), {"model_name": model_name, "img": buffer}
+            ).json()
+
+        first = transcribe("default", (10, 10, 20, 20))
+        self.assertEqual(transcribe("default", (10, 10, 20, 20)), first)
+        self.assertEqual(mock_post.call_count, 1)
+
+        transcribe("other", (10, 10, 20, 20))
+        transcribe("default", (10, 10, 30, 20))
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertEqual(
+            handwriting.get_transcription_cache().stats(),
+            {"hits": 1, "shared_hits": 0, "misses": 3, "size": 3},
+        )
+
+    @patch("requests.Session.post")
+    def test_image_to_text_batch(self, mock_post):
+        def translate(url, files, timeout):
+            model = json.loads(files["json"][1])["model"]
+            if model == "broken":
+                return MagicMock(status_code=500)
+            return MagicMock(
+                status_code=200,
+                content=json.dumps(
+                    {"top_preds": [[model[0]]], "top_probs": [[1.0]]}
+                ).encode(),
+            )
+
+        mock_post.side_effect = translate
+
+        def image(ink_box):
+            img = Image.new("RGBA", (100, 30), (0, 0, 0, 0))
+            img.paste((0, 0, 0, 255), ink_box)
+            buffer = BytesIO()
+            img.save(buffer, format="PNG")
+            buffer.seek(0)
+            return buffer
+
+        blocks = [
+            {"id": "block-1", "model_name": "x-python3"},
+            {"id": "block-2", "model_name": "y-python3"},
+            {"id": "block-3", "model_name": "broken"},
+        ]
+        response = self.client.post(
+            reverse("image_to_text_batch"),
+            {
+                "blocks": json.dumps(blocks),
+                "block-1": image((10, 10, 20, 20)),
+                "block-2": image((10, 10, 30, 20)),
+                "block-3": image((10, 10, 40, 20)),
+            },
+        )
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()["blocks"]
+        self.assertEqual(list(results), ["block-1", "block-2", "block-3"])
+        self.assertEqual(results["block-1"]["predicted_text"], "x")
+        self.assertEqual(results["block-2"]["predicted_text"], "y")
+        self.assertEqual(
+            results["block-3"], {"error": "Handwriting server responded with 500"}
+        )
+
+    @patch("requests.Session.post")
+    def test_image_to_text_compact_predictions(self, mock_post):
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.content = json.dumps(
+            {
+                "top_preds": [["a", "b", "c"], ["", "a", "c"], ["b", "a", "c"]],
+                "top_probs": [[0.8, 0.1, 0.1], [0.5, 0.3, 0.2], [0.9, 0.05, 0.05]],
+            }
+        ).encode()
+        img = Image.new("RGBA", (100, 30), (255, 255, 255, 128))
+        buffer = BytesIO()
+        img.save(buffer, format="PNG")
+        buffer.seek(0)
+
+        response = self.client.post(
+            reverse("image_to_text"),
+            {"model_name": "default", "predictions_format": "compact", "img": buffer},
+        )
+
+        self.assertEqual(
+            response.json(),
+            {
+                "predicted_text": "ab",
+                "predictions": {
+                    "format": "compact",
+                    "ranks": ["a\0b", "baa", "ccc"],
+                    "probabilities": [80, 10, 10, 50, 30, 20, 90, 5, 5],
+                },
+            },
+        )
+
+    def test_create_transcription_falls_back_from_compact_format(self):
+        transcription = create_transcription(
+            {"top_preds": [["ab", "c"]], "top_probs": [[0.6, 0.4]]}, compact=True
+        )
+
+        self.assertEqual(transcription["predicted_text"], "ab")
+        self.assertEqual(
+            transcription["predictions"]["predictions"],
+            [
+                [
+                    {"character": "ab", "probability": 0.6},
+                    {"character": "c", "probability": 0.4},
+                ]
+            ],
+        )
+
+    @patch("requests.Session.post")
+    def test_transcription_job(self, mock_post):
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.content = json.dumps(
+            {"top_preds": [["a", "b"]], "top_probs": [[0.9, 0.1]]}
+        ).encode()
+        img = Image.new("RGBA", (100, 30), (255, 255, 255, 128))
+        buffer = BytesIO()
+        img.save(buffer, format="PNG")
+        buffer.seek(0)
+
+        response = self.client.post(
+            reverse("submit_transcription"), {"model_name": "default", "img": buffer}
+        )
+
+        self.assertEqual(response.status_code, 202)
+        job_url = reverse("transcription_job", args=[response.json()["job_id"]])
+        for _ in range(100):
+            job = self.client.get(job_url).json()
+            if job["status"] == "done":
+                break
+            time.sleep(0.01)
+        self.assertEqual(job["transcription"]["predicted_text"], "a")
+
+        other = User.objects.create_user(username="other", password="12345")
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(job_url).status_code, 404)
+
+    @patch("requests.Session.post")
+    def test_submit_transcription_answers_with_speculative_job(self, mock_post):
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.content = json.dumps(
+            {"top_preds": [["a", "b"]], "top_probs": [[0.9, 0.1]]}
+        ).encode()
+        request = {
+            "model_name": "default",
+            "block_id": str(uuid.uuid4()),
+            "strokes": json.dumps(
+                {
+                    "width": 100,
+                    "height": 30,
+                    "strokes": [{"width": 3, "points": [10, 15, 40, 15]}],
+                }
+            ),
+        }
+
+        response = self.client.post(reverse("speculate_transcription"), request)
+
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()["job_id"]
+        job_url = reverse("transcription_job", args=[job_id])
+        for _ in range(100):
+            if self.client.get(job_url).json()["status"] == "done":
+                break
+            time.sleep(0.01)
+
+        response = self.client.post(reverse("submit_transcription"), request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["job_id"], job_id)
+        self.assertEqual(response.json()["transcription"]["predicted_text"], "a")
+        self.assertEqual(mock_post.call_count, 1)
+
+        # Other ink for the block is transcribed afresh
+        request["model_name"] = "other"
+        response = self.client.post(reverse("submit_transcription"), request)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertNotEqual(response.json()["job_id"], job_id)
+
+    def test_speculate_transcription_requires_block_id(self):
+        response = self.client.post(
+            reverse("speculate_transcription"),
+            {"model_name": "default", "strokes": "{}"},
+        )
+
+        self.assertEqual(response.status_code, 400)
+
+    @patch("backend.handwriting.TranscriptionQueue.submit")
+    def test_submit_transcription_when_queue_is_full(self, mock_submit):
+        mock_submit.side_effect = handwriting.QueueFull(2.5)
+        buffer = BytesIO()
+        Image.new("RGBA", (10, 10)).save(buffer, format="PNG")
+        buffer.seek(0)
+
+        response = self.client.post(
+            reverse("submit_transcription"), {"model_name": "default", "img": buffer}
+        )
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "3")
+        self.assertEqual(
+            response.json(), {"error": "Too many transcriptions are queued"}
+        )
+
+    def test_image_to_text_batch_rejects_missing_image(self):
+        response = self.client.post(
+            reverse("image_to_text_batch"),
+            {"blocks": json.dumps([{"id": "block-1", "model_name": "default"}])},
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json(), {"error": "no image uploaded for block block-1"}
+        )
+
+    @override_settings(HANDWRITING_SPLIT_LINES=True, HANDWRITING_LINE_GAP=12)
+    @patch("requests.Session.post")
+    def test_image_to_text_retranscribes_only_changed_lines(self, mock_post):
+        threads = set()
+        mock_post.side_effect = lambda *args, **kwargs: (
+            threads.add(threading.current_thread().name) or DEFAULT
+        )
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.content = json.dumps(
+            {"top_preds": [["a", "b"]], "top_probs": [[0.9, 0.1]]}
+        ).encode()
+
+        def transcribe(second_line_width):
+            img = Image.new("RGBA", (200, 200), (0, 0, 0, 0))
+            img.paste((0, 0, 0, 255), (10, 10, 50, 30))
+            img.paste((0, 0, 0, 255), (10, 60, 10 + second_line_width, 80))
+            img.paste((0, 0, 0, 255), (30, 110, 70, 130))
+            buffer = BytesIO()
+            img.save(buffer, format="PNG")
+            buffer.seek(0)
+            return self.client.post(
+                reverse("image_to_text"), {"model_name": "default", "img": buffer}
+            ).json()
+
+        transcription = transcribe(40)
+
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertEqual(transcription["predicted_text"], "a\na\na")
+        self.assertEqual(
+            transcription["predictions"]["predictions"][1],
+            [
+                {"character": "\n", "probability": 1.0},
+                {"character": "", "probability": 0.0},
+            ],
+        )
+
+        self.assertEqual(transcribe(60), transcription)
+        self.assertEqual(mock_post.call_count, 4)
+        # Lines are sent on the process-wide pool rather than a pool per request
+        self.assertTrue(all(name.startswith("handwriting") for name in threads))
+
+    @override_settings(
+        HANDWRITING_RETRIES=1,
+        HANDWRITING_RETRY_BACKOFF=0,
+        HANDWRITING_BREAKER_THRESHOLD=2,
+    )
+    @patch("requests.Session.post")
+    def test_image_to_text_fails_fast_while_handwriting_server_is_down(self, mock_post):
+        mock_post.side_effect = requests.exceptions.ConnectionError()
+
+        def transcribe(ink_box):
+            img = Image.new("RGBA", (100, 30), (0, 0, 0, 0))
+            img.paste((0, 0, 0, 255), ink_box)
+            buffer = BytesIO()
+            img.save(buffer, format="PNG")
+            buffer.seek(0)
+            return self.client.post(
+                reverse("image_to_text"), {"model_name": "default", "img": buffer}
+            )
+
+        for ink_box in [(10, 10, 20, 20), (10, 10, 30, 20)]:
+            response = transcribe(ink_box)
+            self.assertEqual(response.status_code, 503)
+            self.assertNotIn("Retry-After", response)
+        # Each transcription was retried once
+        self.assertEqual(mock_post.call_count, 4)
+
+        response = transcribe((10, 10, 40, 20))
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(
+            response.json(), {"error": "Handwriting server is unavailable"}
+        )
+        self.assertEqual(response["Retry-After"], "30")
+        self.assertEqual(mock_post.call_count, 4)
+
     def test_save_new_notebook(self):
         response = self.client.post(
             reverse("save_notebook"),
@@ -89,7 +699,270 @@ class ViewTests(TestCase):
         self.assertEqual(response.status_code, 200)
         data = response.json()
         self.assertIn("notebook_id", data)
-        self.assertEqual(data["notebooks"][0]["notebook_name"], "New Notebook")
+        self.assertEqual(data["notebook"]["id"], data["notebook_id"])
+        self.assertEqual(data["notebook"]["notebook_name"], "New Notebook")
+        self.assertNotIn("notebook_data", data["notebook"])
+
+    def test_save_notebook_only_overwrites_own_notebooks(self):
+        other = User.objects.create_user(username="other", password="12345")
+        notebook = Notebook.objects.create(
+            user=other, notebook_name="Theirs", notebook_data="{}"
+        )
+
+        response = self.client.post(
+            reverse("save_notebook"),
+            {
+                "canvas": '{"pages": []}',
+                "notebook_name": "Mine",
+                "notebook_id": notebook.id,
+            },
+        )
+
+        self.assertEqual(response.status_code, 404)
+        notebook.refresh_from_db()
+        self.assertEqual(notebook.notebook_name, "Theirs")
+        self.assertEqual(notebook.notebook_data, "{}")
+        self.assertEqual(notebook.revision, 0)
+
+    @override_settings(NOTEBOOK_PAGE_SIZE=2)
+    def test_notebooks_lists_pages_without_data(self):
+        for name in ["first", "second", "third"]:
+            Notebook.objects.create(
+                user=self.user, notebook_name=name, notebook_data="{}"
+            )
+        other = User.objects.create_user(username="other", password="12345")
+        Notebook.objects.create(user=other, notebook_name="other", notebook_data="{}")
+        # Saving a notebook moves it to the top
+        first = Notebook.objects.get(notebook_name="first")
+        self.client.post(
+            reverse("save_notebook"),
+            {"canvas": "{}", "notebook_name": "first", "notebook_id": first.id},
+        )
+
+        page = self.client.get(reverse("notebooks")).json()
+
+        self.assertEqual(
+            [notebook["notebook_name"] for notebook in page["notebooks"]],
+            ["first", "third"],
+        )
+        self.assertNotIn("notebook_data", page["notebooks"][0])
+
+        page = self.client.get(
+            reverse("notebooks"), {"cursor": page["next_cursor"]}
+        ).json()
+
+        self.assertEqual(
+            [notebook["notebook_name"] for notebook in page["notebooks"]], ["second"]
+        )
+        self.assertIsNone(page["next_cursor"])
+        self.assertEqual(
+            self.client.get(reverse("notebooks"), {"cursor": "nonsense"}).status_code,
+            400,
+        )
+
+    def save_patch(self, notebook, patch, base_revision):
+        # Saves invalidate the notebook cache once committed
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                reverse("save_notebook"),
+                {
+                    "patch": json.dumps(patch),
+                    "base_revision": base_revision,
+                    "notebook_name": notebook.notebook_name,
+                    "notebook_id": notebook.id,
+                },
+            )
+
+    def notebook_contents(self, notebook):
+        response = self.client.post(
+            reverse("get_notebook_data"), {"notebook_id": notebook.id}
+        )
+        return json.loads(response.json()["notebook_data"])
+
+    @override_settings(NOTEBOOK_COMPACT_INTERVAL=3)
+    def test_save_notebook_patches(self):
+        page = {"id": 1, "name": "Page 1", "layers": [{"lines": []}, {"lines": []}]}
+        notebook = Notebook.objects.create(
+            user=self.user,
+            notebook_name="Patched",
+            notebook_data=json.dumps({"pages": [[1, page]], "code_blocks": []}),
+        )
+        line = {"color": "auto", "lineWidth": 2, "points": [{"x": 1, "y": 2}]}
+
+        response = self.save_patch(
+            notebook,
+            {
+                "pages": {
+                    "1": {"layers": {"0": {"lines": [line]}}},
+                    "2": {
+                        "page": {"id": 2, "name": "Page 2"},
+                        "layers": {"0": {"lines": []}, "1": {"lines": []}},
+                    },
+                },
+                "page_order": [1, 2],
+            },
+            base_revision=0,
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["revision"], 1)
+        contents = self.notebook_contents(notebook)
+        self.assertEqual([key for key, _ in contents["pages"]], [1, 2])
+        self.assertEqual(contents["pages"][0][1]["layers"][0]["lines"], [line])
+        self.assertEqual(contents["pages"][0][1]["layers"][1]["lines"], [])
+        self.assertEqual(contents["pages"][0][1]["name"], "Page 1")
+
+        # A save based on an older revision is refused
+        response = self.save_patch(notebook, {"code_blocks": []}, base_revision=0)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["revision"], 1)
+
+        self.save_patch(notebook, {"code_blocks": [{"language": "python3"}]}, 1)
+        self.save_patch(notebook, {"page_order": ["2"]}, 2)
+
+        # The third patch folded them all into the notebook's data
+        notebook.refresh_from_db()
+        self.assertEqual(notebook.revision, 3)
+        self.assertFalse(notebook.patches.exists())
+        contents = json.loads(notebook.notebook_data)
+        self.assertEqual([key for key, _ in contents["pages"]], ["2"])
+        self.assertEqual(contents["code_blocks"], [{"language": "python3"}])
+        self.assertEqual(self.notebook_contents(notebook), contents)
+
+    def test_notebook_manifest_and_pages(self):
+        line = {"color": "auto", "lineWidth": 2, "points": [{"x": 1, "y": 2}]}
+        pages = [
+            [
+                key,
+                {
+                    "layers": [{"name": "code", "lines": [line] * key}],
+                    "id": key,
+                    "name": f"Page {key}",
+                    "scrollLeft": 0,
+                    "scrollTop": 10,
+                },
+            ]
+            for key in (1, 2)
+        ]
+        code_blocks = [{"data-page": "2", "predicted-text": "print(1)"}]
+        notebook = Notebook.objects.create(
+            user=self.user,
+            notebook_name="Lazy",
+            notebook_data=json.dumps({"pages": pages, "code_blocks": code_blocks}),
+        )
+
+        manifest = self.client.get(reverse("notebook_manifest", args=[notebook.id]))
+
+        self.assertEqual(
+            manifest.json(),
+            {
+                "notebook_id": notebook.id,
+                "notebook_name": "Lazy",
+                "revision": 0,
+                "pages": [
+                    {
+                        "key": 1,
+                        "id": 1,
+                        "name": "Page 1",
+                        "scrollLeft": 0,
+                        "scrollTop": 10,
+                    },
+                    {
+                        "key": 2,
+                        "id": 2,
+                        "name": "Page 2",
+                        "scrollLeft": 0,
+                        "scrollTop": 10,
+                    },
+                ],
+                "code_blocks": code_blocks,
+            },
+        )
+
+        page = self.client.get(reverse("notebook_page", args=[notebook.id, "2"]))
+
+        self.assertEqual(page.json()["key"], 2)
+        self.assertEqual(page.json()["layers"][0]["lines"], [line, line])
+        self.assertEqual(
+            self.client.get(
+                reverse("notebook_page", args=[notebook.id, "3"])
+            ).status_code,
+            404,
+        )
+
+        other = User.objects.create_user(username="other", password="12345")
+        self.client.force_login(other)
+        self.assertEqual(
+            self.client.get(
+                reverse("notebook_manifest", args=[notebook.id])
+            ).status_code,
+            404,
+        )
+
+    def test_notebook_parts_are_cached_when_the_notebook_is_loaded(self):
+        pages = [[key, {"layers": [{"name": "code", "lines": []}]}] for key in (1, 2)]
+        notebook = Notebook.objects.create(
+            user=self.user,
+            notebook_name="Parts",
+            notebook_data=json.dumps({"pages": pages, "code_blocks": []}),
+        )
+        self.client.get(reverse("notebook_manifest", args=[notebook.id]))
+
+        with patch("backend.views.load_notebook_data") as mock_load:
+            manifest = self.client.get(reverse("notebook_manifest", args=[notebook.id]))
+            page = self.client.get(reverse("notebook_page", args=[notebook.id, "2"]))
+            missing = self.client.get(reverse("notebook_page", args=[notebook.id, "3"]))
+
+        mock_load.assert_not_called()
+        self.assertEqual([page["key"] for page in manifest.json()["pages"]], [1, 2])
+        self.assertEqual(page.json()["key"], 2)
+        self.assertEqual(missing.status_code, 404)
+
+        # Parts evicted before the notebook are cached again
+        key = cached_notebook(notebook.id, self.user)["cache_key"]
+        notebook_cache().delete(f"{key}:page:1")
+        page = self.client.get(reverse("notebook_page", args=[notebook.id, "1"]))
+        self.assertEqual(page.json()["layers"], pages[0][1]["layers"])
+
+    def test_save_notebook_rejects_malformed_patch(self):
+        notebook = Notebook.objects.create(
+            user=self.user, notebook_name="Patched", notebook_data="{}"
+        )
+
+        page = {"page": {"name": "Page 1"}, "layers": {"0": {"lines": []}}}
+        for notebook_patch in (
+            {"layers": []},
+            {"pages": {"1": {"page": {"layers": 5}, "layers": {"0": {}}}}},
+            {"pages": {"1": {"layers": {"0": []}}}},
+            {"pages": {"1": {"layers": {"1000000000": {}}}}},
+            {"pages": {"1": page}, "page_order": [{"key": 1}]},
+            {"code_blocks": ["print(1)"]},
+        ):
+            with self.subTest(patch=notebook_patch):
+                response = self.save_patch(notebook, notebook_patch, base_revision=0)
+
+                self.assertEqual(response.status_code, 400)
+                notebook.refresh_from_db()
+                self.assertEqual(notebook.revision, 0)
+                self.assertFalse(notebook.patches.exists())
+
+        # Layers can only be added after the last one
+        self.assertEqual(
+            self.save_patch(notebook, {"pages": {"1": page}}, 0).status_code, 200
+        )
+        self.assertEqual(
+            self.save_patch(
+                notebook, {"pages": {"1": {"layers": {"2": {}}}}}, 1
+            ).status_code,
+            400,
+        )
+        self.assertEqual(
+            self.client.get(reverse("notebook_page", args=[notebook.id, "1"])).json()[
+                "layers"
+            ],
+            [{"lines": []}],
+        )
 
     def test_get_notebook_data(self):
         notebook = Notebook.objects.create(
@@ -105,6 +978,45 @@ class ViewTests(TestCase):
         data = response.json()
         self.assertEqual(data["notebook_name"], "Django Test Notebook")
 
+    def test_get_notebook_data_is_cached_until_saved(self):
+        notebook = Notebook.objects.create(
+            user=self.user, notebook_name="Cached", notebook_data='{"pages": []}'
+        )
+        url = reverse("get_notebook_data") + f"?notebook_id={notebook.id}"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("no-cache", response["Cache-Control"])
+
+        # The client has it already, and the notebook is not read again
+        with self.assertNumQueries(2):  # The session and the user
+            not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.content, b"")
+        page = self.client.get(
+            reverse("notebook_manifest", args=[notebook.id]),
+            HTTP_IF_MODIFIED_SINCE=response["Last-Modified"],
+        )
+        self.assertEqual(page.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse("save_notebook"),
+                {
+                    "canvas": '{"pages": [], "code_blocks": []}',
+                    "notebook_name": "Renamed",
+                    "notebook_id": notebook.id,
+                },
+            )
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["notebook_name"], "Renamed")
+        self.assertEqual(response.json()["revision"], 1)
+
+        other = User.objects.create_user(username="other", password="12345")
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
     def test_delete_notebook(self):
         nb = Notebook.objects.create(
             user=self.user,
@@ -118,6 +1030,35 @@ class ViewTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.content.decode(), "success")
 
+    def test_deleted_notebook_is_not_served_from_cache(self):
+        notebook = Notebook.objects.create(
+            user=self.user, notebook_name="ToDelete", notebook_data="{}"
+        )
+        url = reverse("notebook_manifest", args=[notebook.id])
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("delete_notebook"), {"notebook_id": notebook.id})
+
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    @override_settings(
+        WEB_CONCURRENCY=2,
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "shared": {
+                "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                "LOCATION": "/tmp/enscribe-test-cache",
+            },
+        },
+    )
+    def test_several_workers_refuse_a_process_local_notebook_cache(self):
+        check_shared_caches()
+
+        with override_settings(NOTEBOOK_CACHE_ALIAS="default"):
+            with self.assertRaisesMessage(ImproperlyConfigured, "NOTEBOOK_CACHE_ALIAS"):
+                check_shared_caches()
+
     def test_save_method_creates_user(self):
         """Test that the save method creates a user and sets the correct values"""
 
@@ -185,3 +1126,86 @@ class ViewTests(TestCase):
         html = "<div>Hello, World!</div>"
         result = strip_html_div(html)
         self.assertEqual(result, "Hello, World!")
+
+    def canvas(self, ink_box, size=(400, 300)):
+        img = Image.new("RGBA", size, (0, 0, 0, 0))
+        img.paste((0, 0, 0, 200), ink_box)
+        buffer = BytesIO()
+        img.save(buffer, format="PNG")
+        buffer.seek(0)
+        return buffer
+
+    @override_settings(HANDWRITING_CROP_MARGIN=10, HANDWRITING_INPUT_HEIGHT=0)
+    def test_preprocess_image_crops_to_ink(self):
+        result = Image.open(preprocess_image(self.canvas((100, 50, 150, 70))))
+
+        self.assertEqual(result.mode, "L")
+        self.assertEqual(result.size, (70, 40))
+        self.assertEqual(result.getpixel((0, 0)), 255)
+        self.assertEqual(result.getpixel((35, 20)), 55)
+
+    @override_settings(HANDWRITING_CROP_MARGIN=0, HANDWRITING_INPUT_HEIGHT=20)
+    def test_preprocess_image_shrinks_to_input_height(self):
+        tall = Image.open(preprocess_image(self.canvas((0, 0, 80, 40))))
+        short = Image.open(preprocess_image(self.canvas((0, 0, 80, 10))))
+
+        self.assertEqual(tall.size, (40, 20))
+        self.assertEqual(short.size, (80, 10))
+
+    @override_settings(HANDWRITING_CROP_MARGIN=0, HANDWRITING_LINE_GAP=12)
+    def test_preprocess_lines_splits_at_blank_rows(self):
+        img = Image.new("RGBA", (400, 300), (0, 0, 0, 0))
+        img.paste((0, 0, 0, 255), (20, 10, 100, 30))
+        # Close enough to the ink above to be part of the same line
+        img.paste((0, 0, 0, 255), (20, 33, 60, 36))
+        img.paste((0, 0, 0, 255), (60, 60, 150, 80))
+        buffer = BytesIO()
+        img.save(buffer, format="PNG")
+        buffer.seek(0)
+
+        first, second = (Image.open(line) for line in preprocess_lines(buffer))
+
+        self.assertEqual(first.size, (80, 26))
+        self.assertEqual(second.size, (130, 20))
+        # The second line keeps its indentation
+        self.assertEqual(second.getpixel((39, 10)), 255)
+        self.assertEqual(second.getpixel((40, 10)), 0)
+
+    @override_settings(HANDWRITING_CROP_MARGIN=10, HANDWRITING_INPUT_HEIGHT=0)
+    def test_preprocess_strokes_crops_to_ink(self):
+        strokes = parse_strokes(
+            {
+                "width": 400,
+                "height": 300,
+                "strokes": [{"width": 20, "points": [100, 60, 150, 60]}],
+            }
+        )
+
+        result = Image.open(preprocess_image(strokes))
+
+        self.assertEqual(result.mode, "L")
+        # The stroke's round ends reach half its width past its end points
+        self.assertAlmostEqual(result.width, 70 + 20, delta=1)
+        self.assertAlmostEqual(result.height, 20 + 20, delta=1)
+        self.assertEqual(result.getpixel((0, 0)), 255)
+        self.assertEqual(result.getpixel((result.width // 2, result.height // 2)), 0)
+
+    @override_settings(HANDWRITING_CROP_MARGIN=0, HANDWRITING_INPUT_HEIGHT=20)
+    def test_preprocess_strokes_draws_at_input_height(self):
+        strokes = parse_strokes(
+            {
+                "width": 400,
+                "height": 300,
+                "strokes": [{"width": 4, "points": [10, 12, 10, 48, 70, 48]}],
+            }
+        )
+
+        result = Image.open(preprocess_image(strokes))
+
+        self.assertEqual(result.height, 20)
+        self.assertAlmostEqual(result.width, 32, delta=1)
+
+    def test_preprocess_blank_image(self):
+        result = Image.open(preprocess_image(self.canvas((0, 0, 0, 0))))
+
+        self.assertLessEqual(result.width, 2 * 16 + 1)
@@ -1,6 +1,7 @@
+from django.conf import settings
 from django.urls import path
 
-from . import views
+from . import async_views, views
 from .views import RegisterView
 
 """
@@ -9,17 +10,77 @@ The `urlpatterns` list routes URLs to views.
  - "/": The main page of the app
     - "/index/": The main page of the app
     - "/execute/": The API endpoint for executing code
+    - "/execute_stream/": The API endpoint for executing code, streaming its output
+    - "/execute_batch/": The API endpoint for executing several code blocks in order
+    - "/execute_batch_stream/": The API endpoint for executing several code blocks,
+      streaming their output
     - "/image_to_text/": The API endpoint for converting images to text
-    
+    - "/image_to_text_batch/": The API endpoint for converting several code block
+      images to text at once
+    - "/transcription_jobs/": The API endpoint for queueing the conversion of an
+      image to text
+    - "/transcription_jobs/<job_id>/": The state of a queued conversion
+    - "/speculative_transcriptions/": The API endpoint for converting a code block
+      image to text before the block is run
+    - "/transcription_cache_stats/": The transcription cache's counters, for staff
+    - "/notebooks/": A page of the user's notebooks, without their data
+    - "/notebooks/<notebook_id>/": A notebook without the strokes of its pages
+    - "/notebooks/<notebook_id>/pages/<page_key>/": The strokes of a notebook's page
+
+When settings.ASYNC_VIEWS is set, the endpoints that wait on the Jupyter and
+handwriting servers are served by their asynchronous versions in async_views.
 """
+upstream_views = async_views if settings.ASYNC_VIEWS else views
+
 urlpatterns = [
     path("", views.index),
     path("index/", views.index, name="index"),
-    path("execute/", views.execute, name="execute"),
-    path("image_to_text/", views.image_to_text, name="image_to_text"),
+    path("execute/", upstream_views.execute, name="execute"),
+    path("execute_stream/", upstream_views.execute_stream, name="execute_stream"),
+    path("execute_batch/", upstream_views.execute_batch, name="execute_batch"),
+    path(
+        "execute_batch_stream/",
+        upstream_views.execute_batch_stream,
+        name="execute_batch_stream",
+    ),
+    path("image_to_text/", upstream_views.image_to_text, name="image_to_text"),
+    path(
+        "image_to_text_batch/",
+        upstream_views.image_to_text_batch,
+        name="image_to_text_batch",
+    ),
+    path(
+        "transcription_jobs/", views.submit_transcription, name="submit_transcription"
+    ),
+    path(
+        "transcription_jobs/<str:job_id>/",
+        views.transcription_job,
+        name="transcription_job",
+    ),
+    path(
+        "speculative_transcriptions/",
+        views.speculate_transcription,
+        name="speculate_transcription",
+    ),
+    path(
+        "transcription_cache_stats/",
+        views.transcription_cache_stats,
+        name="transcription_cache_stats",
+    ),
+    path("notebooks/", views.notebooks, name="notebooks"),
+    path(
+        "notebooks/<int:notebook_id>/",
+        views.notebook_manifest,
+        name="notebook_manifest",
+    ),
+    path(
+        "notebooks/<int:notebook_id>/pages/<str:page_key>/",
+        views.notebook_page,
+        name="notebook_page",
+    ),
     path("save_notebook/", views.save_notebook, name="save_notebook"),
     path("get_notebook_data/", views.get_notebook_data, name="get_notebook_data"),
     path("delete_notebook/", views.delete_notebook, name="delete_notebook"),
-    path("restart_kernel/", views.restart_kernel, name="restart_kernel"),
+    path("restart_kernel/", upstream_views.restart_kernel, name="restart_kernel"),
     path("register/", RegisterView.as_view(), name="register"),
 ]
@@ -1,15 +1,18 @@
 from typing import Any
 
 import datetime
+import json
 import re
 import uuid
 
 
-def send_execute_request(code: str) -> dict[str, Any]:
+def send_execute_request(code: str, stop_on_error: bool = True) -> dict[str, Any]:
     """Generate the required message to send to jupyter kernel to execute code.
 
     Args:
         code (str): The code to execute
+        stop_on_error (bool): Whether the kernel aborts the requests queued behind
+            this one if it fails
 
     Returns:
         dict[str, Any]: The message to send to the jupyter kernel
@@ -29,6 +32,7 @@ def send_execute_request(code: str) -> dict[str, Any]:
         "content": {
             "code": code,
             "silent": False,
+            "stop_on_error": stop_on_error,
         },
     }
 
@@ -48,3 +52,144 @@ def strip_html_div(html: str) -> str:
     if len(matches) == 0:
         return html
     return matches[0]
+
+
+def translate_output(language: str, rsp: dict[str, Any]) -> dict[str, Any] | None:
+    """Translate a message from a jupyter kernel into an output item for the frontend.
+
+    Args:
+        language (str): The language the code was executed in
+        rsp (dict[str, Any]): The message from the kernel
+
+    Returns:
+        dict[str, Any] | None: Output item with success, type and content fields,
+            or None if the message is not part of the code's output
+    """
+    msg_type = rsp["msg_type"]
+
+    output = None
+    match language:
+        case "python3":
+            match msg_type:
+                case "stream":
+                    output = {
+                        "success": True,
+                        "type": "text",
+                        "content": rsp["content"]["text"],
+                    }
+                case "execute_result":
+                    output = {
+                        "success": True,
+                        "type": "text",
+                        "content": rsp["content"]["data"]["text/plain"],
+                    }
+                case "error":
+                    output = {
+                        "success": False,
+                        "type": "ansi-text",
+                        "content": rsp["content"]["traceback"],
+                    }
+        case "dyalog_apl":
+            match msg_type:
+                case "execute_result":
+                    output = {
+                        "success": True,
+                        "type": "html",
+                        "content": strip_html_div(rsp["content"]["data"]["text/html"]),
+                    }
+                case "stream":
+                    output = {
+                        "success": False,
+                        "type": "text",
+                        "content": rsp["content"]["text"],
+                    }
+        case "lambda-calculus":
+            match msg_type:
+                case "stream":
+                    match rsp["content"]["name"]:
+                        case "stdout":
+                            output = {
+                                "success": True,
+                                "type": "text",
+                                "content": rsp["content"]["text"],
+                            }
+                        case "stderr":
+                            output = {
+                                "success": False,
+                                "type": "text",
+                                "content": rsp["content"]["text"],
+                            }
+
+    return output
+
+
+def server_sent_event(event: str, data: dict[str, Any]) -> str:
+    """Format a Server-Sent Event.
+
+    Args:
+        event (str): The event name
+        data (dict[str, Any]): The event's JSON payload
+
+    Returns:
+        str: The encoded event
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class OutputLimiter:
+    """Caps the total size of the output items captured from one execution.
+
+    Attributes:
+        limit (int): The maximum number of bytes of output content to keep
+        size (int): The number of bytes kept so far
+        truncated (bool): Whether output has been dropped
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.size = 0
+        self.truncated = False
+
+    def add(self, output: dict[str, Any]) -> list[dict[str, Any]]:
+        """Account for an output item, truncating it if it goes over the limit.
+
+        Args:
+            output (dict[str, Any]): The output item
+
+        Returns:
+            list[dict[str, Any]]: The output items to keep: the (possibly truncated)
+                item, followed by a truncation marker when the limit is first reached,
+                or nothing once output has been truncated
+        """
+        if self.truncated:
+            return []
+
+        content = output["content"]
+        # Tracebacks are lists of lines, other content is a single string
+        parts = content if isinstance(content, list) else [content]
+        kept = []
+        for part in parts:
+            encoded = part.encode()
+            if self.size + len(encoded) > self.limit:
+                remaining = self.limit - self.size
+                kept.append(encoded[:remaining].decode(errors="ignore"))
+                self.size = self.limit
+                self.truncated = True
+                break
+            self.size += len(encoded)
+            kept.append(part)
+
+        output = {
+            **output,
+            "content": kept if isinstance(content, list) else "".join(kept),
+        }
+        if not self.truncated:
+            return [output]
+        return [
+            output,
+            {
+                "success": False,
+                "type": "text",
+                "content": f"\n[Output truncated after {self.limit} bytes]\n",
+            },
+        ]
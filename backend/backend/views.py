@@ -1,23 +1,49 @@
 from django.core.handlers.wsgi import WSGIRequest
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpRequest, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import BaseCache, caches
+from django.db import transaction
+from django.db.models import Q
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 from .forms import CustomUserCreationForm
 from django.views.generic.edit import CreateView
 from django.urls import reverse_lazy
+from django.utils.datastructures import MultiValueDict
 
+from typing import IO, Any, Callable, Iterable, Iterator
+
+import hashlib
 import json
-import requests
-import numpy as np
-from websocket import create_connection
-from backend.utils import send_execute_request, strip_html_div
-from backend.models import Notebook
+import math
+import uuid
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from backend import handwriting, jupyter
+from backend.utils import server_sent_event
+from backend.models import (
+    Notebook,
+    NotebookPatch,
+    apply_notebook_patch,
+    load_notebook_data,
+)
 
-from PIL import Image
+import numpy as np
+from PIL import Image, ImageDraw
 
 from io import BytesIO
 
+# The strokes of a code block uploaded in place of its image, from parse_strokes
+Strokes = dict[str, Any]
+
+# Largest width or height in pixels of a code block uploaded as strokes
+MAX_STROKES_SIZE = 8192
+
 
 class RegisterView(CreateView):
     """RegisterView for user registration
@@ -47,10 +73,15 @@ def index(request: WSGIRequest) -> HttpResponse:
         request (WSGIRequest): GET request
 
     Returns:
-        HttpResponse: Response with the html for the main app
+        HttpResponse: Response with the html for the main app, listing the most
+            recently modified notebooks
     """
-    user_notebooks = Notebook.objects.filter(user=request.user)
-    return render(request, "main_app.html", {"notebooks": user_notebooks})
+    user_notebooks, next_cursor = list_notebooks(request.user)
+    return render(
+        request,
+        "main_app.html",
+        {"notebooks": user_notebooks, "next_notebooks_cursor": next_cursor},
+    )
 
 
 @login_required
@@ -73,24 +104,14 @@ def execute(request: WSGIRequest) -> HttpResponse:
     Returns:
         HttpResponse: Response with the output of the code execution
     """
-    # https://stackoverflow.com/questions/54475896/interact-with-jupyter-notebooks-via-api
-    # The token is written on stdout when you start the notebook
-    base = f"http://{settings.JUPYTER_URL}:{settings.JUPYTER_PORT}"
-    headers = {
-        "Authorization": f"Token {settings.JUPYTER_TOKEN}",
-        "Cookie": request.headers["Cookie"],
-        # "X-XSRFToken": request.COOKIES["_xsrf"], # Safe to disable this when using token
-    }
-
-    url = base + "/api/kernels"
-
-    # Get execution language from frontend request
+    # Get execution language and code from frontend request
     language = request.POST.get("language")
+    code = request.POST.get("code")
 
-    # Get list of existing kernels
     try:
-        response = requests.get(url, headers=headers)
-    except requests.exceptions.ConnectionError:
+        # Send code to the user's kernel over its shared websocket
+        execution = jupyter.get_client().execute(request.user.pk, language, code)
+    except jupyter.JupyterError:
         output = {
             "success": False,
             "type": "text",
@@ -98,111 +119,204 @@ def execute(request: WSGIRequest) -> HttpResponse:
         }
         return JsonResponse({"output_stream": [output]})
 
-    # Single user kernel management
-    # Use existing kernel if exists for execution language, otherwise start new kernel
-    existing_kernel = False
-    if response:
-        for kernel in json.loads(response.text):
-            if kernel["name"] == language:
-                active_kernel = kernel
-                existing_kernel = True
+    full_response = list(execution.outputs(language))
 
-    if not existing_kernel:
-        response = requests.post(url, headers=headers, json={"name": language})
-        active_kernel = json.loads(response.text)
+    return JsonResponse({"output_stream": full_response})
+
+
+@login_required
+def execute_stream(request: WSGIRequest) -> HttpResponse:
+    """Execute a provided string like /execute, streaming output as it is produced
 
-    # Get code from POST request body
+    The response is a stream of Server-Sent Events. Each "output" event carries one
+    output item in the same format as /execute's output_stream, and a final
+    "status" event carries the execution's status ("ok", "error", "aborted",
+    "timeout" or "dead").
+
+    Requires:
+        - user to be logged in
+
+    Args:
+        request (WSGIRequest): POST request with the following fields:
+            - language: The language to execute the code in
+            - code: The code to execute
+
+    Returns:
+        HttpResponse: Streaming response of output and status events
+    """
+    language = request.POST.get("language")
     code = request.POST.get("code")
 
     try:
-        # Create connection to jupyter kernel
-        ws = create_connection(
-            f"ws://{settings.JUPYTER_URL}:{settings.JUPYTER_PORT}/api/kernels/{active_kernel['id']}/channels",
-            header=headers,
-        )
-
-        # Send code to the jupyter kernel
-        ws.send(json.dumps(send_execute_request(code)))
-    except ConnectionRefusedError:
+        execution = jupyter.get_client().execute(request.user.pk, language, code)
+    except jupyter.JupyterError:
         output = {
             "success": False,
             "type": "text",
             "content": "Jupyter Server Error",
         }
-        return JsonResponse({"output_stream": [output]})
+        return _event_stream_response(
+            iter(
+                [
+                    server_sent_event("output", output),
+                    server_sent_event("status", {"status": "error"}),
+                ]
+            )
+        )
 
-    # Process response
-    # Collect all the messages which constitute the actual code output
-    full_response = []
-    while True:
-        msg = ws.recv()
-        rsp = json.loads(msg)
-        msg_type = rsp["msg_type"]
-
-        output = None
-        match language:
-            case "python3":
-                match msg_type:
-                    case "stream":
-                        output = {
-                            "success": True,
-                            "type": "text",
-                            "content": rsp["content"]["text"],
-                        }
-                    case "execute_result":
-                        output = {
-                            "success": True,
-                            "type": "text",
-                            "content": rsp["content"]["data"]["text/plain"],
-                        }
-                    case "error":
-                        output = {
-                            "success": False,
-                            "type": "ansi-text",
-                            "content": rsp["content"]["traceback"],
-                        }
-            case "dyalog_apl":
-                match msg_type:
-                    case "execute_result":
-                        output = {
-                            "success": True,
-                            "type": "html",
-                            "content": strip_html_div(
-                                rsp["content"]["data"]["text/html"]
-                            ),
-                        }
-                    case "stream":
-                        output = {
-                            "success": False,
-                            "type": "text",
-                            "content": rsp["content"]["text"],
-                        }
-            case "lambda-calculus":
-                match msg_type:
-                    case "stream":
-                        match rsp["content"]["name"]:
-                            case "stdout":
-                                output = {
-                                    "success": True,
-                                    "type": "text",
-                                    "content": rsp["content"]["text"],
-                                }
-                            case "stderr":
-                                output = {
-                                    "success": False,
-                                    "type": "text",
-                                    "content": rsp["content"]["text"],
-                                }
-
-        if output:
-            full_response.append(output)
-        if msg_type == "execute_reply":
-            break
-
-    ws.close()
+    outputs = execution.outputs(language)
 
-    return JsonResponse({"output_stream": full_response})
-    # return HttpResponse(output)
+    def events() -> Iterator[str]:
+        while True:
+            try:
+                output = next(outputs)
+            except StopIteration as stop:
+                yield server_sent_event("status", {"status": stop.value})
+                return
+            yield server_sent_event("output", output)
+
+    return _event_stream_response(events())
+
+
+def _event_stream_response(events: Iterator[str]) -> StreamingHttpResponse:
+    """Wrap Server-Sent Events in an unbuffered streaming response
+
+    Args:
+        events (Iterator[str]): The encoded events
+
+    Returns:
+        StreamingHttpResponse: The streaming response
+    """
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Stop reverse proxies from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@login_required
+def execute_batch(request: WSGIRequest) -> HttpResponse:
+    """Execute several code blocks in order in one request, e.g. to run a whole notebook
+
+    The execute requests are sent back-to-back on the user's kernels before their
+    replies are read, so blocks in different languages run in parallel.
+
+    Requires:
+        - user to be logged in
+
+    Args:
+        request (WSGIRequest): POST request with the following fields:
+            - blocks: JSON list of code blocks, each with id, language and code fields
+            - stop_on_error: "true" to skip every block after one that fails
+
+    Returns:
+        HttpResponse: Response with the output_stream and status of each block,
+            keyed by block ID
+    """
+    try:
+        blocks = parse_blocks(request.POST.get("blocks"))
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    stop_on_error = request.POST.get("stop_on_error") == "true"
+
+    events = jupyter.get_client().execute_batch(request.user.pk, blocks, stop_on_error)
+
+    return JsonResponse({"blocks": batch_results(blocks, events)})
+
+
+@login_required
+def execute_batch_stream(request: WSGIRequest) -> HttpResponse:
+    """Execute several code blocks like /execute_batch, streaming output as it is produced
+
+    The response is a stream of Server-Sent Events. Each "output" event carries a
+    block's id and one of its output items, and each block ends with a "status"
+    event carrying its id and status (as for /execute_stream, or "skipped").
+
+    Requires:
+        - user to be logged in
+
+    Args:
+        request (WSGIRequest): POST request with the same fields as /execute_batch
+
+    Returns:
+        HttpResponse: Streaming response of output and status events
+    """
+    try:
+        blocks = parse_blocks(request.POST.get("blocks"))
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    stop_on_error = request.POST.get("stop_on_error") == "true"
+
+    events = jupyter.get_client().execute_batch(request.user.pk, blocks, stop_on_error)
+
+    return _event_stream_response(batch_server_sent_event(*event) for event in events)
+
+
+def parse_blocks(blocks_json: str | None) -> list[dict[str, str]]:
+    """Parse the code blocks sent to /execute_batch
+
+    Args:
+        blocks_json (str | None): JSON list of code blocks
+
+    Raises:
+        ValueError: If the blocks are missing or malformed
+
+    Returns:
+        list[dict[str, str]]: Code blocks with id, language and code fields
+    """
+    try:
+        blocks = json.loads(blocks_json or "")
+    except json.JSONDecodeError as e:
+        raise ValueError("blocks must be a JSON list") from e
+    if not isinstance(blocks, list):
+        raise ValueError("blocks must be a JSON list")
+
+    parsed = []
+    for block in blocks:
+        if not isinstance(block, dict) or not all(
+            isinstance(block.get(field), str) for field in ("id", "language", "code")
+        ):
+            raise ValueError("each block needs string id, language and code fields")
+        parsed.append(
+            {"id": block["id"], "language": block["language"], "code": block["code"]}
+        )
+    return parsed
+
+
+def batch_results(
+    blocks: list[dict[str, str]], events: Iterable[tuple[str, str, Any]]
+) -> dict[str, dict[str, Any]]:
+    """Gather the events of a batch execution into results per block
+
+    Args:
+        blocks (list[dict[str, str]]): The code blocks that were executed
+        events (Iterable[tuple[str, str, Any]]): The output and status events
+
+    Returns:
+        dict[str, dict[str, Any]]: The output_stream and status of each block,
+            keyed by block ID in the order the blocks were given
+    """
+    results = {block["id"]: {"output_stream": [], "status": None} for block in blocks}
+    for event, block_id, data in events:
+        if event == "output":
+            results[block_id]["output_stream"].append(data)
+        else:
+            results[block_id]["status"] = data
+    return results
+
+
+def batch_server_sent_event(event: str, block_id: str, data: Any) -> str:
+    """Encode an event of a batch execution as a Server-Sent Event
+
+    Args:
+        event (str): "output" or "status"
+        block_id (str): The block the event belongs to
+        data (Any): The output item or status
+
+    Returns:
+        str: The encoded event
+    """
+    return server_sent_event(event, {"id": block_id, event: data})
 
 
 @login_required
@@ -225,46 +339,30 @@ def restart_kernel(request: WSGIRequest) -> HttpResponse:
         HttpResponse: Success if restart was successful
     """
 
-    base = f"http://{settings.JUPYTER_URL}:{settings.JUPYTER_PORT}"
-    headers = {
-        "Authorization": f"Token {settings.JUPYTER_TOKEN}",
-        "Cookie": request.headers["Cookie"],
-    }
-
-    url = base + "/api/kernels"
-
     # Get language from frontend request
     language = request.POST.get("language")
 
-    # Get list of existing kernels
+    client = jupyter.get_client()
+
+    # Get kernel ID of active kernel in given language
     try:
-        response = requests.get(url, headers=headers)
-    except requests.exceptions.ConnectionError:
+        kernel_id = client.find_kernel(request.user.pk, language)
+    except jupyter.JupyterError:
         return HttpResponse("Could not connect to Jupyter Server")
 
-    # Get kernel ID of active kernel in given language
-    existing_kernel = False
-    if response:
-        for kernel in json.loads(response.text):
-            if kernel["name"] == language:
-                kernel_id = kernel["id"]
-                existing_kernel = True
-
-    if not existing_kernel:
+    if kernel_id is None:
         return HttpResponse("No active kernel in given language")
 
     # Restart kernel
-    url = base + f"/api/kernels/{kernel_id}/restart"
     try:
-        response = requests.post(url, headers=headers)
-        if response.status_code == 200:
-            return HttpResponse("Restarted Kernel")
-        else:
-            return HttpResponse("Could not restart kernel")
-
-    except requests.exceptions.ConnectionError:
+        client.restart_kernel(kernel_id)
+    except jupyter.KernelNotFound:
+        return HttpResponse("No active kernel in given language")
+    except jupyter.JupyterError:
         return HttpResponse("Could not restart kernel")
 
+    return HttpResponse("Restarted Kernel")
+
 
 @login_required
 def image_to_text(request: WSGIRequest) -> HttpResponse:
@@ -276,105 +374,624 @@ def image_to_text(request: WSGIRequest) -> HttpResponse:
     Args:
         request (WSGIRequest): POST request with the following fields:
             - model_name: The name of the model to use for conversion
+            - predictions_format: "compact" for the compact predictions format
+            - strokes: JSON strokes of the code block (see parse_strokes), or
             - FILE: img: The image to convert to text
 
     Returns:
-        HttpResponse: Response with a dictionary containing the predicted characters and their probabilities
+        HttpResponse: Response with a dictionary containing the predicted characters and their probabilities,
+            or a 503 response with an error field if the handwriting server failed
     """
     if request.method == "POST":
-        image = request.FILES["img"]
+        try:
+            image = uploaded_ink(request)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
         model_name = request.POST.get("model_name")
+        compact = request.POST.get("predictions_format") == "compact"
+
+        try:
+            transcription = transcribe_image(image, model_name, compact)
+        except handwriting.HandwritingError as e:
+            return handwriting_error_response(e)
+
+        return JsonResponse(transcription)
+
+    return HttpResponse("upload failed")
+
+
+@login_required
+def image_to_text_batch(request: WSGIRequest) -> HttpResponse:
+    """Convert the images of several code blocks to text in one request
 
-        # load image and convert to grayscale based on alpha channel
-        img = Image.open(image)
-        img = np.array(img)
-        img = Image.fromarray(255 - img[:, :, 3]).convert("L")
+    The images are preprocessed and sent to the handwriting server concurrently,
+    at most settings.HANDWRITING_BATCH_CONCURRENCY at a time, and the handwriting
+    client sends at most settings.HANDWRITING_CONCURRENCY of their lines at once.
+
+    Requires:
+        - user to be logged in
 
-        # Save the uploaded image to a temporary file
-        temp_image = BytesIO()
-        img.save(temp_image, format="PNG")
-        temp_image.seek(0)
+    Args:
+        request (WSGIRequest): POST request with the following fields:
+            - blocks: JSON list of code blocks, each with id and model_name fields,
+              and optionally the block's strokes (see parse_strokes)
+            - predictions_format: "compact" for the compact predictions format
+            - FILE: <id>: The image of each block without strokes, named by its
+              block ID
 
-        request_url = (
-            f"http://{settings.HANDWRITING_URL}:{settings.HANDWRITING_PORT}/translate"
+    Returns:
+        HttpResponse: Response with the predicted_text and predictions of each
+            block keyed by block ID, or an error field for blocks that could not be
+            transcribed
+    """
+    try:
+        blocks = parse_image_blocks(request.POST.get("blocks"), request.FILES)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    compact = request.POST.get("predictions_format") == "compact"
+
+    with ThreadPoolExecutor(settings.HANDWRITING_BATCH_CONCURRENCY) as executor:
+        transcriptions = executor.map(
+            partial(batch_transcription, compact=compact), blocks
         )
+        results = {
+            block["id"]: transcription
+            for block, transcription in zip(blocks, transcriptions)
+        }
 
-        files = {"image": temp_image, "json": json.dumps({"model": model_name})}
+    return JsonResponse({"blocks": results})
 
-        response = requests.post(request_url, files=files)
 
-        json_response = response.json()
+@login_required
+def submit_transcription(request: WSGIRequest) -> HttpResponse:
+    """Queue the conversion of an image to text, to be collected from transcription_job
 
-        top_characters = json_response["top_preds"]
-        top_character_probs = json_response["top_probs"]
+    If the code block was transcribed by speculate_transcription with the same ink,
+    model and predictions format, that job is answered with instead.
 
-        code_block_predictions_dict = {}
-        code_block_predictions_set = []
+    Requires:
+        - user to be logged in
 
-        # Loop through each position in string
-        for i in range(len(top_characters)):
-            top_character_predictions_set = []
+    Args:
+        request (WSGIRequest): POST request with the same fields as image_to_text,
+            and optionally:
+            - block_id: The ID of the code block, as sent to speculate_transcription
 
-            # Loop through top 3 predicted characters for that position
-            for j in range(len(top_characters[i])):
-                top_character_predictions_set.append(
-                    {
-                        "character": top_characters[i][j],
-                        "probability": top_character_probs[i][j],
-                    }
-                )
-            code_block_predictions_set.append(top_character_predictions_set)
-        code_block_predictions_dict["predictions"] = code_block_predictions_set
-        predicted_text = create_predicted_code_block(code_block_predictions_dict)
-
-        return JsonResponse(
-            {
-                "predicted_text": predicted_text,
-                "predictions": code_block_predictions_dict,
-            }
+    Returns:
+        HttpResponse: 202 response with the job_id of the transcription, or a 200
+            response with the job's state too if it is already done, or a 503
+            response with an error field and Retry-After header if the queue is full
+    """
+    try:
+        transcribe, ink = queued_transcription(request)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    queue = handwriting.get_transcription_queue()
+    block_id = request.POST.get("block_id")
+    job_id = None
+    if block_id:
+        job_id = queue.claim_speculation(request.user.pk, block_id, ink)
+    if job_id is not None:
+        job = queue.get(job_id, request.user.pk)
+        if job is not None and job["status"] == "done":
+            return JsonResponse({"job_id": job_id, **job})
+        return JsonResponse({"job_id": job_id}, status=202)
+
+    try:
+        job_id = queue.submit(request.user.pk, transcribe)
+    except handwriting.HandwritingError as e:
+        return handwriting_error_response(e)
+
+    return JsonResponse({"job_id": job_id}, status=202)
+
+
+@login_required
+def speculate_transcription(request: WSGIRequest) -> HttpResponse:
+    """Queue the conversion of a code block's image to text before the block is run
+
+    The frontend calls this when the pen goes idle, so the transcription is ready by
+    the time the block is run and sent to submit_transcription. A newer request for
+    the same block supersedes the last, which is dropped if it has not started.
+
+    Requires:
+        - user to be logged in
+
+    Args:
+        request (WSGIRequest): POST request with the same fields as image_to_text,
+            and the following:
+            - block_id: The ID of the code block
+
+    Returns:
+        HttpResponse: 202 response with the job_id of the transcription, or a 503
+            response with an error field and Retry-After header if the queue is full
+    """
+    block_id = request.POST.get("block_id")
+    if not block_id:
+        return JsonResponse({"error": "block_id is required"}, status=400)
+    try:
+        transcribe, ink = queued_transcription(request)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    try:
+        job_id = handwriting.get_transcription_queue().speculate(
+            request.user.pk, block_id, ink, transcribe
         )
+    except handwriting.HandwritingError as e:
+        return handwriting_error_response(e)
 
-    return HttpResponse("upload failed")
+    return JsonResponse({"job_id": job_id}, status=202)
+
+
+def queued_transcription(
+    request: WSGIRequest,
+) -> tuple[Callable[[], dict[str, Any]], str]:
+    """Get the transcription asked for by a request to queue one
+
+    Args:
+        request (WSGIRequest): POST request with the same fields as image_to_text
+
+    Raises:
+        ValueError: If the strokes are malformed
+
+    Returns:
+        tuple[Callable[[], dict[str, Any]], str]: Transcribes the code block, and a
+            digest of its ink, model and predictions format
+    """
+    image = uploaded_ink(request)
+    if isinstance(image, dict):
+        ink = request.POST["strokes"].encode()
+    else:
+        # The upload is closed once the request ends, so keep the image in memory
+        ink = image.read()
+        image = BytesIO(ink)
+    model_name = request.POST.get("model_name")
+    compact = request.POST.get("predictions_format") == "compact"
+
+    digest = hashlib.sha256(json.dumps([model_name, compact]).encode())
+    digest.update(ink)
+    return partial(transcribe_image, image, model_name, compact), digest.hexdigest()
+
+
+def uploaded_ink(request: HttpRequest) -> IO[bytes] | Strokes:
+    """Get the code block image or strokes uploaded to be converted to text
+
+    Args:
+        request (HttpRequest): POST request with a strokes field or img file
+
+    Raises:
+        ValueError: If the strokes are malformed
+
+    Returns:
+        IO[bytes] | Strokes: The image, or the strokes from parse_strokes
+    """
+    if "strokes" in request.POST:
+        return parse_strokes(json.loads(request.POST["strokes"]))
+    return request.FILES["img"]
+
+
+@login_required
+def transcription_job(request: WSGIRequest, job_id: str) -> HttpResponse:
+    """Get the state of a transcription queued by submit_transcription
+
+    Requires:
+        - user to be logged in
+
+    Args:
+        request (WSGIRequest): GET request
+        job_id (str): The ID of the transcription job
+
+    Returns:
+        HttpResponse: Response with the job's status ("queued", "running", "done",
+            "failed" or "cancelled"), with its transcription once done or error once
+            failed
+    """
+    job = handwriting.get_transcription_queue().get(job_id, request.user.pk)
+    if job is None:
+        return JsonResponse({"error": "No such transcription job"}, status=404)
+    return JsonResponse(job)
+
+
+def transcribe_image(
+    image: IO[bytes] | Strokes, model_name: str | None, compact: bool = False
+) -> dict[str, Any]:
+    """Transcribe a code block image with the handwriting server
+
+    If settings.HANDWRITING_SPLIT_LINES is set, each line of the block is
+    transcribed separately, so after an edit only the changed lines are sent to the
+    handwriting server and the rest come from the transcription cache. The changed
+    lines are sent together on the process-wide pool from
+    handwriting.get_line_executor, within the handwriting client's limit of
+    settings.HANDWRITING_CONCURRENCY transcriptions at once.
+
+    Args:
+        image (IO[bytes] | Strokes): The image or strokes of the code block
+        model_name (str | None): The name of the model to use for conversion
+        compact (bool): Whether to give the predictions in the compact format
+
+    Raises:
+        handwriting.HandwritingError: If the handwriting server failed
+
+    Returns:
+        dict[str, Any]: The predicted text and the predictions for each character
+    """
+    if settings.HANDWRITING_SPLIT_LINES:
+        lines = [line.getvalue() for line in preprocess_lines(image)]
+    else:
+        lines = [preprocess_image(image).getvalue()]
+
+    # Unchanged ink has already been transcribed
+    cache = handwriting.get_transcription_cache()
+    keys = [cache.key(line, model_name) for line in lines]
+    line_predictions = [cache.get(key) for key in keys]
+    missing = [
+        i for i, predictions in enumerate(line_predictions) if predictions is None
+    ]
+
+    client = handwriting.get_handwriting_client()
+    transcribed = handwriting.get_line_executor().map(
+        lambda i: client.transcribe(lines[i], model_name), missing
+    )
+    for i, predictions in zip(missing, transcribed):
+        line_predictions[i] = predictions
+        cache.set(keys[i], predictions)
+
+    return create_transcription(stitch_lines(line_predictions), compact)
+
+
+def stitch_lines(line_predictions: list[dict[str, Any]]) -> dict[str, Any]:
+    """Join the handwriting server's predictions for each line of a code block
+
+    Args:
+        line_predictions (list[dict[str, Any]]): Predictions for each line, from
+            top to bottom, with top_preds and top_probs fields
+
+    Returns:
+        dict[str, Any]: Predictions for the whole block, with a certain newline
+            between lines
+    """
+    if len(line_predictions) == 1:
+        return line_predictions[0]
+
+    # Give the newlines as many ranks as the characters, so the block stays rectangular
+    ranks = max(
+        (
+            len(top)
+            for predictions in line_predictions
+            for top in predictions["top_preds"]
+        ),
+        default=1,
+    )
+    top_preds = []
+    top_probs = []
+    for i, predictions in enumerate(line_predictions):
+        if i:
+            top_preds.append(["\n"] + [""] * (ranks - 1))
+            top_probs.append([1.0] + [0.0] * (ranks - 1))
+        top_preds.extend(predictions["top_preds"])
+        top_probs.extend(predictions["top_probs"])
+    return {"top_preds": top_preds, "top_probs": top_probs}
+
+
+def parse_image_blocks(
+    blocks_json: str | None, files: MultiValueDict
+) -> list[dict[str, Any]]:
+    """Parse the code blocks sent to /image_to_text_batch
+
+    Args:
+        blocks_json (str | None): JSON list of code blocks
+        files (MultiValueDict): The uploaded images, named by block ID
+
+    Raises:
+        ValueError: If the blocks are missing or malformed, or an image is missing
+
+    Returns:
+        list[dict[str, Any]]: Code blocks with id, model_name and image fields,
+            where the image is the uploaded file or the block's strokes
+    """
+    try:
+        blocks = json.loads(blocks_json or "")
+    except json.JSONDecodeError as e:
+        raise ValueError("blocks must be a JSON list") from e
+    if not isinstance(blocks, list):
+        raise ValueError("blocks must be a JSON list")
+
+    parsed = []
+    for block in blocks:
+        if not isinstance(block, dict) or not all(
+            isinstance(block.get(field), str) for field in ("id", "model_name")
+        ):
+            raise ValueError("each block needs string id and model_name fields")
+        if "strokes" in block:
+            image = parse_strokes(block["strokes"])
+        elif block["id"] in files:
+            image = files[block["id"]]
+        else:
+            raise ValueError(f"no image uploaded for block {block['id']}")
+        parsed.append(
+            {"id": block["id"], "model_name": block["model_name"], "image": image}
+        )
+    return parsed
+
+
+def batch_transcription(block: dict[str, Any], compact: bool) -> dict[str, Any]:
+    """Transcribe the image of a code block sent to /image_to_text_batch
+
+    Args:
+        block (dict[str, Any]): Code block with model_name and image fields
+        compact (bool): Whether to give the predictions in the compact format
+
+    Returns:
+        dict[str, Any]: The predicted text and predictions, or an error field if
+            the handwriting server failed
+    """
+    try:
+        return transcribe_image(block["image"], block["model_name"], compact)
+    except handwriting.HandwritingError as e:
+        return {"error": str(e)}
+
+
+def handwriting_error_response(error: handwriting.HandwritingError) -> JsonResponse:
+    """Get the response to a transcription the handwriting server failed
+
+    Args:
+        error (handwriting.HandwritingError): The failure
+
+    Returns:
+        JsonResponse: 503 response with an error field, and a Retry-After header if
+            the client should wait before trying again
+    """
+    response = JsonResponse({"error": str(error)}, status=503)
+    if error.retry_after is not None:
+        response["Retry-After"] = str(max(math.ceil(error.retry_after), 1))
+    return response
+
+
+@staff_member_required
+def transcription_cache_stats(request: WSGIRequest) -> HttpResponse:
+    """Get the hit and miss counters of this process's transcription cache
+
+    Requires:
+        - user to be staff
+
+    Args:
+        request (WSGIRequest): GET request
+
+    Returns:
+        HttpResponse: Response with the counters
+    """
+    return JsonResponse(handwriting.get_transcription_cache().stats())
 
 
 @login_required
 def save_notebook(request: WSGIRequest) -> HttpResponse:
     """Save the notebook data to the database
 
+    An existing notebook can be saved by sending only what changed since the
+    revision the frontend last saved or loaded, as a patch applied by
+    models.apply_notebook_patch. Patches are stored as they are, and folded into the
+    notebook's data every settings.NOTEBOOK_COMPACT_INTERVAL saves.
+
     Args:
         request (WSGIRequest): POST request with the following fields:
-            - canvas: The notebook data to save
+            - canvas: The notebook data to save, or
+            - patch: JSON changes to the notebook since base_revision
+            - base_revision: The revision the patch is based on
             - notebook_name: The name of the notebook
             - notebook_id: The ID of the notebook (if it exists)
 
     Returns:
-        HttpResponse: Response with the ID of the saved notebook and the updated list of notebooks
+        HttpResponse: Response with the ID and new revision of the saved notebook,
+            and its id, notebook_name and notebook_modified_at as listed by
+            notebooks, or a 409 response with an error field and the notebook's
+            current revision if the patch is based on an older revision
+            (400 if the patch is malformed or does not apply to the notebook, 404
+            if the user has no such notebook)
     """
     canvas = request.POST.get("canvas")
     notebook_name = request.POST.get("notebook_name")
     notebook_id = request.POST.get("notebook_id")
 
+    if "patch" in request.POST:
+        try:
+            patch = parse_notebook_patch(request.POST["patch"])
+            base_revision = int(request.POST.get("base_revision", ""))
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        with transaction.atomic():
+            # Only one save can move the notebook on from base_revision
+            notebook = (
+                Notebook.objects.select_for_update()
+                .filter(id=notebook_id, user=request.user)
+                .first()
+            )
+            if notebook is None:
+                return JsonResponse({"error": "No such notebook"}, status=404)
+            if notebook.revision != base_revision:
+                return JsonResponse(
+                    {
+                        "error": "The notebook has been saved since it was loaded",
+                        "revision": notebook.revision,
+                    },
+                    status=409,
+                )
+            try:
+                # Every read replays the patch, so only store it if it applies
+                apply_notebook_patch(load_notebook_data(notebook.contents()), patch)
+            except ValueError as e:
+                return JsonResponse({"error": str(e)}, status=400)
+            notebook.notebook_name = notebook_name
+            notebook.revision += 1
+            notebook.save(
+                update_fields=["notebook_name", "notebook_modified_at", "revision"]
+            )
+            NotebookPatch.objects.create(
+                notebook=notebook, revision=notebook.revision, patch=patch
+            )
+            if notebook.patches.count() >= settings.NOTEBOOK_COMPACT_INTERVAL:
+                notebook.compact()
     # Create new notebook if not already existing
-    if notebook_id == "-1":
-        new_notebook = Notebook.objects.create(
+    elif notebook_id == "-1":
+        notebook = Notebook.objects.create(
             user=request.user, notebook_name=notebook_name, notebook_data=canvas
         )
-        id_to_return = new_notebook.id
     # If existing then update to latest version of canvas and update name
     else:
-        existing_notebook = Notebook.objects.get(id=notebook_id)
-        existing_notebook.notebook_data = canvas
-        existing_notebook.notebook_name = notebook_name
-        existing_notebook.save()
-        id_to_return = existing_notebook.id
-
-    updated_user_notebooks = Notebook.objects.filter(user=request.user).values(
-        "id", "notebook_name", "notebook_modified_at", "notebook_data"
-    )
+        with transaction.atomic():
+            notebook = (
+                Notebook.objects.select_for_update()
+                .defer("encoded_data")
+                .filter(id=notebook_id, user=request.user)
+                .first()
+            )
+            if notebook is None:
+                return JsonResponse({"error": "No such notebook"}, status=404)
+            notebook.notebook_data = canvas
+            notebook.notebook_name = notebook_name
+            notebook.revision += 1
+            notebook.save()
+            # The canvas replaces everything saved before it
+            notebook.patches.all().delete()
+    transaction.on_commit(partial(forget_notebook, notebook.id))
 
     return JsonResponse(
-        {"notebook_id": id_to_return, "notebooks": list(updated_user_notebooks)}
+        {
+            "notebook_id": notebook.id,
+            "revision": notebook.revision,
+            "notebook": {field: getattr(notebook, field) for field in NOTEBOOK_FIELDS},
+        }
+    )
+
+
+def parse_notebook_patch(patch_json: str) -> dict[str, Any]:
+    """Parse the changes to a notebook sent to /save_notebook
+
+    Args:
+        patch_json (str): JSON changes, as applied by models.apply_notebook_patch
+
+    Raises:
+        ValueError: If the patch is malformed
+
+    Returns:
+        dict[str, Any]: The changes
+    """
+    try:
+        patch = json.loads(patch_json)
+    except json.JSONDecodeError as e:
+        raise ValueError("patch must be a JSON object") from e
+    if not isinstance(patch, dict) or not set(patch) <= {
+        "pages",
+        "page_order",
+        "code_blocks",
+    }:
+        raise ValueError("patch may only have pages, page_order and code_blocks")
+
+    pages = patch.get("pages", {})
+    if not isinstance(pages, dict) or not all(
+        isinstance(change, dict)
+        and set(change) <= {"page", "layers"}
+        and isinstance(change.get("page", {}), dict)
+        and "layers" not in change.get("page", {})
+        and isinstance(change.get("layers", {}), dict)
+        and all(
+            index.isdigit() and isinstance(layer, dict)
+            for index, layer in change.get("layers", {}).items()
+        )
+        for change in pages.values()
+    ):
+        raise ValueError("pages must map keys to a page and layers by index")
+    page_order = patch.get("page_order", [])
+    if not isinstance(page_order, list) or not all(
+        isinstance(key, (int, str)) and not isinstance(key, bool) for key in page_order
+    ):
+        raise ValueError("page_order must be a list of page keys")
+    code_blocks = patch.get("code_blocks", [])
+    if not isinstance(code_blocks, list) or not all(
+        isinstance(block, dict) for block in code_blocks
+    ):
+        raise ValueError("code_blocks must be a list of code blocks")
+    return patch
+
+
+@login_required
+def notebooks(request: WSGIRequest) -> HttpResponse:
+    """List the user's notebooks, most recently modified first, a page at a time
+
+    Args:
+        request (WSGIRequest): GET request with the following optional parameters:
+            - cursor: The next_cursor of the previous page
+            - limit: The most notebooks to list, up to settings.NOTEBOOK_PAGE_SIZE
+
+    Returns:
+        HttpResponse: Response with the id, notebook_name and notebook_modified_at
+            of each notebook, and the next_cursor to list the ones after them (null
+            on the last page), or a 400 response with an error field if the cursor
+            or limit is malformed
+    """
+    try:
+        limit = int(request.GET.get("limit", settings.NOTEBOOK_PAGE_SIZE))
+        user_notebooks, next_cursor = list_notebooks(
+            request.user,
+            request.GET.get("cursor"),
+            max(1, min(limit, settings.NOTEBOOK_PAGE_SIZE)),
+        )
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    return JsonResponse({"notebooks": user_notebooks, "next_cursor": next_cursor})
+
+
+# The fields of a notebook listed without loading its data
+NOTEBOOK_FIELDS = ("id", "notebook_name", "notebook_modified_at")
+
+
+def list_notebooks(
+    user: User, cursor: str | None = None, limit: int | None = None
+) -> tuple[list[dict[str, Any]], str | None]:
+    """List a page of a user's notebooks without their data, most recently modified first
+
+    Pages are found by keyset rather than offset, so each is a single index range
+    scan however far down the list it is, and notebooks saved between requests do
+    not shift the pages.
+
+    Args:
+        user (User): The user whose notebooks to list
+        cursor (str | None): Where the page starts, from the previous page, or None
+            for the first page
+        limit (int | None): The most notebooks to list, or None for
+            settings.NOTEBOOK_PAGE_SIZE
+
+    Raises:
+        ValueError: If the cursor is malformed
+
+    Returns:
+        tuple[list[dict[str, Any]], str | None]: The page's notebooks, and the cursor
+            of the next page, or None if this is the last
+    """
+    limit = limit or settings.NOTEBOOK_PAGE_SIZE
+    user_notebooks = Notebook.objects.filter(user=user).order_by(
+        "-notebook_modified_at", "-id"
     )
+    if cursor is not None:
+        try:
+            modified_at, notebook_id = cursor.rsplit("_", 1)
+            modified_at = datetime.fromisoformat(modified_at)
+            notebook_id = int(notebook_id)
+        except ValueError as e:
+            raise ValueError("Malformed notebooks cursor") from e
+        user_notebooks = user_notebooks.filter(
+            Q(notebook_modified_at__lt=modified_at)
+            | Q(notebook_modified_at=modified_at, id__lt=notebook_id)
+        )
+
+    # Fetch one more than a page to know whether there is another page after it
+    page = list(user_notebooks.values(*NOTEBOOK_FIELDS)[: limit + 1])
+    if len(page) <= limit:
+        return page, None
+    page = page[:limit]
+    last = page[-1]
+    return page, f"{last['notebook_modified_at'].isoformat()}_{last['id']}"
 
 
 # Return the canvas of notebook of given ID
@@ -383,24 +1000,261 @@ def get_notebook_data(request: WSGIRequest) -> HttpResponse:
     """Get the notebook data for the given ID
 
     Args:
-        request (WSGIRequest): POST request with the following fields:
+        request (WSGIRequest): GET or POST request with the following fields:
             - notebook_id: The ID of the notebook to get.
 
     Returns:
-        HttpResponse: Response with the notebook data, name and ID
+        HttpResponse: Response with the notebook data, name, ID and revision, or a
+            304 response if the client has it already (404 if the user has no such
+            notebook)
     """
-    notebook_id = request.POST.get("notebook_id")
-    this_notebook = Notebook.objects.get(id=notebook_id)
+    notebook_id = request.GET.get("notebook_id", request.POST.get("notebook_id"))
+    notebook = cached_notebook(notebook_id, request.user)
+    if notebook is None:
+        return JsonResponse({"error": "No such notebook"}, status=404)
+
+    return notebook_response(
+        request,
+        notebook,
+        lambda: {
+            "notebook_data": notebook["contents"],
+            "notebook_name": notebook["notebook_name"],
+            "notebook_id": notebook["notebook_id"],
+            "revision": notebook["revision"],
+        },
+    )
 
-    return JsonResponse(
-        {
-            "notebook_data": this_notebook.notebook_data,
-            "notebook_name": this_notebook.notebook_name,
+
+def notebook_cache() -> BaseCache:
+    """Get the cache of opened notebooks, named by settings.NOTEBOOK_CACHE_ALIAS
+
+    Returns:
+        BaseCache: The cache
+    """
+    return caches[settings.NOTEBOOK_CACHE_ALIAS]
+
+
+def cached_notebook(notebook_id: Any, user: User) -> dict[str, Any] | None:
+    """Get a user's notebook with its contents, read through the notebook cache
+
+    Each notebook is cached under a version that forget_notebook drops when the
+    notebook is saved, so a read racing a save can only cache what it read under
+    the dropped version, where no later read looks. Its manifest and pages are
+    cached alongside it by cache_notebook_parts.
+
+    Args:
+        notebook_id (Any): The ID of the notebook
+        user (User): The user opening the notebook
+
+    Returns:
+        dict[str, Any] | None: The notebook's notebook_id, notebook_name, revision,
+            modified_at, contents and cache_key, or None if the user has no such
+            notebook
+    """
+    try:
+        notebook_id = int(notebook_id)
+    except (TypeError, ValueError):
+        return None
+    cache = notebook_cache()
+    version_key = f"notebook-version:{notebook_id}"
+    version = cache.get(version_key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(version_key, version, settings.NOTEBOOK_CACHE_TIMEOUT):
+            version = cache.get(version_key, version)
+    key = f"notebook:{notebook_id}:{version}"
+
+    notebook = cache.get(key)
+    if notebook is None:
+        this_notebook = Notebook.objects.filter(id=notebook_id).first()
+        if this_notebook is None:
+            return None
+        notebook = {
             "notebook_id": this_notebook.id,
+            "user_id": this_notebook.user_id,
+            "notebook_name": this_notebook.notebook_name,
+            "revision": this_notebook.revision,
+            "modified_at": this_notebook.notebook_modified_at,
+            "contents": this_notebook.contents(),
+            "cache_key": key,
+        }
+        cache.set(key, notebook, settings.NOTEBOOK_CACHE_TIMEOUT)
+        try:
+            cache_notebook_parts(notebook)
+        except ValueError:
+            # Only notebook_manifest and notebook_page need the contents parsed
+            pass
+    if notebook["user_id"] != user.pk:
+        return None
+    return notebook
+
+
+def cache_notebook_parts(notebook: dict[str, Any]) -> dict[str, Any]:
+    """Cache a notebook's manifest and each of its pages under their own keys
+
+    Parsing a notebook takes as long as it has strokes, so it is parsed once when
+    it is loaded into the cache, and notebook_manifest and notebook_page serve
+    their parts without reading the rest.
+
+    Args:
+        notebook (dict[str, Any]): The notebook, from cached_notebook
+
+    Raises:
+        ValueError: If the notebook's contents are not a serialised JSON object
+
+    Returns:
+        dict[str, Any]: The cached parts by key
+    """
+    data = load_notebook_data(notebook["contents"])
+    pages = data.get("pages", [])
+    parts = {
+        f"{notebook['cache_key']}:manifest": {
+            "pages": [
+                {
+                    "key": key,
+                    **{
+                        field: value
+                        for field, value in page.items()
+                        if field != "layers"
+                    },
+                }
+                for key, page in pages
+            ],
+            "code_blocks": data.get("code_blocks", []),
+        }
+    }
+    for key, page in pages:
+        parts[f"{notebook['cache_key']}:page:{key}"] = {
+            "key": key,
+            "layers": page["layers"],
         }
+    notebook_cache().set_many(parts, settings.NOTEBOOK_CACHE_TIMEOUT)
+    return parts
+
+
+def cached_notebook_part(notebook: dict[str, Any], part: str) -> dict[str, Any] | None:
+    """Get a part of a notebook cached by cache_notebook_parts
+
+    Args:
+        notebook (dict[str, Any]): The notebook, from cached_notebook
+        part (str): "manifest", or "page:" and the key of a page
+
+    Returns:
+        dict[str, Any] | None: The part, or None if the notebook has no such page
+    """
+    key = f"{notebook['cache_key']}:{part}"
+    value = notebook_cache().get(key)
+    if value is None:
+        # Evicted before the notebook itself
+        value = cache_notebook_parts(notebook).get(key)
+    return value
+
+
+def forget_notebook(notebook_id: int) -> None:
+    """Drop a notebook from the notebook cache once it has been saved or deleted
+
+    Args:
+        notebook_id (int): The ID of the notebook
+    """
+    notebook_cache().delete(f"notebook-version:{notebook_id}")
+
+
+def notebook_response(
+    request: WSGIRequest,
+    notebook: dict[str, Any],
+    payload: Callable[[], dict[str, Any]],
+) -> HttpResponse:
+    """Respond with part of a notebook, or with 304 Not Modified if the client has it
+
+    Responses are validated by the notebook's revision and modification time, and
+    the browser is told to revalidate them each time, so reopening a notebook that
+    has not been saved since transfers nothing.
+
+    Args:
+        request (WSGIRequest): The request, with any If-None-Match or
+            If-Modified-Since headers
+        notebook (dict[str, Any]): The notebook, from cached_notebook
+        payload (Callable[[], dict[str, Any]]): Makes the response's JSON, if the
+            client does not have it
+
+    Returns:
+        HttpResponse: The response, with its ETag and Last-Modified headers
+    """
+    last_modified = int(notebook["modified_at"].timestamp())
+    etag = quote_etag(
+        f"{notebook['notebook_id']}-{notebook['revision']}-"
+        f"{notebook['modified_at'].timestamp()}"
+    )
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = JsonResponse(payload())
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+@login_required
+def notebook_manifest(request: WSGIRequest, notebook_id: int) -> HttpResponse:
+    """Get a notebook without the strokes of its pages, which notebook_page gets
+
+    The frontend opens notebooks from their manifest and loads each page as it is
+    shown, so opening a notebook takes as long however many pages it has.
+
+    Args:
+        request (WSGIRequest): GET request
+        notebook_id (int): The ID of the notebook
+
+    Returns:
+        HttpResponse: Response with the notebook's notebook_id, notebook_name and
+            revision, its pages in order with their key and every field but their
+            layers, and its code_blocks, or a 304 response if the client has it
+            already (404 if the user has no such notebook)
+    """
+    notebook = cached_notebook(notebook_id, request.user)
+    if notebook is None:
+        return JsonResponse({"error": "No such notebook"}, status=404)
+
+    return notebook_response(
+        request,
+        notebook,
+        lambda: {
+            "notebook_id": notebook["notebook_id"],
+            "notebook_name": notebook["notebook_name"],
+            "revision": notebook["revision"],
+            **cached_notebook_part(notebook, "manifest"),
+        },
     )
 
 
+@login_required
+def notebook_page(
+    request: WSGIRequest, notebook_id: int, page_key: str
+) -> HttpResponse:
+    """Get the strokes of a page of a notebook opened from notebook_manifest
+
+    Args:
+        request (WSGIRequest): GET request
+        notebook_id (int): The ID of the notebook
+        page_key (str): The page's key, from the manifest
+
+    Returns:
+        HttpResponse: Response with the page's key, its layers and the notebook's
+            revision, or a 304 response if the client has it already (404 if the
+            user has no such notebook or page)
+    """
+    notebook = cached_notebook(notebook_id, request.user)
+    if notebook is None:
+        return JsonResponse({"error": "No such notebook"}, status=404)
+    manifest = cached_notebook_part(notebook, "manifest")
+    if page_key in (str(page["key"]) for page in manifest["pages"]):
+        page = cached_notebook_part(notebook, f"page:{page_key}")
+        return notebook_response(
+            request, notebook, lambda: {**page, "revision": notebook["revision"]}
+        )
+    return JsonResponse({"error": "No such page"}, status=404)
+
+
 # Delete notebook with given ID
 @login_required
 def delete_notebook(request: WSGIRequest) -> HttpResponse:
@@ -416,23 +1270,328 @@ def delete_notebook(request: WSGIRequest) -> HttpResponse:
     notebook_id = request.POST.get("notebook_id")
 
     this_notebook = Notebook.objects.get(id=notebook_id)
+    deleted_id = this_notebook.id
     this_notebook.delete()
+    # Forget the notebook only once it is gone, so a read in between cannot cache it again
+    transaction.on_commit(partial(forget_notebook, deleted_id))
 
     return HttpResponse("success")
 
 
+def preprocess_image(image: IO[bytes] | Strokes) -> BytesIO:
+    """Convert an uploaded code block image into the grayscale PNG the handwriting server expects
+
+    The ink is drawn black on white, cropped to its bounding box plus
+    settings.HANDWRITING_CROP_MARGIN pixels and, if settings.HANDWRITING_INPUT_HEIGHT
+    is set, shrunk to at most that height. Every step works on the alpha channel
+    alone in PIL's C routines, so blank canvas is never copied or encoded.
+
+    Args:
+        image (IO[bytes] | Strokes): The uploaded RGBA image, or the block's strokes
+
+    Returns:
+        BytesIO: The grayscale PNG, rewound to the start
+    """
+    alpha = load_ink(image, fit_input_height=True)
+
+    bbox = alpha.getbbox()
+    if bbox is None:
+        # Blank canvas, so send a blank image rather than all of it
+        bbox = (0, 0, min(alpha.width, 1), min(alpha.height, 1))
+    return ink_to_png(alpha, bbox)
+
+
+def preprocess_lines(image: IO[bytes] | Strokes) -> list[BytesIO]:
+    """Convert an uploaded code block image into a grayscale PNG per line of code
+
+    Lines are found by horizontal projection: rows of the image containing ink,
+    where runs of ink rows separated by fewer than settings.HANDWRITING_LINE_GAP
+    blank rows belong to the same line. Every line is cropped from the left edge of
+    the block's ink, so indentation is kept and a line's image does not change when
+    other lines are edited or it moves up or down.
+
+    Args:
+        image (IO[bytes] | Strokes): The uploaded RGBA image, or the block's strokes
+
+    Returns:
+        list[BytesIO]: The grayscale PNG of each line, from top to bottom, as
+            preprocess_image would produce it
+    """
+    alpha = load_ink(image)
+
+    ink = np.asarray(alpha) > 0
+    ink_rows = np.flatnonzero(ink.any(axis=1))
+    if ink_rows.size == 0:
+        return [ink_to_png(alpha, (0, 0, min(alpha.width, 1), min(alpha.height, 1)))]
+    left = int(np.flatnonzero(ink.any(axis=0))[0])
+
+    # A line ends where the gap to the next ink row is wide enough
+    breaks = np.flatnonzero(np.diff(ink_rows) > settings.HANDWRITING_LINE_GAP)
+    tops = ink_rows[np.concatenate(([0], breaks + 1))]
+    bottoms = ink_rows[np.concatenate((breaks, [ink_rows.size - 1]))] + 1
+
+    lines = []
+    for top, bottom in zip(tops, bottoms):
+        right = int(np.flatnonzero(ink[top:bottom].any(axis=0))[-1]) + 1
+        lines.append(ink_to_png(alpha, (left, int(top), right, int(bottom))))
+    return lines
+
+
+def load_ink(image: IO[bytes] | Strokes, fit_input_height: bool = False) -> Image.Image:
+    """Get the ink of an uploaded code block as an 8-bit mask
+
+    Args:
+        image (IO[bytes] | Strokes): The uploaded RGBA image, or the block's strokes
+        fit_input_height (bool): Whether strokes may be drawn already shrunk to fit
+            settings.HANDWRITING_INPUT_HEIGHT, as preprocess_image would shrink them
+
+    Returns:
+        Image.Image: The mask, nonzero wherever there is ink
+    """
+    if isinstance(image, dict):
+        return rasterize_strokes(image, fit_input_height)
+    with Image.open(image) as img:
+        # Ink is wherever the canvas is not transparent
+        return img.getchannel("A")
+
+
+def parse_strokes(strokes: Any) -> Strokes:
+    """Check the strokes of a code block uploaded in place of its image
+
+    Args:
+        strokes (Any): Decoded JSON object with the width and height of the code
+            block and its strokes, each with a width and a flat list of points
+            relative to the block's top left corner:
+
+                {"width": 200, "height": 100,
+                 "strokes": [{"width": 3, "points": [x0, y0, x1, y1, ...]}, ...]}
+
+    Raises:
+        ValueError: If the strokes are malformed or the block is too large
+
+    Returns:
+        Strokes: The strokes, with each stroke's points as an array of (x, y) rows
+    """
+    if not isinstance(strokes, dict) or not isinstance(strokes.get("strokes"), list):
+        raise ValueError("strokes must be a JSON object with a list of strokes")
+    width, height = strokes.get("width"), strokes.get("height")
+    if not all(
+        isinstance(side, (int, float)) and 0 < side <= MAX_STROKES_SIZE
+        for side in (width, height)
+    ):
+        raise ValueError(f"width and height must be between 0 and {MAX_STROKES_SIZE}")
+
+    parsed = []
+    for stroke in strokes["strokes"]:
+        try:
+            points = np.asarray(stroke["points"], dtype=float).reshape(-1, 2)
+            stroke_width = float(stroke["width"])
+        except (TypeError, KeyError, ValueError) as e:
+            raise ValueError("each stroke needs a width and a list of points") from e
+        if len(points) == 0 or not np.isfinite(points).all() or not stroke_width > 0:
+            raise ValueError("each stroke needs a positive width and a list of points")
+        parsed.append({"width": stroke_width, "points": points})
+    return {"width": width, "height": height, "strokes": parsed}
+
+
+def rasterize_strokes(strokes: Strokes, fit_input_height: bool = False) -> Image.Image:
+    """Draw the strokes of a code block as an ink mask, as the frontend would draw them
+
+    Args:
+        strokes (Strokes): The strokes, from parse_strokes
+        fit_input_height (bool): Whether to draw the strokes shrunk so their ink
+            and margin fit settings.HANDWRITING_INPUT_HEIGHT, instead of drawing
+            them at full size for preprocess_image to shrink
+
+    Returns:
+        Image.Image: The mask, 255 wherever there is ink
+    """
+    scale = 1.0
+    # Height left for the ink once preprocess_image adds its margin
+    room = settings.HANDWRITING_INPUT_HEIGHT - 2 * settings.HANDWRITING_CROP_MARGIN
+    if fit_input_height and settings.HANDWRITING_INPUT_HEIGHT and strokes["strokes"]:
+        top = min(
+            stroke["points"][:, 1].min() - stroke["width"] / 2
+            for stroke in strokes["strokes"]
+        )
+        bottom = max(
+            stroke["points"][:, 1].max() + stroke["width"] / 2
+            for stroke in strokes["strokes"]
+        )
+        ink_height = min(bottom, strokes["height"]) - max(top, 0)
+        if 0 < room < ink_height:
+            scale = room / ink_height
+
+    mask = Image.new(
+        "L",
+        (
+            max(math.ceil(strokes["width"] * scale), 1),
+            max(math.ceil(strokes["height"] * scale), 1),
+        ),
+    )
+    draw = ImageDraw.Draw(mask)
+    for stroke in strokes["strokes"]:
+        points = stroke["points"] * scale
+        width = stroke["width"] * scale
+        if len(points) > 1:
+            draw.line(
+                points.ravel().tolist(),
+                fill=255,
+                width=max(round(width), 1),
+                joint="curve",
+            )
+        # Round the ends of the stroke, or draw it as a dot if it has one point
+        radius = width / 2
+        for x, y in {tuple(points[0]), tuple(points[-1])}:
+            draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=255)
+    return mask
+
+
+def ink_to_png(alpha: Image.Image, bbox: tuple[int, int, int, int]) -> BytesIO:
+    """Crop ink from a code block image and encode it for the handwriting server
+
+    Args:
+        alpha (Image.Image): The alpha channel of the code block image
+        bbox (tuple[int, int, int, int]): Box around the ink to keep, which is
+            widened by settings.HANDWRITING_CROP_MARGIN
+
+    Returns:
+        BytesIO: The grayscale PNG, rewound to the start
+    """
+    margin = settings.HANDWRITING_CROP_MARGIN
+    left, top, right, bottom = bbox
+    ink = alpha.crop(
+        (
+            max(left - margin, 0),
+            max(top - margin, 0),
+            min(right + margin, alpha.width),
+            min(bottom + margin, alpha.height),
+        )
+    )
+
+    height = settings.HANDWRITING_INPUT_HEIGHT
+    if height and ink.height > height:
+        width = max(round(ink.width * height / ink.height), 1)
+        ink = ink.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+    # Invert so the ink is black on white
+    grayscale = ink.point(_INVERT)
+
+    temp_image = BytesIO()
+    grayscale.save(temp_image, format="PNG")
+    temp_image.seek(0)
+    return temp_image
+
+
+_INVERT = [255 - value for value in range(256)]
+
+
+def create_transcription(
+    json_response: dict[str, Any], compact: bool = False
+) -> dict[str, Any]:
+    """Build the /image_to_text response from the handwriting server's predictions
+
+    Args:
+        json_response (dict[str, Any]): The handwriting server's response, with the
+            top predicted characters (top_preds) and their probabilities (top_probs)
+        compact (bool): Whether to give the predictions in the compact format (see
+            compact_predictions), if they fit it
+
+    Returns:
+        dict[str, Any]: The predicted text and the predictions for each character
+    """
+    top_characters = json_response["top_preds"]
+    top_character_probs = json_response["top_probs"]
+
+    code_block_predictions_dict = (
+        compact_predictions(top_characters, top_character_probs) if compact else None
+    )
+    if code_block_predictions_dict is None:
+        code_block_predictions_dict = {
+            "predictions": [
+                [
+                    {"character": character, "probability": probability}
+                    for character, probability in zip(characters, probabilities)
+                ]
+                for characters, probabilities in zip(
+                    top_characters, top_character_probs
+                )
+            ]
+        }
+    predicted_text = create_predicted_code_block(code_block_predictions_dict)
+
+    return {
+        "predicted_text": predicted_text,
+        "predictions": code_block_predictions_dict,
+    }
+
+
+# Stands in for an empty prediction in the compact format
+_NO_CHARACTER = "\0"
+
+
+def compact_predictions(
+    top_characters: list[list[str]], top_character_probs: list[list[float]]
+) -> dict[str, Any] | None:
+    """Pack character predictions into the compact format
+
+    The compact format has one string per rank, whose nth character is that rank's
+    prediction for the nth position ("\\0" for an empty prediction), and the
+    probabilities as whole percentages in a flat list, position by position:
+
+        {"format": "compact", "ranks": ["ab", "ba"], "probabilities": [80, 20, 90, 10]}
+
+    Args:
+        top_characters (list[list[str]]): Top predicted characters at each position
+        top_character_probs (list[list[float]]): Their probabilities
+
+    Returns:
+        dict[str, Any] | None: The compact predictions, or None if they do not fit
+            the format because a prediction is not a single character or positions
+            have different numbers of predictions
+    """
+    try:
+        characters = np.array(top_characters, dtype=str)
+        probabilities = np.array(top_character_probs, dtype=float)
+    except ValueError:
+        return None
+    if characters.size == 0:
+        return {"format": "compact", "ranks": [], "probabilities": []}
+    # A unicode array's items are 4 bytes per character
+    if (
+        characters.ndim != 2
+        or characters.shape != probabilities.shape
+        or characters.dtype.itemsize > 4
+    ):
+        return None
+
+    return {
+        "format": "compact",
+        "ranks": [
+            "".join(character or _NO_CHARACTER for character in rank)
+            for rank in characters.T.tolist()
+        ],
+        "probabilities": np.rint(probabilities * 100).astype(np.uint8).ravel().tolist(),
+    }
+
+
 # Get the top predicted character for each position and construct a string
 def create_predicted_code_block(
-    code_block_prediction_dict: dict[str, list[list[str | float]]],
+    code_block_prediction_dict: dict[str, Any],
 ) -> str:
     """Generates the string from the predicted characters
 
     Args:
-        code_block_prediction_dict (dict[str, list[list[str  |  float]]]): Character predictions
+        code_block_prediction_dict (dict[str, Any]): Character predictions, in
+            either format create_transcription gives
 
     Returns:
         str: Predicted string
     """
+    if code_block_prediction_dict.get("format") == "compact":
+        ranks = code_block_prediction_dict["ranks"]
+        return ranks[0].replace(_NO_CHARACTER, "") if ranks else ""
+
     predicted_characters_list = []
     all_top_predictions = code_block_prediction_dict["predictions"]
 
@@ -4,5 +4,10 @@ if [ "$DJANGO_ENV" = "development" ]; then
 else
     poetry run python ./manage.py collectstatic
     poetry run python ./manage.py migrate
-    poetry run gunicorn --bind 0.0.0.0:"${PORT:-5000}" thesite.wsgi:application
+    if [ "$SERVER_MODE" = "asgi" ]; then
+        # Async views: one worker process serves many in-flight executions
+        poetry run uvicorn --host 0.0.0.0 --port "${PORT:-5000}" --workers "${WEB_CONCURRENCY:-1}" thesite.asgi:application
+    else
+        poetry run gunicorn --bind 0.0.0.0:"${PORT:-5000}" thesite.wsgi:application
+    fi
 fi
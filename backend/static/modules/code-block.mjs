@@ -4,6 +4,7 @@
 
 import { onEvent } from './reactivity.mjs';
 import * as shapeUtils from './shapeUtils.mjs';
+import { expandPredictions } from './predictions.mjs';
 
 const code_block_template = `
 <link rel="stylesheet" href="/static/code_block.css">
@@ -35,6 +36,88 @@ const code_block_template = `
 
 const csrftoken = document.querySelector('[name=csrfmiddlewaretoken]')?.value;
 
+/**
+ * Parse a streamed response body as Server-Sent Events.
+ *
+ * @param {Response} response - A response with a text/event-stream body.
+ * @yields {{event: string, data: any}} Each event, with its JSON data parsed.
+ */
+async function* readServerSentEvents(response) {
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = "";
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done)
+            return;
+        buffer += value;
+        // Events are separated by a blank line; the last chunk may be incomplete.
+        const chunks = buffer.split("\n\n");
+        buffer = chunks.pop();
+        for (const chunk of chunks) {
+            let event = "message";
+            let data = "";
+            for (const line of chunk.split("\n")) {
+                if (line.startsWith("event: "))
+                    event = line.slice("event: ".length);
+                else if (line.startsWith("data: "))
+                    data += line.slice("data: ".length);
+            }
+            yield { event: event, data: JSON.parse(data) };
+        }
+    }
+}
+
+// Milliseconds between checks on a queued transcription
+const TRANSCRIPTION_POLL_INTERVAL = 200;
+// Times a transcription is resubmitted when the server asks us to come back later
+const TRANSCRIPTION_SUBMIT_ATTEMPTS = 3;
+// Milliseconds the pen must be idle before a stale block is transcribed ahead of being run
+const SPECULATION_DELAY = 800;
+
+const sleep = (milliseconds) => new Promise((resolve) => setTimeout(resolve, milliseconds));
+
+/**
+ * Queue a transcription on the server and wait for its result.
+ *
+ * @param {FormData} imageFormData - The image and model_name to transcribe.
+ * @returns {Promise<Object>} The transcription, with predicted_text and predictions.
+ * @throws {Error} If the transcription failed.
+ */
+async function requestTranscription(imageFormData) {
+    let job_id;
+    for (let attempt = 1; job_id === undefined; attempt++) {
+        const rsp = await fetch("/transcription_jobs/", {
+            method: "POST",
+            body: imageFormData,
+            headers: {
+                "X-CSRFTOKEN": csrftoken
+            }
+        });
+        const json = await rsp.json();
+        if (rsp.ok && json.status == "done") {
+            // The block was already transcribed speculatively
+            return json.transcription;
+        } else if (rsp.ok) {
+            job_id = json.job_id;
+        } else if (rsp.headers.has("Retry-After") && attempt < TRANSCRIPTION_SUBMIT_ATTEMPTS) {
+            // The server is busy, so wait as long as it asks before trying again
+            await sleep(1000 * Number(rsp.headers.get("Retry-After")));
+        } else {
+            throw new Error(json.error);
+        }
+    }
+
+    while (true) {
+        await sleep(TRANSCRIPTION_POLL_INTERVAL);
+        const rsp = await fetch(`/transcription_jobs/${job_id}/`);
+        const json = await rsp.json();
+        if (!rsp.ok || json.status == "failed")
+            throw new Error(json.error);
+        if (json.status == "done")
+            return json.transcription;
+    }
+}
+
 /**
  * A code block element, that can be used to run handwritten code.
  */
@@ -69,6 +152,10 @@ export class CodeBlock extends HTMLElement {
         "predictions"
     ];
 
+    /** Identifies the code block to the server for speculative transcription. */
+    #block_id = crypto.randomUUID();
+    /** Timer for the speculative transcription of the block once the pen is idle. */
+    #speculation_timer;
     /** The region of the whiteboard that is selected for evaluation. */
     #selection;
     /** X coordinate where selection started. */
@@ -246,36 +333,64 @@ export class CodeBlock extends HTMLElement {
         // Re-enable the run button now code has executed.
         this.#run.disabled = false;
     }
-    async transcribeCodeBlockImage() {
-        let selectionContents = await this.whiteboard.extractCode(DOMRect.fromRect(this.dataset));
+
+    /**
+     * The form data of a request to transcribe the code block.
+     * @returns {FormData}
+     */
+    #transcriptionFormData() {
+        // The strokes are far smaller than an image of them, and are drawn at the
+        // model's resolution by the server
+        let strokes = this.whiteboard.extractStrokes(DOMRect.fromRect(this.dataset));
 
         let language = this.getAttribute("language");
         let complete_model = this.#selectedModel.value + "-" + language;
 
-        // Put the screen capture image into FormData object
+        // Put the code strokes into FormData object
         const imageFormData = new FormData();
-        imageFormData.append("img", selectionContents); // Add the image file to the form data
+        imageFormData.append("strokes", JSON.stringify(strokes));
         imageFormData.append("name", "image_unique_id");
         imageFormData.append("model_name", complete_model);
+        imageFormData.append("predictions_format", "compact");
+        imageFormData.append("block_id", this.#block_id);
+        return imageFormData;
+    }
 
-        return fetch("/image_to_text/", {
-            method: "POST",
-            body: imageFormData,
-            headers: {
-                "X-CSRFTOKEN": csrftoken
-            }
-        })
-            .then((rsp) => rsp.json())
+    /**
+     * Transcribe the block once the pen has been idle for a while, so the
+     * transcription is ready by the time the block is run.
+     */
+    #scheduleSpeculation() {
+        clearTimeout(this.#speculation_timer);
+        this.#speculation_timer = setTimeout(() => {
+            if (this.getAttribute("state") != "stale" || !this.isConnected)
+                return;
+            // The block is transcribed again when it is run if this fails
+            fetch("/speculative_transcriptions/", {
+                method: "POST",
+                body: this.#transcriptionFormData(),
+                headers: {
+                    "X-CSRFTOKEN": csrftoken
+                }
+            }).catch((error) => console.debug("Speculative transcription failed:", error));
+        }, SPECULATION_DELAY);
+    }
+
+    async transcribeCodeBlockImage() {
+        clearTimeout(this.#speculation_timer);
+
+        // If the transcription fails, the current one is kept
+        return requestTranscription(this.#transcriptionFormData())
             .then((json) => {
                 // Set the predicted text attribute to transcribed text and display in text box
                 this.setAttribute("predicted-text", json.predicted_text);
                 this.#text.textContent = json.predicted_text;
-                this.setAttribute("predictions", JSON.stringify(json.predictions["predictions"]));
+                this.setAttribute("predictions", JSON.stringify(json.predictions));
 
                 // Update the change character predictions UI
-                this.#predictions.value = JSON.stringify(json.predictions["predictions"]);
+                this.#predictions.value = JSON.stringify(json.predictions);
                 try {
-                    this.predictions_dict = json.predictions["predictions"]
+                    this.predictions_dict = expandPredictions(json.predictions);
                 }
                 catch (error) {
                     console.log("Error loading predictions dictionary: " + error)
@@ -370,7 +485,7 @@ export class CodeBlock extends HTMLElement {
         executeFormData.append("language", this.getAttribute("language"));
         executeFormData.append("code", cleaned_text);
 
-        return fetch("/execute/", {
+        return fetch("/execute_stream/", {
             method: "POST",
             body: executeFormData,
             credentials: 'include',
@@ -378,17 +493,19 @@ export class CodeBlock extends HTMLElement {
                 "X-CSRFTOKEN": csrftoken
             }
         })
-            .then((rsp) => rsp.json())
-            .then((json) => {
+            .then(async (rsp) => {
                 var output = "";
-                // Loop through each line of output from /execute response
-                for (const line of json.output_stream) {
-                    // success = line.success
-                    // content_type = line.type
-                    output += line.content
+                this.setAttribute("execution-output", output);
+                // Render each line of output as soon as the server streams it
+                for await (const event of readServerSentEvents(rsp)) {
+                    if (event.event !== "output")
+                        continue;
+                    // success = event.data.success
+                    // content_type = event.data.type
+                    output += event.data.content;
+                    var cleaned_output = output.replace(/\x1b\[[0-9;]*m/g, '');
+                    this.setAttribute("execution-output", cleaned_output);
                 }
-                var cleaned_output = output.replace(/\x1b\[[0-9;]*m/g, '');
-                this.setAttribute("execution-output", cleaned_output);
             })
             .catch((error) => console.error("Error:", error));
     }
@@ -535,6 +652,7 @@ export class CodeBlock extends HTMLElement {
                 this.#hideText();
                 this.#text_toggle.disabled = true;
                 this.#tick.style["display"] = "none";
+                this.#scheduleSpeculation();
                 break;
             case "running":
                 this.#controls.style["display"] = "block";
@@ -587,7 +705,7 @@ export class CodeBlock extends HTMLElement {
                 // Update the change character predictions UI
                 this.#predictions.value = newValue;
                 try {
-                    this.predictions_dict = JSON.parse(newValue);
+                    this.predictions_dict = expandPredictions(JSON.parse(newValue));
                 }
                 catch (error) {
                     console.log("Error loading predictions dictionary: " + error)
@@ -93,6 +93,24 @@ export class Line {
             ctx.stroke();
         }
     }
+
+    /**
+     * The line as a stroke for /image_to_text/, relative to the given clip rectangle
+     * @param {shapeUtils.Rectangle} clip
+     * @returns {?{width: float, points: float[]}} The line's width and flat list of
+     *     x, y coordinates, or null if it lies outside the clip rectangle
+     */
+    stroke(clip) {
+        if (!shapeUtils.rectanglesOverlapping(this.boundingRect, clip)) {
+            return null;
+        }
+        // A tenth of a pixel is finer than the model's input resolution
+        const round = (coordinate) => Math.round(coordinate * 10) / 10;
+        return {
+            width: this.lineWidth,
+            points: this.points.flatMap((point) => [round(point.x - clip.left), round(point.y - clip.top)]),
+        };
+    }
 }
 
 /**
@@ -127,6 +145,24 @@ export class Layer {
         }
     }
 
+    /**
+     * The strokes of the lines of this layer within the given clip rectangle
+     *
+     * @param {shapeUtils.Rectangle} clip
+     * @returns {{width: float, points: float[]}[]} See Line.stroke
+     */
+    strokes(clip) {
+        const strokes = [];
+        // lines is a sparse array, so we must use "in" rather than "of"
+        for (const i in this.lines) {
+            const stroke = this.lines[i].stroke(clip);
+            if (stroke !== null) {
+                strokes.push(stroke);
+            }
+        }
+        return strokes;
+    }
+
     /**
      * Add a new line
      *
@@ -0,0 +1,65 @@
+/**
+ * @module predictions
+ */
+
+/**
+ * A candidate for the character at one position of a code block
+ * @typedef {Object} CharacterPrediction
+ * @property {string} character - The predicted character
+ * @property {float} probability - The model's confidence in it, from 0 to 1
+ */
+
+/**
+ * Predictions in the compact format sent by /image_to_text/ when asked for with
+ * predictions_format=compact
+ * @typedef {Object} CompactPredictions
+ * @property {string} format - "compact"
+ * @property {string[]} ranks - For each rank, a string whose nth character is the
+ *     prediction of that rank for the nth position ("\0" for an empty prediction)
+ * @property {int[]} probabilities - The probabilities as whole percentages,
+ *     position by position
+ */
+
+/**
+ * Predictions as a list of candidates per position, which older notebooks were
+ * saved with and /image_to_text/ still sends when they do not fit the compact format
+ * @typedef {Object} ListedPredictions
+ * @property {CharacterPrediction[][]} predictions - The candidates at each position
+ */
+
+/**
+ * Get the candidates for each position of a code block from its predictions.
+ * Accepts both the compact format and the list of candidates per position, bare
+ * or wrapped in a predictions field.
+ * @param {CompactPredictions|ListedPredictions|CharacterPrediction[][]} predictions
+ * @returns {CharacterPrediction[][]} The candidates at each position, most likely first
+ */
+export function expandPredictions(predictions) {
+    if (Array.isArray(predictions)) {
+        return predictions;
+    }
+    if (Array.isArray(predictions?.predictions)) {
+        return predictions.predictions;
+    }
+    if (predictions?.format !== "compact") {
+        return [];
+    }
+
+    // Split into code points, as each position is one character
+    const ranks = predictions.ranks.map((rank) => Array.from(rank));
+    const positions = ranks.length ? ranks[0].length : 0;
+    const expanded = [];
+    for (let i = 0; i < positions; i++) {
+        const candidates = [];
+        ranks.forEach((rank, r) => {
+            const probability = predictions.probabilities[i * ranks.length + r] / 100;
+            // Lower ranks are padded with certain-to-be-wrong empty predictions
+            if (r > 0 && rank[i] === "\0" && probability === 0) {
+                return;
+            }
+            candidates.push({ character: rank[i] === "\0" ? "" : rank[i], probability });
+        });
+        expanded.push(candidates);
+    }
+    return expanded;
+}
@@ -0,0 +1,49 @@
+import { expandPredictions } from './predictions.mjs';
+
+test('expands compact predictions',
+    () => {
+        expect(expandPredictions({
+            format: "compact",
+            ranks: ["a\n", "b\0"],
+            probabilities: [80, 20, 100, 0],
+        })).toEqual([
+            [{ character: "a", probability: 0.8 }, { character: "b", probability: 0.2 }],
+            [{ character: "\n", probability: 1 }],
+        ]);
+    }
+)
+
+test('keeps empty predictions',
+    () => {
+        expect(expandPredictions({
+            format: "compact",
+            ranks: ["\0", "x"],
+            probabilities: [60, 40],
+        })).toEqual([
+            [{ character: "", probability: 0.6 }, { character: "x", probability: 0.4 }],
+        ]);
+    }
+)
+
+test('passes through predictions saved by older versions',
+    () => {
+        const predictions = [[{ character: "a", probability: 0.8 }]];
+        expect(expandPredictions(predictions)).toBe(predictions);
+    }
+)
+
+test('unwraps predictions listed per position',
+    () => {
+        // Sent when the predictions do not fit the compact format, and saved so by
+        // older notebooks
+        const predictions = [[{ character: "ab", probability: 0.8 }], []];
+        expect(expandPredictions({ predictions })).toBe(predictions);
+    }
+)
+
+test('handles missing predictions',
+    () => {
+        expect(expandPredictions({})).toEqual([]);
+        expect(expandPredictions({ format: "compact", ranks: [], probabilities: [] })).toEqual([]);
+    }
+)
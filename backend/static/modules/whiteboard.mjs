@@ -189,8 +189,19 @@ export class Whiteboard extends HTMLElement {
     #notebook_name;
     #notebook_name_label;
     #notebook_id;
-    #notebooks;
+    /** The revision of the notebook on the server that was last saved or loaded. */
+    #notebook_revision;
+    /**
+     * The notebook as last saved or loaded, from #notebookParts, or null if the
+     * server's copy is unknown and the whole notebook must be saved.
+     */
+    #saved_parts;
+    /** Ids of the pages whose strokes have not been fetched since opening the notebook. */
+    #unloaded_pages;
+    /** Fetches of the strokes of pages, by page id. */
+    #page_loads;
     #notebooks_dialog;
+    #more_notebooks;
     #restart_kernel;
 
     constructor() {
@@ -206,8 +217,12 @@ export class Whiteboard extends HTMLElement {
         this.#notebook_name = "";
         this.#notebook_name_label = shadowRoot.getElementById("notebook-name-label");
         this.#notebook_id = -1;
-        this.#notebooks = null;
+        this.#notebook_revision = null;
+        this.#saved_parts = null;
+        this.#unloaded_pages = new Set();
+        this.#page_loads = new Map();
         this.#notebooks_dialog = document.getElementById("notebooks-dialog");
+        this.#more_notebooks = document.getElementById("more-notebooks");
         this.#restart_kernel = shadowRoot.getElementById("restart-kernel");
 
         const saveNotebookDialog = document.getElementById("save-notebook-dialog");
@@ -235,15 +250,14 @@ export class Whiteboard extends HTMLElement {
             this.#notebook_name = "";
             this.#notebook_name_label.textContent = "Untitled Notebook";
             this.#notebook_id = -1;
+            this.#saved_parts = null;
             localStorage.setItem("current_notebook_id", -1);
 
         });
 
         // Save the notebook on the server
         document.getElementById("save").addEventListener("click", async () => {
-            const jsonString = this.serialiseNotebook();
             const notebookFormData = new FormData();
-            notebookFormData.append("canvas", jsonString);
 
             if (this.#notebook_name === "") {
                 saveNotebookDialog.showModal();
@@ -308,6 +322,7 @@ export class Whiteboard extends HTMLElement {
                         this.#notebook_name = file.name.replace(".json", "");
                         this.#notebook_name_label.textContent = this.#notebook_name;
                         this.loadNotebook(event.target.result);
+                        this.#saved_parts = null;
                         localStorage.setItem("current_notebook_id", this.#notebook_id);
                     } catch (error) {
                         console.error("Invalid JSON file:", error);
@@ -349,6 +364,7 @@ export class Whiteboard extends HTMLElement {
         });
 
         this.applyNotebookEventListeners();
+        this.#more_notebooks.addEventListener("click", () => this.loadMoreNotebooks());
 
         // Default default language (used on hard reload)
         this.dataset.defaultLanguage = "python3";
@@ -402,28 +418,32 @@ export class Whiteboard extends HTMLElement {
         var current_notebook_id = localStorage.getItem("current_notebook_id");
         this.newPage();
         if ((current_notebook_id != null) && (current_notebook_id != -1)) {
-            const notebookFormData = new FormData();
-            notebookFormData.append("notebook_id", current_notebook_id);
-            fetch("/get_notebook_data/", {
-                method: "POST",
-                body: notebookFormData,
-                credentials: 'include',
-                headers: {
-                    "X-CSRFTOKEN": csrftoken
-                }
-            })
-                .then((rsp) => rsp.json())
-                .then((json) => {
-                    // Load the returned notebook and display notebook name
-                    this.loadNotebook(json["notebook_data"]);
-                    this.#notebook_name = json["notebook_name"]
-                    this.#notebook_name_label.textContent = json["notebook_name"];
-                    this.#notebook_id = json["notebook_id"];
-                })
+            this.openNotebook(current_notebook_id)
                 .catch((error) => console.error("Error:", error));
         }
     }
 
+    /**
+     * Open a notebook saved on the server. Only its manifest is fetched here: the strokes of
+     * each page are fetched when the page is first shown.
+     *
+     * @param {number | string} notebook_id
+     */
+    async openNotebook(notebook_id) {
+        const rsp = await fetch(`/notebooks/${notebook_id}/`, { credentials: "include" });
+        const json = await rsp.json();
+        if (!rsp.ok)
+            throw new Error(json.error);
+
+        // Load the returned notebook and display notebook name
+        this.#notebook_id = json["notebook_id"];
+        this.loadManifest(json);
+        this.#notebook_name = json["notebook_name"]
+        this.#notebook_name_label.textContent = json["notebook_name"];
+        this.#notebook_revision = json["revision"];
+        this.#saved_parts = this.#notebookParts();
+    }
+
     /**
      * Perform the necessary operations to handle a change in the given region of the current page.
      * @param {shapeUtils.Rectangle} region
@@ -436,11 +456,22 @@ export class Whiteboard extends HTMLElement {
     }
 
     /**
+     * Every page must be loaded first, see loadAllPages.
+     *
      * @returns {string} The current notebook state as serialised JSON.
      */
     serialiseNotebook() {
         this.#active_page.scrollLeft = this.#container.scrollLeft;
         this.#active_page.scrollTop = this.#container.scrollTop;
+
+        var whiteboard_dict = { "pages": Array.from(this.#pages.entries()), "code_blocks": this.#codeBlockList() }
+        const jsonString = JSON.stringify(whiteboard_dict, null, 0)
+
+        return jsonString
+    }
+
+    /** @returns {Object[]} The attributes of each code block. */
+    #codeBlockList() {
         var code_block_list = []
         for (const block of this.#ui.querySelectorAll("code-block")) {
             // Convert HTML elements attributes to dict
@@ -450,15 +481,71 @@ export class Whiteboard extends HTMLElement {
             }, {});
             code_block_list.push(attributes_dict);
         }
+        return code_block_list;
+    }
 
-        var whiteboard_dict = { "pages": Array.from(this.#pages.entries()), "code_blocks": code_block_list }
-        const jsonString = JSON.stringify(whiteboard_dict, null, 0)
+    /**
+     * The current notebook state, serialised in the parts it is saved in by patches.
+     *
+     * @returns {{pages: Map<number, {page: string, layers: ?string[]}>, page_order: number[], code_blocks: string}}
+     */
+    #notebookParts() {
+        this.#active_page.scrollLeft = this.#container.scrollLeft;
+        this.#active_page.scrollTop = this.#container.scrollTop;
+        const pages = new Map();
+        for (const [key, page] of this.#pages) {
+            const { layers, ...fields } = page;
+            pages.set(key, {
+                page: JSON.stringify(fields),
+                // Pages that have not been fetched are unchanged
+                layers: this.#unloaded_pages.has(key) ? null : layers.map((layer) => JSON.stringify(layer)),
+            });
+        }
+        return {
+            pages: pages,
+            page_order: Array.from(this.#pages.keys()),
+            code_blocks: JSON.stringify(this.#codeBlockList()),
+        };
+    }
 
-        return jsonString
+    /**
+     * The changes from the notebook as last saved or loaded to the given state, in the
+     * format save_notebook applies: the changed pages and layers, the order of the
+     * pages, and the code blocks if any changed.
+     *
+     * @param {Object} parts - The current notebook state, from #notebookParts.
+     * @returns {Object} The patch.
+     */
+    #notebookPatch(parts) {
+        const patch = { pages: {}, page_order: parts.page_order };
+        for (const [key, page] of parts.pages) {
+            const saved = this.#saved_parts.pages.get(key);
+            const change = {};
+            if (saved?.page !== page.page)
+                change.page = JSON.parse(page.page);
+            page.layers?.forEach((layer, index) => {
+                if (saved?.layers?.[index] !== layer) {
+                    change.layers ??= {};
+                    change.layers[index] = JSON.parse(layer);
+                }
+            });
+            if (Object.keys(change).length > 0)
+                patch.pages[key] = change;
+        }
+        if (parts.code_blocks !== this.#saved_parts.code_blocks)
+            patch.code_blocks = JSON.parse(parts.code_blocks);
+        return patch;
     }
 
     /** Download a local copy of the current notebook. */
-    downloadNotebook(notebook_name) {
+    async downloadNotebook(notebook_name) {
+        try {
+            await this.loadAllPages();
+        } catch (error) {
+            console.error("Error:", error);
+            alert("Could not download Notebook: " + error.message);
+            return;
+        }
         const jsonString = this.serialiseNotebook();
         const blob = new Blob([jsonString], { type: "application/json" }); // Create a Blob
         const link = document.createElement("a"); // Create a temporary link
@@ -470,86 +557,128 @@ export class Whiteboard extends HTMLElement {
     }
 
     /**
-     * Save the current notebook to the server.
+     * Save the current notebook to the server, sending only what changed since it was last
+     * saved or loaded when the server's copy is known. If the notebook has been saved from
+     * elsewhere since, it is only overwritten as a whole if the user confirms it.
      *
-     * @param {FormData} notebookFormData - Form data containing the notebook, its name and ID.
+     * @param {FormData} notebookFormData - Form data containing the notebook's name and ID.
      */
     async saveNotebook(notebookFormData) {
+        const post = () => fetch("/save_notebook/", {
+            method: "POST",
+            body: notebookFormData,
+            credentials: "include",
+            headers: { "X-CSRFTOKEN": csrftoken }
+        });
+        const parts = this.#notebookParts();
         try {
-            const response = await fetch("/save_notebook/", {
-                method: "POST",
-                body: notebookFormData,
-                credentials: "include",
-                headers: { "X-CSRFTOKEN": csrftoken }
-            });
+            let response;
+            if (notebookFormData.get("notebook_id") != -1 && this.#saved_parts !== null) {
+                notebookFormData.set("patch", JSON.stringify(this.#notebookPatch(parts)));
+                notebookFormData.set("base_revision", this.#notebook_revision);
+                response = await post();
+            }
+            if (response?.status == 409) {
+                // Saving the whole notebook would throw away what the other save changed
+                if (!confirm("This notebook has been saved from elsewhere since you opened it. \nOverwrite those changes with yours?")) {
+                    alert("Notebook not saved. Reopen it to see the other changes, or download a copy of yours first.");
+                    return;
+                }
+                response = undefined;
+            }
+            if (response === undefined) {
+                notebookFormData.delete("patch");
+                notebookFormData.delete("base_revision");
+                await this.loadAllPages();
+                notebookFormData.set("canvas", this.serialiseNotebook());
+                response = await post();
+            }
             const json = await response.json();
 
-            this.#notebooks = json["notebooks"];
             this.#notebook_id = json["notebook_id"];
+            this.#notebook_revision = json["revision"];
+            this.#saved_parts = parts;
 
             // Show saved popup
             const savedPopup = document.getElementById("saved-popup");
             savedPopup.className = "show popup";
             setTimeout(() => { savedPopup.className = savedPopup.className.replace("show", ""); }, 2900);
 
-            this.updateNotebookList();
+            this.updateNotebookList(json["notebook"]);
             localStorage.setItem("current_notebook_id", this.#notebook_id);
         } catch (error) {
             console.error("Error:", error);
         }
     }
 
-    /** Generate an interactive list of the notebooks the current user has saved on the server. */
-    updateNotebookList() {
+    /**
+     * Move a notebook the current user has just saved to the top of the list of their notebooks.
+     *
+     * @param {{id: number, notebook_name: string, notebook_modified_at: string}} notebook
+     */
+    updateNotebookList(notebook) {
         const container = document.getElementById("notebooks-container");
-        container.innerHTML = ""; // Clear existing notebooks
-
-        this.#notebooks.forEach(notebook => {
-            const div = document.createElement("div");
-            div.classList.add("notebook-div");
-            div.setAttribute("data-notebook-id", notebook.id);
-            div.innerHTML = `
-                <div> ${notebook.notebook_name} </div>
-                <div> ${this.timeSince(notebook.notebook_modified_at)} </div>
-                <div>
-                    <button class="open-notebook material-symbols-outlined" data-notebook-id="${notebook.id}" title="Open Notebook">draw</button>
-                    <button class="delete-notebook material-symbols-outlined" data-notebook-id="${notebook.id}" title="Delete Notebook">delete</button>
-                </div>
-            `;
-            container.appendChild(div);
-        });
+        container.querySelector(`.notebook-div[data-notebook-id='${notebook.id}']`)?.remove();
+        container.prepend(this.notebookEntry(notebook));
+    }
 
-        this.applyNotebookEventListeners();
+    /** Add the next page of the current user's notebooks to the bottom of the list. */
+    async loadMoreNotebooks() {
+        const container = document.getElementById("notebooks-container");
+        const params = new URLSearchParams({ cursor: container.dataset.nextCursor });
+        try {
+            const response = await fetch(`/notebooks/?${params}`, { credentials: "include" });
+            const json = await response.json();
+            for (const notebook of json["notebooks"]) {
+                // Skip notebooks saved since the list was loaded, which are already at the top
+                if (!container.querySelector(`.notebook-div[data-notebook-id='${notebook.id}']`))
+                    container.appendChild(this.notebookEntry(notebook));
+            }
+            container.dataset.nextCursor = json["next_cursor"] ?? "";
+            this.#more_notebooks.hidden = json["next_cursor"] === null;
+        } catch (error) {
+            console.error("Error:", error);
+        }
     }
 
+    /**
+     * Create the interactive entry of a notebook in the list of the current user's notebooks.
+     *
+     * @param {{id: number, notebook_name: string, notebook_modified_at: string}} notebook
+     * @returns {HTMLDivElement}
+     */
+    notebookEntry(notebook) {
+        const div = document.createElement("div");
+        div.classList.add("notebook-div");
+        div.setAttribute("data-notebook-id", notebook.id);
+        div.innerHTML = `
+            <div> ${notebook.notebook_name} </div>
+            <div> ${this.timeSince(notebook.notebook_modified_at)} </div>
+            <div>
+                <button class="open-notebook material-symbols-outlined" data-notebook-id="${notebook.id}" title="Open Notebook">draw</button>
+                <button class="delete-notebook material-symbols-outlined" data-notebook-id="${notebook.id}" title="Delete Notebook">delete</button>
+            </div>
+        `;
+        this.applyNotebookEventListeners(div);
+        return div;
+    }
 
-    /** Add event listeners to all .open-notebook and .delete-notebook buttons */
-    applyNotebookEventListeners() {
+    /**
+     * Add event listeners to all .open-notebook and .delete-notebook buttons
+     *
+     * @param {ParentNode} root - The element containing the buttons.
+     */
+    applyNotebookEventListeners(root = document) {
         // Open notebook button for each notebook
-        document.querySelectorAll(".open-notebook").forEach(button => {
+        root.querySelectorAll(".open-notebook").forEach(button => {
             button.addEventListener("click", () => {
                 // Allow the user to cancel opening a new notebook
                 if (!confirm("Opening a notebook will delete any unsaved work \nAre you sure you want to continue?")) {
                     return;
                 }
                 let notebook_id = button.getAttribute("data-notebook-id");
-                const notebookFormData = new FormData();
-                notebookFormData.append("notebook_id", notebook_id);
-                return fetch("/get_notebook_data/", {
-                    method: "POST",
-                    body: notebookFormData,
-                    credentials: 'include',
-                    headers: {
-                        "X-CSRFTOKEN": csrftoken
-                    }
-                })
-                    .then((rsp) => rsp.json())
-                    .then((json) => {
-                        // Load the returned notebook and display notebook name
-                        this.loadNotebook(json["notebook_data"]);
-                        this.#notebook_name = json["notebook_name"]
-                        this.#notebook_name_label.textContent = json["notebook_name"];
-                        this.#notebook_id = json["notebook_id"];
+                return this.openNotebook(notebook_id)
+                    .then(() => {
                         localStorage.setItem("current_notebook_id", this.#notebook_id);
                         this.#notebooks_dialog.close();
                     })
@@ -559,7 +688,7 @@ export class Whiteboard extends HTMLElement {
         });
 
         // Delete notebook button for each notebook
-        document.querySelectorAll(".delete-notebook").forEach(button => {
+        root.querySelectorAll(".delete-notebook").forEach(button => {
             button.addEventListener("click", () => {
                 // Give the user a chance to cancel the action.
                 if (!confirm("Permanently delete this notebook?")) {
@@ -614,8 +743,8 @@ export class Whiteboard extends HTMLElement {
 
         // For each page in saved notebook
         for (const [key, page] of pages) {
-            // Create a new page
-            var page_id = this.newPage();
+            // Create a new page, keeping its key so later saves can patch it
+            var page_id = this.newPage(parseInt(key));
             this.#tab_bar.querySelector(`button[data-id='${page_id}'] > span`).textContent = page.name;
             this.#pages.get(page_id).name = page.name;
 
@@ -628,27 +757,7 @@ export class Whiteboard extends HTMLElement {
             // Load the page's scroll position (the Page object's scroll values will get set when switching to a different page)
             this.#container.scrollTo(page.scrollLeft, page.scrollTop);
 
-            // Reconstruct each line of code layer
-            var line_objs = [];
-            for (var code_line of page.layers[0].lines) {
-                if (code_line != null) {
-                    let line = new Line(code_line.color, code_line.lineWidth, code_line.points);
-                    line_objs.push(line);
-                }
-            }
-
-            this.#pages.get(page_id).layers[0].lines = line_objs
-
-            // Reconstruct each line of annotations layer
-            var line_objs = [];
-            for (var code_line of page.layers[1].lines) {
-                if (code_line != null) {
-                    let line = new Line(code_line.color, code_line.lineWidth, code_line.points);
-                    line_objs.push(line)
-                }
-            }
-
-            this.#pages.get(page_id).layers[1].lines = line_objs
+            this.#loadLayers(this.#pages.get(page_id), page.layers);
         }
 
         // Restore each code block
@@ -660,6 +769,110 @@ export class Whiteboard extends HTMLElement {
         this.switchToPage(first_page_id);
     }
 
+    /**
+     * Load a notebook from its manifest, leaving the strokes of each page to be fetched when
+     * the page is first shown.
+     *
+     * @param {Object} manifest - The notebook's manifest, from /notebooks/<notebook_id>/.
+     */
+    loadManifest(manifest) {
+        // Close all existing tabs
+        this.closeAllPages();
+
+        // Create a new pages map
+        this.#pages = new Map();
+
+        for (const page of manifest["pages"]) {
+            // Create a new page, keeping its key so its strokes can be fetched and patched
+            const page_id = this.newPage(parseInt(page.key));
+            this.#tab_bar.querySelector(`button[data-id='${page_id}'] > span`).textContent = page.name;
+            const new_page = this.#pages.get(page_id);
+            new_page.name = page.name;
+            new_page.scrollLeft = page.scrollLeft;
+            new_page.scrollTop = page.scrollTop;
+            this.#unloaded_pages.add(page_id);
+        }
+
+        // Restore each code block
+        for (const code_block of manifest["code_blocks"]) {
+            this.restoreSelection(code_block)
+        }
+
+        // Switch to the first page, which fetches its strokes
+        this.switchToPage(this.#pages.keys().next().value);
+    }
+
+    /**
+     * Fetch the strokes of a page of a notebook opened from its manifest, if they have not
+     * been already.
+     *
+     * @param {number} id - The id of the page.
+     * @returns {Promise<void>} Settles once the page is loaded or has failed to load.
+     */
+    loadPage(id) {
+        if (!this.#unloaded_pages.has(id)) {
+            return Promise.resolve();
+        }
+        if (!this.#page_loads.has(id)) {
+            const notebook_id = this.#notebook_id;
+            const load = fetch(`/notebooks/${notebook_id}/pages/${id}/`, { credentials: "include" })
+                .then(async (rsp) => {
+                    const json = await rsp.json();
+                    if (!rsp.ok)
+                        throw new Error(json.error);
+                    // Skip the page if another notebook was loaded in the meantime
+                    if (notebook_id != this.#notebook_id || !this.#unloaded_pages.has(id))
+                        return;
+                    const page = this.#pages.get(id);
+                    this.#loadLayers(page, json["layers"]);
+                    this.#unloaded_pages.delete(id);
+                    // The page is as saved, so later saves only need to send changes to it
+                    const saved = this.#saved_parts?.pages.get(id);
+                    if (saved !== undefined)
+                        saved.layers = page.layers.map((layer) => JSON.stringify(layer));
+                    if (page === this.#active_page)
+                        this.render();
+                })
+                .catch((error) => {
+                    // Let the page be fetched again next time it is shown
+                    this.#page_loads.delete(id);
+                    console.error("Error:", error);
+                });
+            this.#page_loads.set(id, load);
+        }
+        return this.#page_loads.get(id);
+    }
+
+    /**
+     * Fetch the strokes of every page that has not been loaded yet.
+     *
+     * @throws {Error} If a page could not be loaded.
+     */
+    async loadAllPages() {
+        await Promise.all(Array.from(this.#unloaded_pages, (id) => this.loadPage(id)));
+        if (this.#unloaded_pages.size > 0)
+            throw new Error("Could not load every page of the notebook");
+    }
+
+    /**
+     * Reconstruct the lines of each layer of a page from their saved form.
+     *
+     * @param {Page} page
+     * @param {Object[]} layers - The saved layers of the page.
+     */
+    #loadLayers(page, layers) {
+        layers.forEach((layer, index) => {
+            var line_objs = [];
+            for (var code_line of layer.lines) {
+                if (code_line != null) {
+                    let line = new Line(code_line.color, code_line.lineWidth, code_line.points);
+                    line_objs.push(line);
+                }
+            }
+            page.layers[index].lines = line_objs;
+        });
+    }
+
     connectedCallback() {
         // Ensure the handwriting canvas is always resized to cover the visible area of the page.
         this.resizeCanvas();
@@ -731,13 +944,16 @@ export class Whiteboard extends HTMLElement {
      * Create a new page, and add a tab for it.
      * Make it the active page.
      *
+     * @param {number} [id] - The id of the page, if it is not to be a new unused one
      * @returns {string} The id of the new page
      */
-    newPage() {
+    newPage(id) {
         // Get an unused ID for the tab
-        let id = 1;
-        while (this.#pages.has(id)) {
-            id += 1;
+        if (id === undefined || Number.isNaN(id) || this.#pages.has(id)) {
+            id = 1;
+            while (this.#pages.has(id)) {
+                id += 1;
+            }
         }
 
         this.#pages.set(id, new Page(id));
@@ -834,6 +1050,14 @@ export class Whiteboard extends HTMLElement {
         this.#active_page.postUndoState();
 
         this.render();
+
+        // Fetch the page's strokes if need be, and its neighbours' ahead of them being shown
+        const ids = Array.from(this.#pages.keys());
+        const index = ids.indexOf(id);
+        for (const page_id of [ids[index], ids[index + 1], ids[index - 1]]) {
+            if (page_id !== undefined)
+                this.loadPage(page_id);
+        }
     }
 
     /**
@@ -868,6 +1092,7 @@ export class Whiteboard extends HTMLElement {
 
         // Delete the page and its associated tab
         this.#pages.delete(id);
+        this.#unloaded_pages.delete(id);
         page_tab.remove();
 
         // Delete associated code blocks
@@ -878,6 +1103,8 @@ export class Whiteboard extends HTMLElement {
 
     /** Close all existing pages */
     closeAllPages() {
+        this.#unloaded_pages.clear();
+        this.#page_loads.clear();
         for (var id of Array.from(this.#pages.keys())) {
             id = parseInt(id);
 
@@ -934,6 +1161,10 @@ export class Whiteboard extends HTMLElement {
         if (event.isPrimary)
             event.target.setPointerCapture(event.pointerId);
         let action = this.eventAction(event);
+        if ((action === "write" || action === "erase") && this.#unloaded_pages.has(this.#active_page.id)) {
+            // The page's strokes are still being fetched, and would replace any drawn now
+            return;
+        }
         switch (action) {
             case "erase":
                 this.erase(event.offsetX, event.offsetY);
@@ -1262,6 +1493,20 @@ export class Whiteboard extends HTMLElement {
         return codeCanvas.convertToBlob();
     }
 
+    /**
+     * Get the code strokes within the given rectangle, to be rasterized by the
+     * server instead of uploading an image of them
+     * @param {DOMRect} clip
+     * @returns {{width: float, height: float, strokes: {width: float, points: float[]}[]}}
+     */
+    extractStrokes(clip) {
+        return {
+            width: clip.width,
+            height: clip.height,
+            strokes: this.#active_page.layers[0].strokes(clip),
+        };
+    }
+
     /** Render the handwriting on the visible portion of the page. */
     render() {
         this.#drawing.clearRect(0, 0, this.#drawing.canvas.width, this.#drawing.canvas.height);
@@ -3,14 +3,23 @@ ASGI config for thesite project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+In production, set SERVER_MODE=asgi to serve this with uvicorn (see entrypoint.sh),
+which also routes the Jupyter and handwriting endpoints to their async views.
+The handler is Django's own, extended to stream their Server-Sent Events as
+they are produced (see backend/streaming.py).
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+
+from backend.streaming import StreamingASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'thesite.settings')
 
-application = get_asgi_application()
+# What get_asgi_application does, with the streaming handler
+django.setup(set_prefix=False)
+application = StreamingASGIHandler()
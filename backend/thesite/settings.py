@@ -127,6 +127,32 @@ DATABASES = (
 )
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/ref/settings/#caches
+
+# "shared" holds state that every worker process must see. The development server is
+# a single process, so it keeps it in memory; in production the workers share files
+# in SHARED_CACHE_LOCATION. Set SHARED_CACHE_BACKEND and SHARED_CACHE_LOCATION to use
+# e.g. Redis instead when workers run on several hosts.
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "shared": (
+        {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "shared",
+        }
+        if DEBUG
+        else {
+            "BACKEND": os.getenv(
+                "SHARED_CACHE_BACKEND",
+                "django.core.cache.backends.filebased.FileBasedCache",
+            ),
+            "LOCATION": os.getenv("SHARED_CACHE_LOCATION", "/tmp/enscribe-cache"),
+        }
+    ),
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -188,13 +214,136 @@ EMAIL_HOST_PASSWORD = os.getenv("EMAIL_PASSWORD")
 
 SITE_ID = 1
 
+# Serve the views that wait on the Jupyter and handwriting servers asynchronously.
+# Set SERVER_MODE=asgi to run under an ASGI server (see entrypoint.sh).
+ASYNC_VIEWS = os.getenv("SERVER_MODE") == "asgi"
+# Worker processes serving the app, read by gunicorn and uvicorn (see entrypoint.sh)
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
 # Jupyter Configuration
 
 JUPYTER_URL = os.getenv("JUPYTER_URL")
 JUPYTER_PORT = os.getenv("JUPYTER_PORT")
 JUPYTER_TOKEN = os.getenv("JUPYTER_TOKEN")
 
+# Timeouts (seconds) and connection pool size for Jupyter REST calls
+JUPYTER_CONNECT_TIMEOUT = float(os.getenv("JUPYTER_CONNECT_TIMEOUT", "3.05"))
+JUPYTER_READ_TIMEOUT = float(os.getenv("JUPYTER_READ_TIMEOUT", "30"))
+JUPYTER_POOL_SIZE = int(os.getenv("JUPYTER_POOL_SIZE", "10"))
+
+# Kernels per language started ahead of time for users running their first cell
+KERNEL_STANDBY_POOL = {
+    language: int(os.getenv("KERNEL_STANDBY_POOL_SIZE", "1"))
+    for language in ("python3", "dyalog_apl", "lambda-calculus")
+}
+
+# Seconds a kernel may go unused before it is shut down (0 to keep kernels forever)
+KERNEL_IDLE_TTL = float(os.getenv("KERNEL_IDLE_TTL", "3600"))
+# Seconds between sweeps for idle kernels (0 to disable the background sweep)
+KERNEL_REAP_INTERVAL = float(os.getenv("KERNEL_REAP_INTERVAL", "60"))
+# Most kernels kept on the Jupyter server, in total and per language (0 for no limit).
+# Least recently used kernels are shut down to make room for new ones.
+KERNEL_MAX_COUNT = int(os.getenv("KERNEL_MAX_COUNT", "0"))
+KERNEL_MAX_PER_LANGUAGE = {
+    "python3": int(os.getenv("PYTHON3_MAX_KERNELS", "0")),
+    "dyalog_apl": int(os.getenv("DYALOG_APL_MAX_KERNELS", "0")),
+    "lambda-calculus": int(os.getenv("LAMBDA_CALCULUS_MAX_KERNELS", "0")),
+}
+
+# Languages whose execution outputs are cached, comma separated (e.g. "lambda-calculus").
+# A cell is answered from the cache only when it was also the last cell run on its
+# kernel, so only list languages whose cells print the same output when run twice
+# in a row.
+EXECUTION_CACHE_LANGUAGES = [
+    language
+    for language in os.getenv("EXECUTION_CACHE_LANGUAGES", "").split(",")
+    if language
+]
+# Most execution results kept in the cache
+EXECUTION_CACHE_SIZE = int(os.getenv("EXECUTION_CACHE_SIZE", "1024"))
+
+# Seconds a cell may run before its kernel is interrupted, per language
+EXECUTION_DEADLINES = {
+    "python3": float(os.getenv("PYTHON3_DEADLINE", "60")),
+    "dyalog_apl": float(os.getenv("DYALOG_APL_DEADLINE", "60")),
+    "lambda-calculus": float(os.getenv("LAMBDA_CALCULUS_DEADLINE", "30")),
+}
+# Seconds to wait for a kernel to reply once it has been interrupted
+EXECUTION_RECV_TIMEOUT = float(os.getenv("EXECUTION_RECV_TIMEOUT", "10"))
+# Maximum bytes of output captured from one cell
+EXECUTION_OUTPUT_LIMIT = int(os.getenv("EXECUTION_OUTPUT_LIMIT", str(1024 * 1024)))
+
 # Handwriting server configuration
 
 HANDWRITING_URL = os.getenv("HANDWRITING_URL")
 HANDWRITING_PORT = os.getenv("HANDWRITING_PORT")
+# Addresses (host:port) of the handwriting server replicas, comma separated.
+# Defaults to the single server at HANDWRITING_URL:HANDWRITING_PORT.
+HANDWRITING_REPLICAS = os.getenv(
+    "HANDWRITING_REPLICAS", f"{HANDWRITING_URL}:{HANDWRITING_PORT}"
+).split(",")
+# Seconds between checks that each replica answers requests to HANDWRITING_HEALTH_PATH
+# (0 to only mark replicas down when requests to them fail)
+HANDWRITING_HEALTH_INTERVAL = float(os.getenv("HANDWRITING_HEALTH_INTERVAL", "10"))
+HANDWRITING_HEALTH_PATH = os.getenv("HANDWRITING_HEALTH_PATH", "/")
+HANDWRITING_HEALTH_TIMEOUT = float(os.getenv("HANDWRITING_HEALTH_TIMEOUT", "2"))
+# Outstanding requests that sending a transcription to a replica which has not
+# used its model yet counts as, so replicas with the model loaded are preferred
+HANDWRITING_MODEL_LOAD_PENALTY = int(os.getenv("HANDWRITING_MODEL_LOAD_PENALTY", "2"))
+
+# Seconds to wait to connect to the handwriting server, and for it to transcribe
+HANDWRITING_CONNECT_TIMEOUT = float(os.getenv("HANDWRITING_CONNECT_TIMEOUT", "3"))
+HANDWRITING_READ_TIMEOUT = float(os.getenv("HANDWRITING_READ_TIMEOUT", "60"))
+# Keep-alive connections to the handwriting server kept open by each process
+HANDWRITING_POOL_SIZE = int(os.getenv("HANDWRITING_POOL_SIZE", "10"))
+# Transcriptions each process sends to the handwriting server at once, across every
+# request and queued job (and separately for the async views' event loop)
+HANDWRITING_CONCURRENCY = int(os.getenv("HANDWRITING_CONCURRENCY", "8"))
+# Images of a batch transcription request preprocessed and transcribed at once
+HANDWRITING_BATCH_CONCURRENCY = int(os.getenv("HANDWRITING_BATCH_CONCURRENCY", "4"))
+# Times a transcription is retried after failing to connect or a gateway error
+HANDWRITING_RETRIES = int(os.getenv("HANDWRITING_RETRIES", "2"))
+# Base delay in seconds between retries, doubled after each attempt
+HANDWRITING_RETRY_BACKOFF = float(os.getenv("HANDWRITING_RETRY_BACKOFF", "0.25"))
+# Consecutive failed transcriptions after which the handwriting server is given
+# HANDWRITING_BREAKER_RESET seconds to recover before being tried again
+HANDWRITING_BREAKER_THRESHOLD = int(os.getenv("HANDWRITING_BREAKER_THRESHOLD", "5"))
+HANDWRITING_BREAKER_RESET = float(os.getenv("HANDWRITING_BREAKER_RESET", "30"))
+
+# Pixels of blank canvas kept around the ink when cropping code block images
+HANDWRITING_CROP_MARGIN = int(os.getenv("HANDWRITING_CROP_MARGIN", "16"))
+# Height in pixels code block images are shrunk to before transcription (0 to keep
+# their size), e.g. the handwriting model's input height
+HANDWRITING_INPUT_HEIGHT = int(os.getenv("HANDWRITING_INPUT_HEIGHT", "0"))
+# Transcribe each line of a code block separately, so edits only re-transcribe the
+# lines they touch. Enable for models that read single lines.
+HANDWRITING_SPLIT_LINES = os.getenv("HANDWRITING_SPLIT_LINES") == "true"
+# Blank rows of pixels that separate two lines of handwriting
+HANDWRITING_LINE_GAP = int(os.getenv("HANDWRITING_LINE_GAP", "12"))
+
+# Transcriptions kept in each process, keyed by image and model (0 to disable)
+TRANSCRIPTION_CACHE_SIZE = int(os.getenv("TRANSCRIPTION_CACHE_SIZE", "512"))
+# Name of a cache in CACHES to share transcriptions between processes, if any
+TRANSCRIPTION_CACHE_ALIAS = os.getenv("TRANSCRIPTION_CACHE_ALIAS")
+# Seconds transcriptions are kept in the shared cache
+TRANSCRIPTION_CACHE_TIMEOUT = int(os.getenv("TRANSCRIPTION_CACHE_TIMEOUT", "86400"))
+
+# Queued transcriptions run at once in each process, and how many more may wait
+TRANSCRIPTION_WORKERS = int(os.getenv("TRANSCRIPTION_WORKERS", "4"))
+TRANSCRIPTION_QUEUE_SIZE = int(os.getenv("TRANSCRIPTION_QUEUE_SIZE", "32"))
+# Name of the cache in CACHES holding queued transcriptions' states, which must be
+# shared between processes when there is more than one (checked at startup)
+TRANSCRIPTION_JOB_CACHE_ALIAS = os.getenv("TRANSCRIPTION_JOB_CACHE_ALIAS", "shared")
+# Seconds a transcription's result is kept for collection
+TRANSCRIPTION_JOB_TIMEOUT = int(os.getenv("TRANSCRIPTION_JOB_TIMEOUT", "600"))
+
+# Notebooks listed at a time in the notebooks dialog
+NOTEBOOK_PAGE_SIZE = int(os.getenv("NOTEBOOK_PAGE_SIZE", "50"))
+# Saves of a notebook as patches before they are folded into its data
+NOTEBOOK_COMPACT_INTERVAL = int(os.getenv("NOTEBOOK_COMPACT_INTERVAL", "20"))
+# Name of the cache in CACHES holding opened notebooks, which must be shared between
+# processes when there is more than one, as saves only invalidate it there (checked
+# at startup)
+NOTEBOOK_CACHE_ALIAS = os.getenv("NOTEBOOK_CACHE_ALIAS", "shared")
+# Seconds an opened notebook is kept in the cache
+NOTEBOOK_CACHE_TIMEOUT = int(os.getenv("NOTEBOOK_CACHE_TIMEOUT", "3600"))